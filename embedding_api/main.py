@@ -8,18 +8,67 @@ This service:
 """
 
 import os
+import asyncio
+import struct
+import bisect
+import hashlib
+import threading
 import torch
 import numpy as np
 import json
 from pathlib import Path
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import FastAPI, HTTPException, Body, Header, Response
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from transformers import AutoTokenizer, AutoModel
 
 # Constants
 MODEL_NAME = "Snowflake/snowflake-arctic-embed-m"
 EMBEDDING_DIM = 768  # Dimension of the snowflake-arctic-embed-m embeddings
+MAX_LENGTH = 512  # Maximum number of tokens per snippet
+
+# Inference backend: "torch" (fp32 PyTorch), "onnx" (fp32 ONNX Runtime)
+# or "onnx-int8" (ONNX Runtime with dynamic int8 quantization)
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+# Exported models are cached on the shared volume, one directory per model, so they survive container rebuilds
+ONNX_MODEL_DIR = Path(os.getenv("ONNX_MODEL_DIR", "/app/shared/onnx_model")) / MODEL_NAME.replace("/", "--")
+ONNX_INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]  # Order of BertModel.forward
+
+# Embedding modes: "truncate" embeds the first MAX_LENGTH tokens only, "pooled"
+# embeds overlapping token windows and averages them into one file vector, and
+# "chunks" additionally returns every window vector with its line range
+EMBEDDING_MODES = ("truncate", "pooled", "chunks")
+# Windows are MAX_LENGTH tokens long and consecutive windows share CHUNK_OVERLAP_TOKENS
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "128"))
+
+# Micro-batching settings for single-snippet /embed requests
+MICROBATCH_MAX_WAIT_MS = float(os.getenv("MICROBATCH_MAX_WAIT_MS", "5"))
+MICROBATCH_MAX_SIZE = int(os.getenv("MICROBATCH_MAX_SIZE", "16"))
+
+# Length-bucketed /embed_batch settings: maximum padded tokens and rows per forward pass
+EMBED_BATCH_TOKEN_BUDGET = int(os.getenv("EMBED_BATCH_TOKEN_BUDGET", "8192"))
+EMBED_BATCH_MAX_SIZE = int(os.getenv("EMBED_BATCH_MAX_SIZE", "32"))
+
+# Inference executor settings: number of forward passes that may run at once
+# and the number of intra-op threads torch uses for each of them
+INFERENCE_SLOTS = int(os.getenv("INFERENCE_SLOTS", "1"))
+TORCH_NUM_THREADS = int(os.getenv("TORCH_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // INFERENCE_SLOTS))))
+
+# Binary transport: clients opt in with "Accept: application/x-embeddings; dtype=float16".
+# The payload is a 16-byte little-endian header (magic, dtype code, rows, dim)
+# followed by the row-major matrix; batch rows follow the request's key order.
+EMBEDDING_MEDIA_TYPE = "application/x-embeddings"
+EMBEDDING_MAGIC = b"EMB1"
+EMBEDDING_HEADER = struct.Struct("<4sBxxxII")
+EMBEDDING_DTYPES = {"float32": 0, "float16": 1}
+
+# Embedding cache settings: in-memory LRU capacity and optional on-disk tier
+EMBEDDING_CACHE_SIZE = int(os.getenv("EMBEDDING_CACHE_SIZE", "10000"))
+EMBEDDING_CACHE_DIR = os.getenv("EMBEDDING_CACHE_DIR", "")  # Empty disables the disk tier
+CACHE_IO_WORKERS = int(os.getenv("CACHE_IO_WORKERS", "4"))  # Threads reading and writing disk cache entries
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -31,133 +80,728 @@ app = FastAPI(
 # Models for API requests and responses
 class CodeEmbeddingRequest(BaseModel):
     code: str
+    mode: str = "truncate"  # One of EMBEDDING_MODES
+    normalize: bool = False  # L2-normalize the returned vectors (for cosine / inner-product search)
 
 class BatchEmbeddingRequest(BaseModel):
     code_snippets: Dict[str, str]  # key: file_path, value: code_content
+    mode: str = "truncate"  # One of EMBEDDING_MODES
+    normalize: bool = False  # L2-normalize the returned vectors (for cosine / inner-product search)
+
+class ChunkEmbedding(BaseModel):
+    embedding: List[float]
+    start_line: int  # 1-based, inclusive
+    end_line: int  # 1-based, inclusive
+    n_tokens: int
 
 class EmbeddingResponse(BaseModel):
     embedding: List[float]
+    chunks: Optional[List[ChunkEmbedding]] = None  # Only set in "chunks" mode
 
 class BatchEmbeddingResponse(BaseModel):
     embeddings: Dict[str, List[float]]  # key: file_path, value: embedding
+    chunks: Optional[Dict[str, List[ChunkEmbedding]]] = None  # Only set in "chunks" mode
 
 # Global variables for the model and tokenizer
 model = None
 tokenizer = None
+onnx_session = None  # Set instead of model when an ONNX backend is selected
+backend = None  # Name of the loaded inference backend
+
+# Dedicated executor for forward passes, so the event loop stays responsive
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_SLOTS, thread_name_prefix="inference")
+inference_slots: asyncio.Semaphore = None
+
+# Small executor for the cache's disk tier, so file IO neither blocks the event loop nor waits for inference
+cache_io_executor = ThreadPoolExecutor(max_workers=CACHE_IO_WORKERS, thread_name_prefix="cache-io")
+
+# Queue of pending single-snippet requests and the task that drains it
+embed_queue: asyncio.Queue = None
+batcher_task: asyncio.Task = None
+inflight_batches = set()  # References to running micro-batch tasks
+
+# Micro-batching counters exposed on /metrics
+batch_stats = {
+    "requests": 0,
+    "batches": 0,
+    "max_batch_size": 0,
+    "max_queue_depth": 0,
+}
+
+class EmbeddingCache:
+    """Content-addressed embedding cache with an LRU memory tier and an optional disk tier.
+    
+    Keys are hashes of the model settings and the normalized snippet text, so a
+    change of model, max_length or backend never returns stale vectors. Disk entries are
+    stored as one .npy file per key and survive restarts; they are read and written
+    on cache_io_executor.
+    """
+    
+    def __init__(self, capacity: int, cache_dir: str = ""):
+        self.capacity = capacity
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+    
+    @staticmethod
+    def normalize(text: str) -> str:
+        """Normalize line endings and trailing whitespace before hashing.
+        
+        Leading blank lines are kept: they shift the line ranges cached with chunk embeddings.
+        """
+        lines = text.replace("\r\n", "\n").replace("\r", "\n").split("\n")
+        return "\n".join(line.rstrip() for line in lines)
+    
+    def key(self, text: str, *variant: str) -> str:
+        """Build the cache key for a snippet under the current model settings."""
+        parts = [MODEL_NAME, str(MAX_LENGTH), EMBEDDING_BACKEND, *variant, self.normalize(text)]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+    
+    def disk_path(self, key: str) -> Path:
+        """Return the on-disk location of a cache entry."""
+        return self.cache_dir / key[:2] / f"{key}.npy"
+    
+    async def get(self, key: str) -> Optional[np.ndarray]:
+        """Return the cached embedding for key, or None on a miss."""
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats["memory_hits"] += 1
+                return self.entries[key]
+        
+        if self.cache_dir is not None:
+            embedding = await asyncio.get_running_loop().run_in_executor(cache_io_executor, self.read, key)
+            if embedding is not None:
+                self.remember(key, embedding)
+                with self.lock:
+                    self.stats["disk_hits"] += 1
+                return embedding
+        
+        with self.lock:
+            self.stats["misses"] += 1
+        return None
+    
+    async def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up several keys, reading their disk entries concurrently."""
+        return await asyncio.gather(*(self.get(key) for key in keys))
+    
+    async def put(self, key: str, embedding: np.ndarray):
+        """Store an embedding in memory and, with a disk tier, on disk."""
+        embedding = self.remember(key, embedding)
+        if self.cache_dir is not None:
+            await asyncio.get_running_loop().run_in_executor(cache_io_executor, self.write, key, embedding)
+    
+    def remember(self, key: str, embedding: np.ndarray) -> np.ndarray:
+        """Store an embedding in the memory tier, evicting the least recently used entry if full.
+        
+        A copy is stored, so an entry never keeps a larger batch matrix it is a view of alive.
+        """
+        embedding = np.array(embedding, copy=True)
+        with self.lock:
+            self.entries[key] = embedding
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        return embedding
+    
+    def read(self, key: str) -> Optional[np.ndarray]:
+        """Read a disk entry (blocking); returns None if it is missing or unreadable."""
+        path = self.disk_path(key)
+        if not path.exists():
+            return None
+        try:
+            return np.load(path)
+        except Exception as e:
+            print(f"WARNING: Could not read cache entry {path}: {str(e)}")
+            return None
+    
+    def write(self, key: str, embedding: np.ndarray):
+        """Write a disk entry atomically (blocking)."""
+        path = self.disk_path(key)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            with open(tmp_path, "wb") as f:
+                np.save(f, embedding)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"WARNING: Could not write cache entry {path}: {str(e)}")
+    
+    def metrics(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current size."""
+        with self.lock:
+            lookups = sum(self.stats.values())
+            hits = self.stats["memory_hits"] + self.stats["disk_hits"]
+            return {
+                **self.stats,
+                "hit_rate": hits / lookups if lookups else 0.0,
+                "memory_entries": len(self.entries),
+                "memory_capacity": self.capacity,
+                "disk_enabled": self.cache_dir is not None
+            }
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_DIR)
 
 def get_root_dir():
     """Get the root directory of the project."""
     current_file = Path(__file__)
     return current_file.parent.parent  # Go up from embedding_api to project root
 
+def export_onnx_model(output_path: Path):
+    """Export the fp32 PyTorch model to ONNX with dynamic batch and sequence axes."""
+    print(f"Exporting {MODEL_NAME} to ONNX at {output_path}...")
+    torch_model = AutoModel.from_pretrained(MODEL_NAME)
+    torch_model.eval()
+    
+    sample = tokenizer(["int main() { return 0; }"], return_tensors="pt")
+    input_names = [name for name in ONNX_INPUT_NAMES if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            torch_model,
+            tuple(sample[name] for name in input_names),
+            str(output_path),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14
+        )
+
+def load_onnx_session(quantized: bool):
+    """Load an ONNX Runtime session, exporting and quantizing the model on first use."""
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    
+    model_path = ONNX_MODEL_DIR / "model.onnx"
+    if not model_path.exists():
+        export_onnx_model(model_path)
+    
+    if quantized:
+        quantized_path = ONNX_MODEL_DIR / "model.int8.onnx"
+        if not quantized_path.exists():
+            print(f"Quantizing {model_path} to int8...")
+            quantize_dynamic(str(model_path), str(quantized_path), weight_type=QuantType.QInt8)
+        model_path = quantized_path
+    
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = TORCH_NUM_THREADS
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return ort.InferenceSession(str(model_path), options, providers=["CPUExecutionProvider"])
+
+def load_backend(name: str):
+    """Load the tokenizer and the requested inference backend into the module globals."""
+    global model, tokenizer, onnx_session, backend
+    
+    if name not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{name}', expected one of {EMBEDDING_BACKENDS}")
+    
+    if tokenizer is None:
+        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+    
+    if name == "torch":
+        model = AutoModel.from_pretrained(MODEL_NAME)
+        model.eval()  # Set to evaluation mode
+        onnx_session = None
+    else:
+        onnx_session = load_onnx_session(quantized=(name == "onnx-int8"))
+        model = None
+    backend = name
+
 # Load the model and tokenizer on startup
 @app.on_event("startup")
 async def startup_load_model():
     """Load the model and tokenizer on startup."""
-    global model, tokenizer
+    torch.set_num_threads(TORCH_NUM_THREADS)
+    print(f"Using {TORCH_NUM_THREADS} torch threads and {INFERENCE_SLOTS} inference slot(s)")
     
-    print("Loading tokenizer and model...")
+    print(f"Loading tokenizer and model with the {EMBEDDING_BACKEND} backend...")
     try:
-        # Load the tokenizer
-        tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
-        
-        # Load the model with CPU optimizations
-        model = AutoModel.from_pretrained(MODEL_NAME)
-        model.eval()  # Set to evaluation mode
-        print(f"Successfully loaded {MODEL_NAME} model")
+        load_backend(EMBEDDING_BACKEND)
+        print(f"Successfully loaded {MODEL_NAME} model ({backend} backend)")
     except Exception as e:
         print(f"Error loading model: {str(e)}")
         raise RuntimeError(f"Failed to load model: {str(e)}")
 
-def generate_single_embedding(code: str):
-    """Generate embedding for a single code snippet."""
-    # Check if model and tokenizer are loaded
-    if model is None or tokenizer is None:
+# Start the micro-batcher on startup
+@app.on_event("startup")
+async def startup_microbatcher():
+    """Create the request queue and start the micro-batching task."""
+    global embed_queue, batcher_task, inference_slots
+    
+    inference_slots = asyncio.Semaphore(INFERENCE_SLOTS)
+    embed_queue = asyncio.Queue()
+    batcher_task = asyncio.create_task(run_microbatcher())
+    print(f"Micro-batcher started (max_wait={MICROBATCH_MAX_WAIT_MS}ms, max_batch={MICROBATCH_MAX_SIZE})")
+
+@app.on_event("shutdown")
+async def shutdown_microbatcher():
+    """Stop the micro-batching task."""
+    if batcher_task is not None:
+        batcher_task.cancel()
+    inference_executor.shutdown(wait=False)
+    cache_io_executor.shutdown(wait=True)
+
+def is_model_loaded() -> bool:
+    """Return True once the tokenizer and an inference backend are loaded."""
+    return tokenizer is not None and (model is not None or onnx_session is not None)
+
+def check_model_loaded():
+    """Raise if the model or tokenizer has not been loaded yet."""
+    if not is_model_loaded():
         raise RuntimeError("Model or tokenizer not loaded!")
+
+def forward_mean_pooled(inputs) -> np.ndarray:
+    """Run the model on tokenized inputs and return mean-pooled embeddings."""
+    if onnx_session is not None:
+        feeds = {
+            session_input.name: inputs[session_input.name].cpu().numpy()
+            for session_input in onnx_session.get_inputs()
+        }
+        token_embeddings = onnx_session.run(["last_hidden_state"], feeds)[0]
+        # Use mean pooling
+        input_mask_expanded = feeds["attention_mask"][..., None].astype("float32")
+        embeddings = np.sum(token_embeddings * input_mask_expanded, 1) / np.clip(input_mask_expanded.sum(1), 1e-9, None)
+        return embeddings.astype('float32')
+    
+    with torch.no_grad():
+        outputs = model(**inputs)
+        # Use mean pooling
+        attention_mask = inputs["attention_mask"]
+        token_embeddings = outputs.last_hidden_state
+        input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
+        embeddings = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
+        embeddings = embeddings.cpu().numpy()
+    
+    return embeddings.astype('float32')
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """Run one padded forward pass over texts and return mean-pooled embeddings."""
+    check_model_loaded()
     
     # Tokenize
     inputs = tokenizer(
-        code,
+        texts,
         padding=True,
         truncation=True,
-        max_length=512,
+        max_length=MAX_LENGTH,
         return_tensors="pt"
     )
     
-    # Generate embedding
-    with torch.no_grad():
-        outputs = model(**inputs)
-        # Use mean pooling
-        attention_mask = inputs["attention_mask"]
-        token_embeddings = outputs.last_hidden_state
-        input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-        embedding = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
-        embedding = embedding.cpu().numpy()[0]  # Get the first (and only) embedding
+    return forward_mean_pooled(inputs)
+
+def plan_length_buckets(lengths: List[int]) -> List[List[int]]:
+    """Group input indices into sub-batches of similar token length.
     
-    return embedding.astype('float32').tolist()
+    Indices are sorted by length and a sub-batch is closed once its padded size
+    (rows * longest row) would exceed EMBED_BATCH_TOKEN_BUDGET or it reaches
+    EMBED_BATCH_MAX_SIZE rows.
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    buckets = []
+    current = []
+    for i in order:
+        # Lengths are ascending, so the new row is the longest in the bucket
+        padded_tokens = (len(current) + 1) * lengths[i]
+        if current and (padded_tokens > EMBED_BATCH_TOKEN_BUDGET or len(current) >= EMBED_BATCH_MAX_SIZE):
+            buckets.append(current)
+            current = []
+        current.append(i)
+    if current:
+        buckets.append(current)
+    return buckets
 
-def generate_batch_embeddings(code_snippets: Dict[str, str]):
-    """Generate embeddings for multiple code snippets."""
-    # Check if model and tokenizer are loaded
-    if model is None or tokenizer is None:
-        raise RuntimeError("Model or tokenizer not loaded!")
+def embed_features_bucketed(features: List[Dict[str, List[int]]]) -> np.ndarray:
+    """Embed pre-tokenized inputs in length-sorted, token-budgeted sub-batches.
     
+    Rows are returned in the original input order.
+    """
+    lengths = [len(feature["input_ids"]) for feature in features]
+    
+    embeddings = np.zeros((len(features), EMBEDDING_DIM), dtype="float32")
+    for bucket in plan_length_buckets(lengths):
+        inputs = tokenizer.pad([features[i] for i in bucket], padding=True, return_tensors="pt")
+        embeddings[bucket] = forward_mean_pooled(inputs)
+    
+    return embeddings
+
+def embed_texts_bucketed(texts: List[str]) -> np.ndarray:
+    """Embed texts in length-sorted, token-budgeted sub-batches.
+    
+    Texts are tokenized once without padding, grouped by length and padded per
+    sub-batch, so short snippets do not pay for the longest one in the request.
+    Rows are returned in the original input order.
+    """
+    check_model_loaded()
+    
+    encodings = tokenizer(texts, truncation=True, max_length=MAX_LENGTH)
+    features = [{key: encodings[key][i] for key in encodings.keys()} for i in range(len(texts))]
+    return embed_features_bucketed(features)
+
+def embed_chunked(texts: List[str]) -> List[Tuple[np.ndarray, np.ndarray]]:
+    """Embed every overlapping token window of each text.
+    
+    The tokenizer splits each text into MAX_LENGTH-token windows overlapping by
+    CHUNK_OVERLAP_TOKENS, so texts that fit in one window cost the same as in
+    "truncate" mode. Returns one (vectors, spans) pair per text, where vectors is
+    (n_windows, dim) and spans is an int32 (n_windows, 3) array of start_line,
+    end_line and n_tokens. All windows of all texts share the same bucketed
+    forward passes.
+    """
+    check_model_loaded()
+    
+    encodings = tokenizer(
+        texts,
+        truncation=True,
+        max_length=MAX_LENGTH,
+        stride=CHUNK_OVERLAP_TOKENS,
+        return_overflowing_tokens=True,
+        return_offsets_mapping=True
+    )
+    owners = np.asarray(encodings["overflow_to_sample_mapping"])
+    line_starts = [[0] + [i + 1 for i, char in enumerate(text) if char == "\n"] for text in texts]
+    
+    features = []
+    spans = []
+    for w, t in enumerate(owners):
+        features.append({key: encodings[key][w] for key in tokenizer.model_input_names if key in encodings})
+        
+        # Special tokens have empty (0, 0) offsets
+        offsets = [(start, end) for start, end in encodings["offset_mapping"][w] if end > start]
+        if offsets:
+            start_line = bisect.bisect_right(line_starts[t], offsets[0][0])
+            end_line = bisect.bisect_right(line_starts[t], offsets[-1][1] - 1)
+        else:
+            start_line = end_line = 1
+        spans.append((start_line, end_line, len(offsets)))
+    
+    vectors = embed_features_bucketed(features)
+    spans = np.asarray(spans, dtype="int32").reshape(-1, 3)
+    
+    return [(vectors[owners == t], spans[owners == t]) for t in range(len(texts))]
+
+def pool_chunks(vectors: np.ndarray, spans: np.ndarray) -> np.ndarray:
+    """Average window vectors into one file vector, weighted by window token count."""
+    weights = np.clip(spans[:, 2].astype("float32"), 1.0, None)
+    return (vectors * weights[:, None]).sum(axis=0) / weights.sum()
+
+def generate_chunked_embeddings(code_snippets: Dict[str, str]):
+    """Generate sliding-window chunk embeddings for multiple code snippets."""
     file_paths = list(code_snippets.keys())
     contents = list(code_snippets.values())
     
     if not contents:
         return {}
     
-    # Tokenize
-    inputs = tokenizer(
-        contents,
-        padding=True,
-        truncation=True,
-        max_length=512,
-        return_tensors="pt"
-    )
+    return dict(zip(file_paths, embed_chunked(contents)))
+
+def generate_batch_embeddings(code_snippets: Dict[str, str]):
+    """Generate embeddings for multiple code snippets."""
+    file_paths = list(code_snippets.keys())
+    contents = list(code_snippets.values())
     
-    # Generate embeddings
-    with torch.no_grad():
-        outputs = model(**inputs)
-        # Use mean pooling
-        attention_mask = inputs["attention_mask"]
-        token_embeddings = outputs.last_hidden_state
-        input_mask_expanded = attention_mask.unsqueeze(-1).expand(token_embeddings.size()).float()
-        batch_embeddings = torch.sum(token_embeddings * input_mask_expanded, 1) / torch.clamp(input_mask_expanded.sum(1), min=1e-9)
-        batch_embeddings = batch_embeddings.cpu().numpy()
+    if not contents:
+        return {}
+    
+    batch_embeddings = embed_texts_bucketed(contents)
     
     # Create a dictionary mapping file paths to embeddings
     result = {}
     for i, file_path in enumerate(file_paths):
-        result[file_path] = batch_embeddings[i].astype('float32').tolist()
+        result[file_path] = batch_embeddings[i]
     
     return result
 
-@app.post("/embed", response_model=EmbeddingResponse)
-async def embed_code(request: CodeEmbeddingRequest):
-    """Generate embedding for a single code snippet."""
+async def run_inference(func, *args):
+    """Run a blocking inference function on the inference executor."""
+    async with inference_slots:
+        return await asyncio.get_running_loop().run_in_executor(inference_executor, func, *args)
+
+async def run_microbatch(batch):
+    """Embed one gathered micro-batch and resolve its futures."""
+    try:
+        embeddings = await asyncio.get_running_loop().run_in_executor(
+            inference_executor, embed_texts, [code for code, _ in batch]
+        )
+    except Exception as e:
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    finally:
+        inference_slots.release()
+    
+    for (_, future), embedding in zip(batch, embeddings):
+        if not future.done():
+            future.set_result(embedding)
+
+async def run_microbatcher():
+    """Gather queued single-snippet requests and embed them as one padded batch.
+    
+    A batch is closed when MICROBATCH_MAX_SIZE requests are collected or
+    MICROBATCH_MAX_WAIT_MS has passed since the first request arrived.
+    The next batch is only gathered once an inference slot is free, so
+    requests keep accumulating while all slots are busy.
+    """
+    loop = asyncio.get_running_loop()
+    max_wait = MICROBATCH_MAX_WAIT_MS / 1000.0
+    
+    while True:
+        # Block until at least one request is waiting
+        batch = [await embed_queue.get()]
+        await inference_slots.acquire()
+        deadline = loop.time() + max_wait
+        
+        # Collect more requests until the batch is full or the window closes
+        while len(batch) < MICROBATCH_MAX_SIZE:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(embed_queue.get(), timeout=remaining))
+            except asyncio.TimeoutError:
+                break
+        
+        # Drop requests whose callers have gone away
+        batch = [(code, future) for code, future in batch if not future.done()]
+        if not batch:
+            inference_slots.release()
+            continue
+        
+        batch_stats["batches"] += 1
+        batch_stats["max_batch_size"] = max(batch_stats["max_batch_size"], len(batch))
+        
+        # Run the batch in the background; the slot is released when it finishes
+        task = asyncio.create_task(run_microbatch(batch))
+        inflight_batches.add(task)
+        task.add_done_callback(inflight_batches.discard)
+
+async def enqueue_single_embedding(code: str):
+    """Submit a single snippet to the micro-batcher and wait for its embedding."""
+    future = asyncio.get_running_loop().create_future()
+    await embed_queue.put((code, future))
+    
+    batch_stats["requests"] += 1
+    batch_stats["max_queue_depth"] = max(batch_stats["max_queue_depth"], embed_queue.qsize())
+    
+    return await future
+
+def validate_mode(mode: str):
+    """Reject unknown embedding modes with a 400."""
+    if mode not in EMBEDDING_MODES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown embedding mode '{mode}', expected one of {list(EMBEDDING_MODES)}"
+        )
+
+def negotiate_binary_dtype(accept: Optional[str]) -> Optional[str]:
+    """Return the requested binary dtype if the Accept header asks for binary embeddings."""
+    if not accept:
+        return None
+    for media_range in accept.split(","):
+        parts = [part.strip() for part in media_range.split(";")]
+        if parts[0] != EMBEDDING_MEDIA_TYPE:
+            continue
+        params = dict(part.split("=", 1) for part in parts[1:] if "=" in part)
+        dtype = params.get("dtype", "float32")
+        if dtype not in EMBEDDING_DTYPES:
+            raise HTTPException(
+                status_code=406,
+                detail=f"Unsupported embedding dtype '{dtype}', expected one of {list(EMBEDDING_DTYPES)}"
+            )
+        return dtype
+    return None
+
+def encode_embeddings(matrix: np.ndarray, dtype: str, metadata: Optional[Dict[str, Any]] = None) -> bytes:
+    """Pack an embedding matrix into the binary transport format.
+    
+    Optional metadata is appended after the matrix as a UTF-8 JSON trailer.
+    """
+    matrix = np.ascontiguousarray(matrix, dtype=np.dtype(dtype).newbyteorder("<"))
+    rows, dim = matrix.shape
+    payload = EMBEDDING_HEADER.pack(EMBEDDING_MAGIC, EMBEDDING_DTYPES[dtype], rows, dim) + matrix.tobytes()
+    if metadata is not None:
+        payload += json.dumps(metadata).encode("utf-8")
+    return payload
+
+def binary_embeddings_response(matrix: np.ndarray, dtype: str, metadata: Optional[Dict[str, Any]] = None) -> Response:
+    """Build a binary embeddings response."""
+    return Response(
+        content=encode_embeddings(matrix, dtype, metadata),
+        media_type=f"{EMBEDDING_MEDIA_TYPE}; dtype={dtype}"
+    )
+
+def binary_chunks_response(chunked: List[Tuple[np.ndarray, np.ndarray]], dtype: str) -> Response:
+    """Build a binary response holding every chunk vector of every snippet.
+    
+    The JSON trailer's "spans" holds [snippet_index, start_line, end_line, n_tokens]
+    for each row, where snippet_index is the position of the snippet in the request.
+    """
+    matrix = np.vstack([vectors for vectors, _ in chunked]) if chunked else np.zeros((0, EMBEDDING_DIM), dtype="float32")
+    spans = [[i, *span] for i, (_, snippet_spans) in enumerate(chunked) for span in snippet_spans.tolist()]
+    return binary_embeddings_response(matrix, dtype, {"spans": spans})
+
+def l2_normalize(vectors: np.ndarray) -> np.ndarray:
+    """Scale vectors (a single vector or one per row) to unit L2 norm."""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return (vectors / np.clip(norms, 1e-12, None)).astype("float32")
+
+def chunk_entries(vectors: np.ndarray, spans: np.ndarray) -> List[Dict[str, Any]]:
+    """Convert chunk vectors and spans to ChunkEmbedding dictionaries."""
+    return [
+        {"embedding": vector.tolist(), "start_line": int(span[0]), "end_line": int(span[1]), "n_tokens": int(span[2])}
+        for vector, span in zip(vectors, spans)
+    ]
+
+async def get_chunked_embeddings(code_snippets: Dict[str, str]) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """Return (vectors, spans) per snippet, serving cached snippets without running the model."""
+    variant = ("chunks", str(CHUNK_OVERLAP_TOKENS))
+    keys = {}
+    results = {}
+    misses = {}
+    for file_path, code in code_snippets.items():
+        keys[file_path] = (embedding_cache.key(code, *variant, "vectors"), embedding_cache.key(code, *variant, "spans"))
+    cached_vectors = dict(zip(keys, await embedding_cache.get_many([vectors_key for vectors_key, _ in keys.values()])))
+    hits = [file_path for file_path, vectors in cached_vectors.items() if vectors is not None]
+    cached_spans = dict(zip(hits, await embedding_cache.get_many([keys[file_path][1] for file_path in hits])))
+    for file_path, code in code_snippets.items():
+        if cached_spans.get(file_path) is not None:
+            results[file_path] = (cached_vectors[file_path], cached_spans[file_path])
+        else:
+            misses[file_path] = code
+    
+    if misses:
+        computed = await run_inference(generate_chunked_embeddings, misses)
+        await asyncio.gather(*(
+            embedding_cache.put(key, value)
+            for file_path, (vectors, spans) in computed.items()
+            for key, value in zip(keys[file_path], (vectors, spans))
+        ))
+        results.update(computed)
+    
+    return results
+
+@app.post("/embed", response_model=EmbeddingResponse, response_model_exclude_none=True)
+async def embed_code(request: CodeEmbeddingRequest, accept: Optional[str] = Header(None)):
+    """Generate embedding for a single code snippet.
+    
+    Returns JSON by default, or the binary transport format when requested via Accept.
+    In "chunks" mode the binary rows are the chunk vectors.
+    """
+    validate_mode(request.mode)
+    binary_dtype = negotiate_binary_dtype(accept)
     try:
-        embedding = generate_single_embedding(request.code)
-        return {"embedding": embedding}
+        if request.mode == "truncate":
+            key = embedding_cache.key(request.code)
+            embedding = await embedding_cache.get(key)
+            if embedding is None:
+                embedding = await enqueue_single_embedding(request.code)
+                await embedding_cache.put(key, embedding)
+        else:
+            vectors, spans = (await get_chunked_embeddings({"code": request.code}))["code"]
+            embedding = pool_chunks(vectors, spans)
+        
+        # Cached vectors stay unnormalized; normalization is applied per response
+        if request.normalize:
+            embedding = l2_normalize(embedding)
+            if request.mode != "truncate":
+                vectors = l2_normalize(vectors)
+        
+        if binary_dtype:
+            if request.mode == "chunks":
+                return binary_chunks_response([(vectors, spans)], binary_dtype)
+            return binary_embeddings_response(embedding.reshape(1, -1), binary_dtype)
+        
+        response = {"embedding": embedding.tolist()}
+        if request.mode == "chunks":
+            response["chunks"] = chunk_entries(vectors, spans)
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating embedding: {str(e)}")
 
-@app.post("/embed_batch", response_model=BatchEmbeddingResponse)
-async def embed_batch(request: BatchEmbeddingRequest):
-    """Generate embeddings for multiple code snippets."""
+@app.post("/embed_batch", response_model=BatchEmbeddingResponse, response_model_exclude_none=True)
+async def embed_batch(request: BatchEmbeddingRequest, accept: Optional[str] = Header(None)):
+    """Generate embeddings for multiple code snippets.
+    
+    Returns JSON by default, or the binary transport format when requested via Accept.
+    Binary rows follow the key order of request.code_snippets; in "chunks" mode
+    they are the chunk vectors of every snippet in that order.
+    """
+    validate_mode(request.mode)
+    binary_dtype = negotiate_binary_dtype(accept)
     try:
-        embeddings = generate_batch_embeddings(request.code_snippets)
-        return {"embeddings": embeddings}
+        chunked = None
+        if request.mode == "truncate":
+            # Serve cached snippets directly and only run the model on misses
+            keys = {file_path: embedding_cache.key(code) for file_path, code in request.code_snippets.items()}
+            embeddings = {}
+            misses = {}
+            cached = await embedding_cache.get_many(list(keys.values()))
+            for (file_path, code), embedding in zip(request.code_snippets.items(), cached):
+                if embedding is not None:
+                    embeddings[file_path] = embedding
+                else:
+                    misses[file_path] = code
+            
+            if misses:
+                computed = await run_inference(generate_batch_embeddings, misses)
+                await asyncio.gather(*(embedding_cache.put(keys[file_path], embedding) for file_path, embedding in computed.items()))
+                embeddings.update(computed)
+        else:
+            chunked = await get_chunked_embeddings(request.code_snippets)
+            embeddings = {file_path: pool_chunks(vectors, spans) for file_path, (vectors, spans) in chunked.items()}
+        
+        # Cached vectors stay unnormalized; normalization is applied per response
+        if request.normalize:
+            embeddings = {file_path: l2_normalize(embedding) for file_path, embedding in embeddings.items()}
+            if chunked is not None:
+                chunked = {file_path: (l2_normalize(vectors), spans) for file_path, (vectors, spans) in chunked.items()}
+        
+        if binary_dtype:
+            if request.mode == "chunks":
+                return binary_chunks_response([chunked[file_path] for file_path in request.code_snippets], binary_dtype)
+            matrix = np.zeros((len(request.code_snippets), EMBEDDING_DIM), dtype="float32")
+            for i, file_path in enumerate(request.code_snippets):
+                matrix[i] = embeddings[file_path]
+            return binary_embeddings_response(matrix, binary_dtype)
+        
+        # Preserve the request's key order
+        response = {"embeddings": {file_path: embeddings[file_path].tolist() for file_path in request.code_snippets}}
+        if request.mode == "chunks":
+            response["chunks"] = {file_path: chunk_entries(*chunked[file_path]) for file_path in request.code_snippets}
+        return response
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating batch embeddings: {str(e)}")
 
 @app.get("/health")
 async def health():
     """Health check endpoint."""
-    if model is None or tokenizer is None:
+    if not is_model_loaded():
         return {"status": "unhealthy", "message": "Model or tokenizer not loaded"}
-    return {"status": "healthy", "model": MODEL_NAME}
+    return {"status": "healthy", "model": MODEL_NAME, "backend": backend}
+
+@app.get("/metrics")
+async def metrics():
+    """Micro-batching, inference and cache metrics."""
+    batches = batch_stats["batches"]
+    return {
+        "queue_depth": embed_queue.qsize() if embed_queue is not None else 0,
+        "max_queue_depth": batch_stats["max_queue_depth"],
+        "requests": batch_stats["requests"],
+        "batches": batches,
+        "avg_batch_size": batch_stats["requests"] / batches if batches else 0.0,
+        "max_batch_size": batch_stats["max_batch_size"],
+        "max_wait_ms": MICROBATCH_MAX_WAIT_MS,
+        "max_batch": MICROBATCH_MAX_SIZE,
+        "inference_slots": INFERENCE_SLOTS,
+        "torch_threads": TORCH_NUM_THREADS,
+        "cache": embedding_cache.metrics()
+    }
 
 @app.get("/")
 async def root():
@@ -166,9 +810,11 @@ async def root():
         "name": "Code Embedding API",
         "description": "Service for generating code embeddings using snowflake-arctic-embed-m model",
         "model": MODEL_NAME,
+        "backend": backend,
         "endpoints": [
             {"path": "/", "method": "GET", "description": "This information"},
             {"path": "/health", "method": "GET", "description": "Health check"},
+            {"path": "/metrics", "method": "GET", "description": "Micro-batching and cache metrics"},
             {"path": "/embed", "method": "POST", "description": "Generate embedding for single code snippet"},
             {"path": "/embed_batch", "method": "POST", "description": "Generate embeddings for multiple code snippets"}
         ]
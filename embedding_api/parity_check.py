@@ -0,0 +1,94 @@
+'''
+This script compares an embedding backend against the fp32 PyTorch reference.
+It embeds a sample of processed code files with both backends and reports the
+cosine drift between the two sets of vectors and the speedup of the candidate.
+
+Usage (inside the embedding_api container):
+    python parity_check.py --backend onnx-int8 --dir /app/shared/processed_codefiles --limit 64
+'''
+
+import argparse
+import time
+import numpy as np
+from pathlib import Path
+from typing import List
+
+import main
+
+def read_sample(code_dir: Path, limit: int) -> List[str]:
+    """Read up to limit non-empty code files from code_dir."""
+    texts = []
+    for file_path in sorted(code_dir.glob("**/*")):
+        if not file_path.is_file():
+            continue
+        try:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                content = f.read()
+        except Exception as e:
+            print(f"Skipping {file_path}: {str(e)}")
+            continue
+        if content.strip():
+            texts.append(content)
+        if len(texts) >= limit:
+            break
+    return texts
+
+def embed_with_backend(name: str, texts: List[str]):
+    """Load a backend and return its embeddings for texts and the time taken."""
+    main.load_backend(name)
+    # Warm up so one-off graph initialization is not counted
+    main.embed_texts(texts[:1])
+
+    start = time.perf_counter()
+    embeddings = main.embed_texts_bucketed(texts)
+    elapsed = time.perf_counter() - start
+    return embeddings, elapsed
+
+def cosine_rows(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Row-wise cosine similarity between two embedding matrices."""
+    a_norm = a / np.clip(np.linalg.norm(a, axis=1, keepdims=True), 1e-12, None)
+    b_norm = b / np.clip(np.linalg.norm(b, axis=1, keepdims=True), 1e-12, None)
+    return np.sum(a_norm * b_norm, axis=1)
+
+def nearest_neighbour_agreement(a: np.ndarray, b: np.ndarray) -> float:
+    """Fraction of rows whose nearest other row is the same under both embeddings."""
+    if len(a) < 2:
+        return 1.0
+    def nearest(x):
+        x = x / np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-12, None)
+        sims = x @ x.T
+        np.fill_diagonal(sims, -np.inf)
+        return np.argmax(sims, axis=1)
+    return float(np.mean(nearest(a) == nearest(b)))
+
+def main_cli():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Compare an embedding backend against fp32 PyTorch")
+    parser.add_argument("--backend", default="onnx-int8", choices=[b for b in main.EMBEDDING_BACKENDS if b != "torch"])
+    parser.add_argument("--dir", default="/app/shared/processed_codefiles", help="Directory of code files to sample")
+    parser.add_argument("--limit", type=int, default=64, help="Maximum number of files to embed")
+    args = parser.parse_args()
+
+    texts = read_sample(Path(args.dir), args.limit)
+    if not texts:
+        print(f"No code files found in {args.dir}")
+        return
+
+    print(f"Embedding {len(texts)} files with the torch reference backend...")
+    reference, reference_time = embed_with_backend("torch", texts)
+
+    print(f"Embedding {len(texts)} files with the {args.backend} backend...")
+    candidate, candidate_time = embed_with_backend(args.backend, texts)
+
+    cosines = cosine_rows(reference, candidate)
+
+    print("=" * 80)
+    print(f"Parity report: {args.backend} vs torch fp32 ({len(texts)} files)")
+    print("=" * 80)
+    print(f"Cosine similarity  mean: {cosines.mean():.6f}  min: {cosines.min():.6f}  p5: {np.percentile(cosines, 5):.6f}")
+    print(f"Cosine drift (1 - cos) mean: {1 - cosines.mean():.6f}  max: {1 - cosines.min():.6f}")
+    print(f"Nearest-neighbour agreement: {nearest_neighbour_agreement(reference, candidate):.1%}")
+    print(f"Time  torch: {reference_time:.2f}s  {args.backend}: {candidate_time:.2f}s  speedup: {reference_time / candidate_time:.2f}x")
+
+if __name__ == "__main__":
+    main_cli()
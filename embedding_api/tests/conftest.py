@@ -0,0 +1,25 @@
+"""Fixtures for the embedding_api tests; the test modules skip themselves without torch."""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+@pytest.fixture
+def service(tmp_path, monkeypatch):
+    """The service module with a tiny model loaded, fresh executors and an empty memory-only cache."""
+    from embedding_api_helpers import embedding_api, tiny_model
+
+    tokenizer, model = tiny_model(tmp_path)
+    monkeypatch.setattr(embedding_api, "tokenizer", tokenizer)
+    monkeypatch.setattr(embedding_api, "model", model)
+    monkeypatch.setattr(embedding_api, "onnx_session", None)
+    monkeypatch.setattr(embedding_api, "backend", "torch")
+    monkeypatch.setattr(embedding_api, "inference_executor", ThreadPoolExecutor(max_workers=1))
+    monkeypatch.setattr(embedding_api, "cache_io_executor", ThreadPoolExecutor(max_workers=2))
+    monkeypatch.setattr(embedding_api, "inference_slots", asyncio.Semaphore(embedding_api.INFERENCE_SLOTS))
+    monkeypatch.setattr(embedding_api, "embedding_cache", embedding_api.EmbeddingCache(100))
+    monkeypatch.setattr(embedding_api, "batch_stats", {name: 0 for name in embedding_api.batch_stats})
+    yield embedding_api
+    embedding_api.inference_executor.shutdown(wait=True)
+    embedding_api.cache_io_executor.shutdown(wait=True)
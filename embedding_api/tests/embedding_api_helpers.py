@@ -0,0 +1,32 @@
+"""Helpers for the embedding_api tests: the service module loaded from main.py and a tiny model."""
+
+import importlib.util
+import sys
+from pathlib import Path
+
+from transformers import BertConfig, BertModel, BertTokenizer
+
+ROOT = Path(__file__).resolve().parents[2]
+
+spec = importlib.util.spec_from_file_location("embedding_api_main", ROOT / "embedding_api" / "main.py")
+embedding_api = importlib.util.module_from_spec(spec)
+sys.modules["embedding_api_main"] = embedding_api
+spec.loader.exec_module(embedding_api)
+
+# Enough of a code vocabulary that snippets tokenize to different lengths
+VOCAB = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "(", ")", ":", "=", "+", ",", ".", "[", "]",
+         "def", "return", "print", "for", "in", "range", "if", "else", "class", "import", "self",
+         "x", "y", "i", "n", "total", "0", "1", "2"]
+
+def tiny_model(vocab_dir: Path):
+    """Return a tokenizer and a randomly initialized one-layer BERT with the service's embedding size."""
+    vocab_file = vocab_dir / "vocab.txt"
+    vocab_file.write_text("\n".join(VOCAB))
+    tokenizer = BertTokenizer(str(vocab_file))
+    config = BertConfig(vocab_size=len(VOCAB), hidden_size=embedding_api.EMBEDDING_DIM, num_hidden_layers=1,
+                        num_attention_heads=12, intermediate_size=64)
+    return tokenizer, BertModel(config).eval()
+
+def snippet(lines: int) -> str:
+    """A python snippet of the given number of lines."""
+    return "\n".join(f"for i in range ( {lines} ) : print ( i + {lines % 3} )" for _ in range(lines))
@@ -0,0 +1,65 @@
+"""The binary embedding transport negotiated through the Accept header."""
+
+import asyncio
+import json
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+pytest.importorskip("torch")
+
+from embedding_api_helpers import embedding_api, snippet  # noqa: E402
+
+def decode(payload: bytes):
+    """Split a payload into its header fields, float32 matrix and JSON trailer."""
+    magic, dtype_code, rows, dim = embedding_api.EMBEDDING_HEADER.unpack_from(payload)
+    dtype = np.dtype("<f4" if dtype_code == 0 else "<f2")
+    end = embedding_api.EMBEDDING_HEADER.size + rows * dim * dtype.itemsize
+    matrix = np.frombuffer(payload[embedding_api.EMBEDDING_HEADER.size:end], dtype=dtype).reshape(rows, dim)
+    trailer = json.loads(payload[end:]) if payload[end:] else None
+    return magic, matrix.astype("float32"), trailer
+
+@pytest.mark.parametrize("accept, dtype", [
+    (None, None),
+    ("application/json", None),
+    ("application/x-embeddings", "float32"),
+    ("application/x-embeddings; dtype=float16, application/json;q=0.5", "float16"),
+    ("application/json, application/x-embeddings;dtype=float16", "float16"),
+])
+def test_negotiation(accept, dtype):
+    assert embedding_api.negotiate_binary_dtype(accept) == dtype
+
+def test_unsupported_dtype_is_refused():
+    with pytest.raises(HTTPException) as error:
+        embedding_api.negotiate_binary_dtype("application/x-embeddings; dtype=int8")
+    assert error.value.status_code == 406
+
+def embed_batch(service, code_snippets, accept=None, **fields):
+    request = service.BatchEmbeddingRequest(code_snippets=code_snippets, **fields)
+    return asyncio.run(service.embed_batch(request, accept=accept))
+
+def test_binary_rows_match_the_json_embeddings_in_key_order(service):
+    code_snippets = {"b.py": snippet(3), "a.py": snippet(1), "c.py": snippet(2)}
+    embeddings = embed_batch(service, code_snippets)["embeddings"]
+
+    response = embed_batch(service, code_snippets, accept="application/x-embeddings; dtype=float32")
+    assert response.media_type == "application/x-embeddings; dtype=float32"
+    magic, matrix, trailer = decode(response.body)
+    assert magic == b"EMB1" and trailer is None
+    np.testing.assert_array_equal(matrix, np.array([embeddings[key] for key in code_snippets], dtype="float32"))
+
+    _, half, _ = decode(embed_batch(service, code_snippets, accept="application/x-embeddings; dtype=float16").body)
+    np.testing.assert_allclose(half, matrix, rtol=1e-3, atol=1e-3)
+
+def test_binary_chunks_carry_their_spans_in_the_trailer(service, monkeypatch):
+    monkeypatch.setattr(service, "MAX_LENGTH", 32)
+    monkeypatch.setattr(service, "CHUNK_OVERLAP_TOKENS", 8)
+    code_snippets = {"long.py": snippet(6), "short.py": snippet(1)}
+    chunks = embed_batch(service, code_snippets, mode="chunks")["chunks"]
+
+    _, matrix, trailer = decode(embed_batch(service, code_snippets, accept="application/x-embeddings", mode="chunks").body)
+    expected = [(i, chunk) for i, key in enumerate(code_snippets) for chunk in chunks[key]]
+    assert len(chunks["long.py"]) > 1
+    assert trailer["spans"] == [[i, chunk["start_line"], chunk["end_line"], chunk["n_tokens"]] for i, chunk in expected]
+    np.testing.assert_array_equal(matrix, np.array([chunk["embedding"] for _, chunk in expected], dtype="float32"))
@@ -0,0 +1,90 @@
+"""The content-addressed embedding cache: keys, stored copies, eviction and the disk tier."""
+
+import asyncio
+import threading
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from embedding_api_helpers import embedding_api, snippet  # noqa: E402
+
+CODE = "def f(x):\n    return x + 1\n"
+
+def test_keys_ignore_line_endings_and_trailing_whitespace():
+    cache = embedding_api.EmbeddingCache(10)
+    assert cache.key(CODE) == cache.key(CODE.replace("\n", "\r\n")) == cache.key("def f(x):   \n    return x + 1\n")
+    # Leading blank lines shift the line ranges stored with chunk embeddings
+    assert cache.key("\n" + CODE) != cache.key(CODE)
+    assert cache.key(CODE, "chunks", "128", "vectors") != cache.key(CODE, "chunks", "64", "vectors")
+
+def test_keys_change_with_the_model_settings(monkeypatch):
+    cache = embedding_api.EmbeddingCache(10)
+    key = cache.key(CODE)
+    monkeypatch.setattr(embedding_api, "EMBEDDING_BACKEND", "onnx-int8")
+    assert cache.key(CODE) != key
+    monkeypatch.undo()
+    monkeypatch.setattr(embedding_api, "MAX_LENGTH", 256)
+    assert cache.key(CODE) != key
+
+def test_entries_are_copies_and_evicted_least_recently_used(service):
+    async def run():
+        cache = embedding_api.EmbeddingCache(2)
+        batch = np.arange(3 * 4, dtype="float32").reshape(3, 4)
+        for i in range(2):
+            await cache.put(f"k{i}", batch[i])
+        assert cache.entries["k0"].base is None  # Not a view keeping the batch alive
+        batch[0] = -1
+        np.testing.assert_array_equal(await cache.get("k0"), [0, 1, 2, 3])
+
+        # k0 was used last, so k1 is evicted
+        await cache.put("k2", batch[2])
+        assert await cache.get("k1") is None
+        assert await cache.get("k0") is not None
+        assert cache.metrics()["memory_entries"] == 2
+
+    asyncio.run(run())
+
+def test_disk_entries_survive_a_restart_and_are_read_off_the_event_loop(service, tmp_path, monkeypatch):
+    load_threads = []
+    load = np.load
+
+    def recording_load(*args, **kwargs):
+        load_threads.append(threading.current_thread())
+        return load(*args, **kwargs)
+
+    async def run():
+        await embedding_api.EmbeddingCache(10, str(tmp_path / "cache")).put("key", np.ones(4, dtype="float32"))
+        restarted = embedding_api.EmbeddingCache(10, str(tmp_path / "cache"))
+        monkeypatch.setattr(embedding_api.np, "load", recording_load)
+        np.testing.assert_array_equal(await restarted.get("key"), np.ones(4))
+        assert restarted.metrics()["disk_hits"] == 1
+        assert await restarted.get("key") is not None
+        assert restarted.metrics()["memory_hits"] == 1
+
+    asyncio.run(run())
+    assert len(load_threads) == 1
+    assert load_threads[0] is not threading.main_thread()
+
+def test_embed_batch_only_runs_the_model_on_misses(service, monkeypatch):
+    generate = service.generate_batch_embeddings
+    misses = []
+
+    def recording_generate(code_snippets):
+        misses.append(sorted(code_snippets))
+        return generate(code_snippets)
+
+    monkeypatch.setattr(service, "generate_batch_embeddings", recording_generate)
+
+    def embed_batch(code_snippets, normalize=False):
+        request = service.BatchEmbeddingRequest(code_snippets=code_snippets, normalize=normalize)
+        return asyncio.run(service.embed_batch(request, accept=None))["embeddings"]
+
+    first = embed_batch({"a.py": snippet(1), "b.py": snippet(2)})
+    # The same code under another name, with Windows line endings
+    second = embed_batch({"c.py": snippet(2).replace("\n", "\r\n"), "d.py": snippet(3)}, normalize=True)
+    assert misses == [["a.py", "b.py"], ["d.py"]]
+    np.testing.assert_allclose(second["c.py"], embedding_api.l2_normalize(np.array(first["b.py"])), atol=1e-6)
+    # Normalization is applied per response, never stored
+    assert embed_batch({"b.py": snippet(2)})["b.py"] == first["b.py"]
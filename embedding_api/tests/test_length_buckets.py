@@ -0,0 +1,34 @@
+"""Length-bucketed sub-batches for /embed_batch."""
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from embedding_api_helpers import embedding_api, snippet  # noqa: E402
+
+def test_buckets_respect_the_token_budget_and_row_limit(monkeypatch):
+    monkeypatch.setattr(embedding_api, "EMBED_BATCH_TOKEN_BUDGET", 100)
+    monkeypatch.setattr(embedding_api, "EMBED_BATCH_MAX_SIZE", 3)
+    lengths = [50, 5, 10, 5, 90, 12, 5]
+    buckets = embedding_api.plan_length_buckets(lengths)
+    assert sorted(i for bucket in buckets for i in bucket) == list(range(len(lengths)))
+    for bucket in buckets:
+        assert len(bucket) <= 3
+        assert len(bucket) == 1 or len(bucket) * max(lengths[i] for i in bucket) <= 100
+    # Similar lengths end up together: the three shortest rows fill the first bucket
+    assert sorted(buckets[0]) == [1, 3, 6]
+
+def test_a_row_longer_than_the_budget_gets_its_own_bucket(monkeypatch):
+    monkeypatch.setattr(embedding_api, "EMBED_BATCH_TOKEN_BUDGET", 100)
+    assert embedding_api.plan_length_buckets([10, 512, 10]) == [[0, 2], [1]]
+
+def test_bucketed_embeddings_match_one_padded_batch_in_input_order(service, monkeypatch):
+    monkeypatch.setattr(service, "EMBED_BATCH_TOKEN_BUDGET", 64)
+    monkeypatch.setattr(service, "EMBED_BATCH_MAX_SIZE", 2)
+    codes = {f"student{i}.py": snippet(lines) for i, lines in enumerate([6, 1, 3, 1, 8, 2])}
+    batched = service.generate_batch_embeddings(codes)
+    assert list(batched) == list(codes)
+    expected = service.embed_texts(list(codes.values()))
+    for i, embedding in enumerate(batched.values()):
+        np.testing.assert_allclose(embedding, expected[i], atol=1e-4)
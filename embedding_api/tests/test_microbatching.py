@@ -0,0 +1,54 @@
+"""Micro-batching of concurrent /embed requests."""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+pytest.importorskip("torch")
+
+from embedding_api_helpers import snippet  # noqa: E402
+
+@pytest.fixture
+def batcher(service, monkeypatch):
+    monkeypatch.setattr(service, "MICROBATCH_MAX_SIZE", 4)
+    monkeypatch.setattr(service, "MICROBATCH_MAX_WAIT_MS", 50)
+    return service
+
+def embed_concurrently(service, codes):
+    """Start the micro-batcher, embed codes as concurrent single requests and stop it again."""
+    async def run():
+        await service.startup_microbatcher()
+        try:
+            return await asyncio.gather(*(service.enqueue_single_embedding(code) for code in codes),
+                                        return_exceptions=True)
+        finally:
+            service.batcher_task.cancel()
+
+    return asyncio.run(run())
+
+def test_concurrent_requests_share_forward_passes(batcher):
+    codes = [snippet(lines) for lines in range(1, 11)]
+    embeddings = embed_concurrently(batcher, codes)
+    assert batcher.batch_stats["requests"] == 10
+    assert batcher.batch_stats["batches"] == 3  # 4 + 4 + 2
+    assert batcher.batch_stats["max_batch_size"] == 4
+    # Every caller gets the embedding of its own snippet, unaffected by the padding of its batch
+    for code, embedding in zip(codes, embeddings):
+        np.testing.assert_allclose(embedding, batcher.embed_texts([code])[0], atol=1e-4)
+
+def test_a_failed_batch_fails_its_callers_and_frees_the_slot(batcher, monkeypatch):
+    embed_texts = batcher.embed_texts
+    calls = []
+
+    def fail_first_batch(texts):
+        calls.append(len(texts))
+        if len(calls) == 1:
+            raise RuntimeError("out of memory")
+        return embed_texts(texts)
+
+    monkeypatch.setattr(batcher, "embed_texts", fail_first_batch)
+    results = embed_concurrently(batcher, [snippet(lines) for lines in range(1, 7)])
+    assert calls == [4, 2]
+    assert all(isinstance(result, RuntimeError) for result in results[:4])
+    assert all(isinstance(result, np.ndarray) for result in results[4:])
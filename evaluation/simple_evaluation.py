@@ -6,7 +6,8 @@ This script:
 1. Reads files from 'original' and 'plagiarized' directories in the current folder
 2. Sends each file to the plagiarism detection service
 3. Creates a pandas DataFrame with the results
-4. Prints a summary of the findings
+4. Prints a summary of the findings, with the accuracy per decision path
+   (similarity bands or LLM) and a sweep of candidate LLM bypass thresholds
 """
 
 import os
@@ -22,6 +23,9 @@ CHECK_URL = f"{ORCHESTRATOR_URL}/check"
 PLAGIARIZED_DIR = "plagiarized"
 ORIGINAL_DIR = "original"
 
+# Quantiles of the best similarity scores tried as LLM_BYPASS_HIGH / LLM_BYPASS_LOW
+THRESHOLD_QUANTILES = [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9]
+
 def read_file_content(file_path):
     """Read content from a file."""
     with open(file_path, 'r', encoding='utf-8') as f:
@@ -82,7 +86,9 @@ def main():
                 "expected_result": "Yes",
                 "similar_files": similar_files,
                 "result": "Yes" if api_result["plagiarism"] else "No",
-                "llm_response": api_result.get("llm_response", "")
+                "llm_response": api_result.get("llm_response", ""),
+                "decided_by": api_result.get("decided_by", "llm"),
+                "top_similarity": max((sf[1] for sf in similar_files), default=None)
             })
     
     # Process original files
@@ -101,7 +107,9 @@ def main():
                 "expected_result": "No",
                 "similar_files": similar_files,
                 "result": "Yes" if api_result["plagiarism"] else "No",
-                "llm_response": api_result.get("llm_response", "")
+                "llm_response": api_result.get("llm_response", ""),
+                "decided_by": api_result.get("decided_by", "llm"),
+                "top_similarity": max((sf[1] for sf in similar_files), default=None)
             })
     
     # Create DataFrame
@@ -128,11 +136,29 @@ def main():
     print(f"False positives: {false_positives}")
     print(f"False negatives: {false_negatives}")
     
+    # Accuracy per decision path, to check the LLM bypass bands against the LLM
+    print("\n===== DECISIONS =====")
+    for decided_by, group in df.groupby("decided_by"):
+        group_correct = (group["expected_result"] == group["result"]).sum()
+        print(f"{decided_by:<18} {len(group):>4} files ({len(group) / total:.1%}), accuracy {group_correct / len(group):.1%}")
+    
+    # Candidate thresholds: how pure each side of a best-similarity cutoff is
+    scored = df.dropna(subset=["top_similarity"])
+    if not scored.empty:
+        print("\n===== BYPASS THRESHOLD SWEEP =====")
+        print(f"{'threshold':>10} {'>= (high band)':>16} {'plagiarized':>12} {'< (low band)':>14} {'original':>10}")
+        for threshold in sorted(set(scored["top_similarity"].quantile(THRESHOLD_QUANTILES))):
+            high = scored[scored["top_similarity"] >= threshold]
+            low = scored[scored["top_similarity"] < threshold]
+            high_precision = (high["expected_result"] == "Yes").mean() if len(high) else 0.0
+            low_precision = (low["expected_result"] == "No").mean() if len(low) else 0.0
+            print(f"{threshold:>10.3f} {len(high):>16} {high_precision:>12.1%} {len(low):>14} {low_precision:>10.1%}")
+    
     # Show results for each file
     print("\n===== DETAILED RESULTS =====")
     for _, row in df.iterrows():
         print(f"File: {row['file']}")
-        print(f"  Expected: {row['expected_result']}, Result: {row['result']}")
+        print(f"  Expected: {row['expected_result']}, Result: {row['result']} (decided by {row['decided_by']})")
         print(f"  LLM Response: {row['llm_response']}")
         print("  Similar files:")
         for sf in row['similar_files']:
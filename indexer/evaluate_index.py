@@ -0,0 +1,163 @@
+'''
+This script compares approximate FAISS index types against the exact flat index.
+It builds each index type over the saved embeddings, queries it with a sample
+of the indexed vectors and reports recall@k and query latency for a sweep of
+query-time settings (nprobe for IVF indexes, efSearch for HNSW), with and
+without search_api's exact re-ranking of the top k * r candidates.
+
+Usage (inside the indexer container, after generate_embeddings.py):
+    python evaluate_index.py --queries 200 --k 10
+    python evaluate_index.py --dir /app/shared/embeddings/shards/java
+'''
+
+import argparse
+import json
+import time
+import faiss
+import numpy as np
+from pathlib import Path
+
+from generate_embeddings import create_faiss_index, INDEX_TYPES
+
+EMBEDDINGS_DIR = Path("/app/shared/embeddings")
+NPROBE_SWEEP = [1, 4, 16, 64]
+EF_SEARCH_SWEEP = [16, 32, 64, 128]
+RERANK_SWEEP = [2, 4, 8]
+
+def search_timed(index, queries: np.ndarray, k: int, params=None):
+    """Search one query at a time and return the results and mean latency in ms."""
+    indices = np.zeros((len(queries), k), dtype="int64")
+    start = time.perf_counter()
+    for i in range(len(queries)):
+        _, indices[i] = index.search(queries[i:i + 1], k, params=params)
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    return indices, latency_ms
+
+def rerank_timed(embeddings: np.ndarray, queries: np.ndarray, candidates: np.ndarray, k: int, metric: str):
+    """Re-rank candidate ids exactly against the original vectors, like search_api does.
+    
+    Returns the re-ranked top-k ids and the mean re-ranking time in ms.
+    """
+    indices = np.zeros((len(queries), k), dtype="int64")
+    start = time.perf_counter()
+    for i in range(len(queries)):
+        ids = candidates[i][candidates[i] >= 0]
+        vectors = embeddings[ids]
+        if metric == "cosine":
+            order = np.argsort(-(vectors @ queries[i]), kind="stable")
+        else:
+            order = np.argsort(np.sum((vectors - queries[i]) ** 2, axis=1), kind="stable")
+        top = ids[order[:k]]
+        indices[i] = np.pad(top, (0, k - len(top)), constant_values=-1)
+    latency_ms = (time.perf_counter() - start) * 1000 / len(queries)
+    return indices, latency_ms
+
+def recall_at_k(exact: np.ndarray, approximate: np.ndarray) -> float:
+    """Fraction of the exact top-k neighbours found by the approximate search."""
+    hits = sum(len(set(e) & set(a)) for e, a in zip(exact, approximate))
+    return hits / exact.size
+
+def query_settings(index_type: str, index_params):
+    """Return (label, SearchParameters) pairs to sweep for an index type."""
+    if index_type in ("ivf-flat", "ivf-pq"):
+        return [
+            (f"nprobe={nprobe}", faiss.SearchParametersIVF(nprobe=nprobe))
+            for nprobe in NPROBE_SWEEP if nprobe <= index_params["nlist"]
+        ]
+    if index_type == "hnsw":
+        return [(f"efSearch={ef}", faiss.SearchParametersHNSW(efSearch=ef)) for ef in EF_SEARCH_SWEEP]
+    return [("exact", None)]
+
+def main():
+    """Main function."""
+    parser = argparse.ArgumentParser(description="Recall vs latency report for FAISS index types")
+    parser.add_argument("--queries", type=int, default=200, help="Number of indexed vectors used as queries")
+    parser.add_argument("--k", type=int, default=10, help="Neighbours per query")
+    parser.add_argument("--types", nargs="+", default=list(INDEX_TYPES), choices=INDEX_TYPES)
+    parser.add_argument("--rerank", nargs="*", type=int, default=RERANK_SWEEP, help="Re-rank factors r to evaluate")
+    parser.add_argument("--dir", type=Path, default=EMBEDDINGS_DIR, help="Index directory, e.g. a language shard")
+    args = parser.parse_args()
+
+    embeddings = np.load(args.dir / "embeddings.npy").astype("float32")
+    # Evaluate with the metric the saved index was built with, not this process's METRIC;
+    # indexes saved without one (or without index_params.json) are L2, as search_api assumes
+    index_params = {}
+    params_path = args.dir / "index_params.json"
+    if params_path.exists():
+        with open(params_path, 'r', encoding='utf-8') as f:
+            index_params = json.load(f)
+    metric = index_params.get("metric", "l2")
+    k = min(args.k, len(embeddings))
+    rng = np.random.default_rng(0)
+    queries = embeddings[rng.choice(len(embeddings), min(args.queries, len(embeddings)), replace=False)]
+    # Perturb the queries slightly so they are not exact copies of indexed vectors
+    queries = queries + rng.normal(scale=0.01 * float(np.std(embeddings)), size=queries.shape).astype("float32")
+    if metric == "cosine":
+        # Indexed vectors are unit length; keep the queries on the unit sphere too
+        faiss.normalize_L2(queries)
+
+    exact_index, _ = create_faiss_index(embeddings, "flat", metric)
+    exact, exact_latency = search_timed(exact_index, queries, k)
+
+    rows = []
+    built = set()
+    for index_type in args.types:
+        start = time.perf_counter()
+        index, index_params = create_faiss_index(embeddings, index_type, metric)
+        build_seconds = time.perf_counter() - start
+
+        # Small corpora fall back to simpler index types; skip repeats
+        if index_params["factory"] in built:
+            continue
+        built.add(index_params["factory"])
+
+        for label, params in query_settings(index_params["index_type"], index_params):
+            approximate, latency = search_timed(index, queries, k, params)
+            recall = recall_at_k(exact, approximate)
+            rows.append({
+                "index_type": index_params["index_type"],
+                "factory": index_params["factory"],
+                "setting": label,
+                "recall": recall,
+                "latency_ms": latency,
+                "speedup": exact_latency / latency if latency else 0.0,
+                "build_seconds": build_seconds
+            })
+            if index_params["index_type"] == "flat":
+                continue
+            
+            # Exact re-ranking of the top k * r candidates; latency includes the larger candidate fetch
+            for factor in args.rerank:
+                candidates, fetch_latency = search_timed(index, queries, k * factor, params)
+                reranked, rerank_latency = rerank_timed(embeddings, queries, candidates, k, index_params["metric"])
+                total_latency = fetch_latency + rerank_latency
+                reranked_recall = recall_at_k(exact, reranked)
+                rows.append({
+                    "index_type": index_params["index_type"],
+                    "factory": index_params["factory"],
+                    "setting": f"{label} r={factor}",
+                    "recall": reranked_recall,
+                    "latency_ms": total_latency,
+                    "speedup": exact_latency / total_latency if total_latency else 0.0,
+                    "build_seconds": build_seconds,
+                    "rerank_factor": factor,
+                    "recall_gain": reranked_recall - recall,
+                    "rerank_latency_ms": total_latency - latency
+                })
+
+    print("=" * 80)
+    print(f"Recall@{k} vs latency over {len(embeddings)} vectors ({len(queries)} queries)")
+    print("=" * 80)
+    print(f"{'factory':<22}{'setting':<18}{'recall':>8}{'gain':>8}{'ms/query':>10}{'+ms':>8}{'speedup':>9}{'build s':>9}")
+    for row in rows:
+        gain = f"{row['recall_gain']:>+8.3f}" if "recall_gain" in row else f"{'':>8}"
+        extra = f"{row['rerank_latency_ms']:>+8.3f}" if "rerank_latency_ms" in row else f"{'':>8}"
+        print(f"{row['factory']:<22}{row['setting']:<18}{row['recall']:>8.3f}{gain}{row['latency_ms']:>10.3f}{extra}{row['speedup']:>9.2f}{row['build_seconds']:>9.2f}")
+
+    report_path = args.dir / "index_report.json"
+    with open(report_path, 'w', encoding='utf-8') as f:
+        json.dump({"k": k, "queries": len(queries), "vectors": len(embeddings), "results": rows}, f, indent=2)
+    print(f"Report saved to {report_path}")
+
+if __name__ == "__main__":
+    main()
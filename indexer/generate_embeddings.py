@@ -5,20 +5,86 @@ Now uses the embedding_api service instead of loading the model directly.
 '''
 
 import os
+import re
 import glob
+import shutil
 import faiss
 import numpy as np
 import json
+import struct
 import requests
+from datetime import datetime, timezone
 from pathlib import Path
 from tqdm import tqdm
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple
 
 # Constants
 EMBEDDING_DIM = 768  # Dimension of the snowflake-arctic-embed-m embeddings
 BATCH_SIZE = 8  # Adjust based on your available RAM
 EMBEDDING_API_URL = "http://embedding_api:8002/embed_batch"  # URL of the embedding API
 
+# Binary embedding transport (see embedding_api): 16-byte header followed by the matrix
+EMBEDDING_MEDIA_TYPE = "application/x-embeddings"
+EMBEDDING_MAGIC = b"EMB1"
+EMBEDDING_HEADER = struct.Struct("<4sBxxxII")
+EMBEDDING_DTYPE_CODES = {0: "<f4", 1: "<f2"}
+EMBEDDING_TRANSPORT_DTYPE = os.getenv("EMBEDDING_TRANSPORT_DTYPE", "float32")  # float32 or float16
+
+# Chunk-level indexing: index one vector per overlapping token window instead of
+# one per file, with a chunk -> (file, line range) mapping saved in chunks.json.
+# Opt-in: it changes the ranking and the score scale of /search
+CHUNKED_INDEX = os.getenv("CHUNKED_INDEX", "false").lower() == "true"
+
+# Similarity metric: "cosine" indexes L2-normalized vectors with inner product,
+# "l2" (default) indexes raw vectors with Euclidean distance
+METRICS = ("cosine", "l2")
+METRIC = os.getenv("METRIC", "l2")
+
+# FAISS index type: "flat" (exact), "ivf-flat", "hnsw" or "ivf-pq"
+INDEX_TYPES = ("flat", "ivf-flat", "hnsw", "ivf-pq")
+INDEX_TYPE = os.getenv("INDEX_TYPE", "flat")
+IVF_NLIST = int(os.getenv("IVF_NLIST", "0"))  # Number of IVF lists; 0 picks 4 * sqrt(n)
+PQ_M = int(os.getenv("PQ_M", "64"))  # PQ sub-quantizers; must divide EMBEDDING_DIM
+PQ_NBITS = int(os.getenv("PQ_NBITS", "8"))  # Bits per PQ sub-quantizer code
+HNSW_M = int(os.getenv("HNSW_M", "32"))  # HNSW graph degree
+HNSW_EF_CONSTRUCTION = int(os.getenv("HNSW_EF_CONSTRUCTION", "200"))
+TRAIN_SAMPLE_SIZE = int(os.getenv("TRAIN_SAMPLE_SIZE", "100000"))  # Vectors sampled to train IVF/PQ
+DEFAULT_NPROBE = int(os.getenv("DEFAULT_NPROBE", "16"))  # Query-time defaults saved with the index
+DEFAULT_EF_SEARCH = int(os.getenv("DEFAULT_EF_SEARCH", "64"))
+
+# Build one index per language under embeddings/shards, so search_api only searches
+# the shard of a query's language; false (default) writes a single index over all files
+SHARD_BY_LANGUAGE = os.getenv("SHARD_BY_LANGUAGE", "false").lower() == "true"
+
+# Language detection rules. They are saved in the shard manifest, where search_api
+# reads them to route queries, so files and queries are assigned languages alike.
+# File extensions mapped to their language shard
+LANGUAGE_EXTENSIONS = {
+    ".py": "python",
+    ".java": "java",
+    ".c": "cpp", ".cc": "cpp", ".cpp": "cpp", ".h": "cpp",
+    ".js": "javascript",
+    ".xml": "xml",
+    ".html": "html",
+}
+
+# Markers that settle the language of other files outright, checked in order; HTML
+# first, since XHTML pages also carry an XML prolog
+LANGUAGE_MARKERS = [
+    ("html", r"(?i)<!DOCTYPE html\b|<html[\s>]"),
+    ("xml", r"<\?xml\b"),
+]
+
+# Content patterns scored for files without an extension or marker
+LANGUAGE_PATTERNS = {
+    "python": [r"^\s*def \w+\(.*\)\s*(->.*)?:\s*$", r"^\s*class \w+(\(.*\))?:\s*$", r"\bself\.", r"^\s*(elif|except|with) .*:\s*$", r"\bprint\("],
+    "java": [r"\b(public|private|protected)( static| final| abstract)* (class|interface|enum|void) ", r"\bSystem\.out\.", r"^\s*package [\w.]+;", r"\b(String|int|boolean)\[\] \w+", r"@Override\b"],
+    "cpp": [r"^\s*#\s*(include|define|ifndef|ifdef|endif|pragma)\b", r"\bstd::", r"\w+->\w+", r"\b(cout|cin|printf|malloc|sizeof)\b", r"\b(unsigned|struct|template|typedef) "],
+    "javascript": [r"\bfunction\b\s*\w*\s*\(", r"\b(const|let|var) \w+\s*=", r"=>", r"\bconsole\.\w+\(", r"\brequire\(", r"\bdocument\."],
+    "html": [r"<!DOCTYPE html", r"<(html|head|body|div|span|script|style|table|form|a|p)[\s>]"],
+    "xml": [r"<\w+:\w+(\s+[\w:.-]+=\"[^\"]*\")+\s*/?>", r"</\w+:\w+>", r"\bxmlns(:\w+)?=\""],
+}
+
 def get_root_dir():
     """Get the root directory of the project."""
     return Path("/app")
@@ -43,6 +109,23 @@ def check_embedding_api():
         print(f"ERROR: Could not connect to embedding API: {str(e)}")
         return False
 
+def decode_embeddings(payload: bytes) -> np.ndarray:
+    """Unpack a binary embeddings payload into a float32 (rows, dim) matrix."""
+    magic, dtype_code, rows, dim = EMBEDDING_HEADER.unpack_from(payload)
+    if magic != EMBEDDING_MAGIC or dtype_code not in EMBEDDING_DTYPE_CODES:
+        raise Exception("Unexpected binary embedding payload")
+    matrix = np.frombuffer(
+        payload, dtype=EMBEDDING_DTYPE_CODES[dtype_code], count=rows * dim, offset=EMBEDDING_HEADER.size
+    )
+    return matrix.reshape(rows, dim).astype("float32")
+
+def decode_embedding_metadata(payload: bytes) -> Dict[str, Any]:
+    """Return the JSON trailer of a binary embeddings payload, or {} if there is none."""
+    magic, dtype_code, rows, dim = EMBEDDING_HEADER.unpack_from(payload)
+    itemsize = np.dtype(EMBEDDING_DTYPE_CODES[dtype_code]).itemsize
+    trailer = payload[EMBEDDING_HEADER.size + rows * dim * itemsize:]
+    return json.loads(trailer) if trailer else {}
+
 def read_code_files(processed_codefiles_dir: Path) -> Dict[str, str]:
     """Read all processed code files."""
     print("Reading code files...")
@@ -92,7 +175,8 @@ def generate_embeddings_batch(code_files: Dict[str, str]):
         try:
             response = requests.post(
                 EMBEDDING_API_URL,
-                json={"code_snippets": batch_code_files},
+                json={"code_snippets": batch_code_files, "normalize": METRIC == "cosine"},
+                headers={"Accept": f"{EMBEDDING_MEDIA_TYPE}; dtype={EMBEDDING_TRANSPORT_DTYPE}, application/json;q=0.5"},
                 timeout=120  # Longer timeout for batch processing
             )
             
@@ -100,19 +184,23 @@ def generate_embeddings_batch(code_files: Dict[str, str]):
                 print(f"Error from embedding API: {response.text}")
                 raise Exception(f"Embedding API returned status code {response.status_code}")
             
-            # Extract embeddings from response
-            embedding_data = response.json()
-            batch_embeddings = []
-            
-            # Ensure we maintain the same order as file_paths
-            for file_path in batch_files:
-                if file_path in embedding_data["embeddings"]:
-                    embedding = np.array(embedding_data["embeddings"][file_path], dtype="float32")
-                    batch_embeddings.append(embedding)
-                else:
-                    print(f"WARNING: No embedding returned for {file_path}")
-                    # Create a zero embedding as fallback
-                    batch_embeddings.append(np.zeros(EMBEDDING_DIM, dtype="float32"))
+            # Binary rows follow the order of batch_code_files
+            if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+                batch_embeddings = list(decode_embeddings(response.content))
+            else:
+                # Extract embeddings from response
+                embedding_data = response.json()
+                batch_embeddings = []
+                
+                # Ensure we maintain the same order as file_paths
+                for file_path in batch_files:
+                    if file_path in embedding_data["embeddings"]:
+                        embedding = np.array(embedding_data["embeddings"][file_path], dtype="float32")
+                        batch_embeddings.append(embedding)
+                    else:
+                        print(f"WARNING: No embedding returned for {file_path}")
+                        # Create a zero embedding as fallback
+                        batch_embeddings.append(np.zeros(EMBEDDING_DIM, dtype="float32"))
             
             print(f"Batch {i//BATCH_SIZE + 1} complete: {len(batch_embeddings)} embeddings generated")
             embeddings_list.extend(batch_embeddings)
@@ -129,41 +217,268 @@ def generate_embeddings_batch(code_files: Dict[str, str]):
     
     return file_paths, embeddings_array
 
-def create_faiss_index(embeddings: np.ndarray):
-    """Create a FAISS index for the embeddings."""
-    print("Creating FAISS index...")
+def generate_chunk_embeddings_batch(code_files: Dict[str, str]):
+    """Generate sliding-window chunk embeddings for code files using the embedding API.
+    
+    Returns the file paths, the (n_chunks, dim) chunk embeddings and a chunk map
+    holding [file_index, start_line, end_line] for every chunk row.
+    """
+    print("Generating chunk embeddings via the embedding API...")
+    
+    file_paths = list(code_files.keys())
+    embeddings_list = []
+    chunk_map = []
+    
+    # Process in batches to avoid overwhelming the API
+    for i in tqdm(range(0, len(file_paths), BATCH_SIZE), desc="Generating embeddings"):
+        batch_files = file_paths[i:i + BATCH_SIZE]
+        batch_code_files = {file_path: code_files[file_path] for file_path in batch_files}
+        
+        print(f"\nProcessing batch {i//BATCH_SIZE + 1}/{(len(file_paths)-1)//BATCH_SIZE + 1}")
+        
+        try:
+            response = requests.post(
+                EMBEDDING_API_URL,
+                json={"code_snippets": batch_code_files, "mode": "chunks", "normalize": METRIC == "cosine"},
+                headers={"Accept": f"{EMBEDDING_MEDIA_TYPE}; dtype={EMBEDDING_TRANSPORT_DTYPE}, application/json;q=0.5"},
+                timeout=120  # Longer timeout for batch processing
+            )
+            
+            if response.status_code != 200:
+                print(f"Error from embedding API: {response.text}")
+                raise Exception(f"Embedding API returned status code {response.status_code}")
+            
+            if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+                # Spans are [snippet_index, start_line, end_line, n_tokens] in batch order
+                batch_embeddings = list(decode_embeddings(response.content))
+                batch_chunk_map = [
+                    [i + snippet_index, start_line, end_line]
+                    for snippet_index, start_line, end_line, _ in decode_embedding_metadata(response.content)["spans"]
+                ]
+            else:
+                chunk_data = response.json()["chunks"]
+                batch_embeddings = []
+                batch_chunk_map = []
+                for j, file_path in enumerate(batch_files):
+                    for chunk in chunk_data.get(file_path, []):
+                        batch_embeddings.append(np.array(chunk["embedding"], dtype="float32"))
+                        batch_chunk_map.append([i + j, chunk["start_line"], chunk["end_line"]])
+            
+            print(f"Batch {i//BATCH_SIZE + 1} complete: {len(batch_embeddings)} chunk embeddings generated")
+            embeddings_list.extend(batch_embeddings)
+            chunk_map.extend(batch_chunk_map)
+            
+        except Exception as e:
+            # Files of a failed batch get no chunks and are never returned by searches
+            print(f"Error generating embeddings for batch: {str(e)}")
+    
+    embeddings_array = np.array(embeddings_list, dtype="float32").reshape(-1, EMBEDDING_DIM)
+    print(f"All chunk embeddings generated. Shape: {embeddings_array.shape}")
+    
+    return file_paths, embeddings_array, chunk_map
+
+def resolve_index_params(index_type: str, n_vectors: int, metric: Optional[str] = None) -> Dict[str, Any]:
+    """Work out the build parameters for an index type and corpus size.
+    
+    Falls back to an exact flat index when the corpus is too small to train
+    the requested index. The metric defaults to METRIC.
+    """
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+    
+    metric = metric or METRIC
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric '{metric}', expected one of {METRICS}")
+    
+    params = {"index_type": index_type, "dim": EMBEDDING_DIM, "metric": metric}
+    
+    if index_type in ("ivf-flat", "ivf-pq"):
+        nlist = IVF_NLIST or int(4 * np.sqrt(n_vectors))
+        # FAISS wants roughly 39 training points per list
+        nlist = max(1, min(nlist, n_vectors // 39))
+        if nlist < 2:
+            print(f"WARNING: {n_vectors} vectors are too few to train {index_type}, using a flat index")
+            return resolve_index_params("flat", n_vectors, metric)
+        params.update({"nlist": nlist, "nprobe": min(DEFAULT_NPROBE, nlist)})
+    
+    if index_type == "ivf-pq":
+        if EMBEDDING_DIM % PQ_M != 0:
+            raise ValueError(f"PQ_M={PQ_M} must divide the embedding dimension {EMBEDDING_DIM}")
+        if n_vectors < 2 ** PQ_NBITS:
+            print(f"WARNING: {n_vectors} vectors are too few to train {PQ_NBITS}-bit PQ, using ivf-flat")
+            return resolve_index_params("ivf-flat", n_vectors, metric)
+        params.update({"pq_m": PQ_M, "pq_nbits": PQ_NBITS})
+    
+    if index_type == "hnsw":
+        params.update({"hnsw_m": HNSW_M, "ef_construction": HNSW_EF_CONSTRUCTION, "ef_search": DEFAULT_EF_SEARCH})
+    
+    return params
+
+def index_factory_string(params: Dict[str, Any]) -> str:
+    """Return the faiss.index_factory description for a set of build parameters."""
+    index_type = params["index_type"]
+    if index_type == "ivf-flat":
+        return f"IVF{params['nlist']},Flat"
+    if index_type == "ivf-pq":
+        return f"IVF{params['nlist']},PQ{params['pq_m']}x{params['pq_nbits']}"
+    if index_type == "hnsw":
+        return f"HNSW{params['hnsw_m']}"
+    return "Flat"
+
+def create_faiss_index(embeddings: np.ndarray, index_type: str = INDEX_TYPE, metric: Optional[str] = None):
+    """Create a FAISS index for the embeddings.
+    
+    Returns the index and the build parameters to persist alongside it.
+    The metric defaults to METRIC.
+    """
+    print(f"Creating FAISS index ({index_type})...")
+    
+    params = resolve_index_params(index_type, len(embeddings), metric)
+    params["factory"] = index_factory_string(params)
     
-    # Create a CPU-friendly index
-    # L2 distance is commonly used for similarity search
-    index = faiss.IndexFlatL2(EMBEDDING_DIM)
+    # Inner product over normalized vectors is cosine similarity
+    metric = faiss.METRIC_INNER_PRODUCT if params["metric"] == "cosine" else faiss.METRIC_L2
+    index = faiss.index_factory(EMBEDDING_DIM, params["factory"], metric)
+    
+    if params["index_type"] == "hnsw":
+        index.hnsw.efConstruction = params["ef_construction"]
+    
+    # Train IVF/PQ quantizers on a random sample
+    if not index.is_trained:
+        sample_size = min(TRAIN_SAMPLE_SIZE, len(embeddings))
+        sample = embeddings[np.random.default_rng(0).choice(len(embeddings), sample_size, replace=False)]
+        print(f"Training {params['factory']} on {sample_size} vectors...")
+        index.train(sample)
+        params["train_size"] = sample_size
     
     # Add vectors to the index
     index.add(embeddings)
-    print(f"FAISS index created with {index.ntotal} vectors")
+    params["ntotal"] = index.ntotal
+    print(f"FAISS index created with {index.ntotal} vectors ({params['factory']})")
     
-    return index
+    return index, params
+
+def replace_file(path: Path, write):
+    """Write a file through a temporary sibling and rename it into place.
+    
+    search_api memory-maps the index files, so they are never rewritten in place:
+    the rename leaves mapped readers on the old file until they reload.
+    """
+    tmp_path = path.with_name(f".tmp-{path.name}")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_json(path: Path, data, indent=None):
+    """Atomically write data to path as JSON."""
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent)
+    replace_file(path, write)
 
-def save_data(embeddings_dir: Path, file_paths: List[str], embeddings: np.ndarray, index):
-    """Save the embeddings, file paths, and FAISS index to disk."""
+def save_data(embeddings_dir: Path, file_paths: List[str], embeddings: np.ndarray, index, chunk_map: List[List[int]] = None, index_params: Dict[str, Any] = None):
+    """Save the embeddings, file paths, chunk map, FAISS index and its build parameters to disk.
+    
+    Each file is replaced atomically and index_params.json, which carries the
+    index version, is written last; a running search_api picks the new version up
+    on its next reload.
+    """
     print("Saving data to disk...")
     
     # Save file paths as JSON
     file_paths_path = embeddings_dir / "file_paths.json"
-    with open(file_paths_path, 'w', encoding='utf-8') as f:
-        json.dump(file_paths, f, indent=2)
+    save_json(file_paths_path, file_paths, indent=2)
+    
+    # Save the chunk map; without it, index rows are whole files
+    chunks_path = embeddings_dir / "chunks.json"
+    if chunk_map is not None:
+        save_json(chunks_path, chunk_map)
+    elif chunks_path.exists():
+        chunks_path.unlink()
     
     # Save embeddings
     embeddings_path = embeddings_dir / "embeddings.npy"
-    np.save(embeddings_path, embeddings)
+    replace_file(embeddings_path, lambda tmp_path: np.save(tmp_path, embeddings))
     
     # Save FAISS index
     index_path = embeddings_dir / "faiss_index.bin"
-    faiss.write_index(index, str(index_path))
+    replace_file(index_path, lambda tmp_path: faiss.write_index(index, str(tmp_path)))
+    
+    # Save index build parameters and query-time defaults
+    index_params = dict(index_params or {"index_type": "flat", "factory": "Flat"})
+    index_params["version"] = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+    index_params_path = embeddings_dir / "index_params.json"
+    save_json(index_params_path, index_params, indent=2)
     
     print(f"Data saved to {embeddings_dir}")
     print(f"- File paths (JSON): {file_paths_path}")
+    if chunk_map is not None:
+        print(f"- Chunk map (JSON): {chunks_path}")
     print(f"- Embeddings: {embeddings_path}")
     print(f"- FAISS index: {index_path}")
+    print(f"- Index parameters: {index_params_path}")
+
+def detect_language(file_path: str, code: str) -> str:
+    """Return the language shard of a file, from its extension or else its content ("other" if unknown)."""
+    language = LANGUAGE_EXTENSIONS.get(os.path.splitext(file_path)[1].lower())
+    if language:
+        return language
+    for language, marker in LANGUAGE_MARKERS:
+        if re.search(marker, code, re.MULTILINE):
+            return language
+    scores = {
+        language: sum(len(re.findall(pattern, code, re.MULTILINE)) for pattern in patterns)
+        for language, patterns in LANGUAGE_PATTERNS.items()
+    }
+    language, score = max(scores.items(), key=lambda item: item[1])
+    return language if score > 0 else "other"
+
+def split_by_language(code_files: Dict[str, str], file_paths: List[str], embeddings: np.ndarray,
+                      chunk_map: List[List[int]] = None) -> Dict[str, Tuple[List[str], np.ndarray, List[List[int]]]]:
+    """Split the embeddings into per-language (file paths, embeddings, chunk map) shards.
+    
+    Chunk map file indexes are renumbered to the shard's own file paths.
+    """
+    languages = [detect_language(path, code_files[path]) for path in file_paths]
+    shards = {}
+    for language in sorted(set(languages)):
+        files = [i for i, file_language in enumerate(languages) if file_language == language]
+        shard_paths = [file_paths[i] for i in files]
+        if chunk_map is None:
+            shards[language] = (shard_paths, embeddings[files], None)
+            continue
+        renumber = {file_idx: i for i, file_idx in enumerate(files)}
+        rows = [row for row, (file_idx, _, _) in enumerate(chunk_map) if file_idx in renumber]
+        shard_chunks = [[renumber[chunk_map[row][0]], chunk_map[row][1], chunk_map[row][2]] for row in rows]
+        shards[language] = (shard_paths, embeddings[rows], shard_chunks)
+    return shards
+
+def save_shards(embeddings_dir: Path, shards: Dict[str, Tuple[List[str], np.ndarray, List[List[int]]]]):
+    """Build and save one FAISS index per language shard, then the shard manifest.
+    
+    Shards from a previous run for languages that no longer occur are removed
+    after the manifest stops listing them.
+    """
+    shards_dir = embeddings_dir / "shards"
+    shards_dir.mkdir(exist_ok=True, parents=True)
+    for language, (file_paths, embeddings, chunk_map) in shards.items():
+        print(f"Building shard {language}: {len(file_paths)} files, {len(embeddings)} vectors")
+        shard_dir = shards_dir / language
+        shard_dir.mkdir(exist_ok=True)
+        index, index_params = create_faiss_index(embeddings)
+        save_data(shard_dir, file_paths, embeddings, index, chunk_map, index_params)
+    
+    # search_api switches to the new shard set once the manifest lists it
+    manifest = {
+        "languages": sorted(shards),
+        "extensions": LANGUAGE_EXTENSIONS,
+        "markers": LANGUAGE_MARKERS,
+        "patterns": LANGUAGE_PATTERNS
+    }
+    save_json(shards_dir / "shards.json", manifest, indent=2)
+    for stale_dir in shards_dir.iterdir():
+        if stale_dir.is_dir() and stale_dir.name not in shards:
+            shutil.rmtree(stale_dir)
+            print(f"Removed stale shard {stale_dir.name}")
 
 def main():
     """Main function."""
@@ -198,13 +513,27 @@ def main():
     print(f"Processing {len(code_files)} code files...")
     
     # Generate embeddings using the embedding API
-    file_paths, embeddings = generate_embeddings_batch(code_files)
-    
-    # Create FAISS index
-    index = create_faiss_index(embeddings)
+    if CHUNKED_INDEX:
+        file_paths, embeddings, chunk_map = generate_chunk_embeddings_batch(code_files)
+    else:
+        file_paths, embeddings = generate_embeddings_batch(code_files)
+        chunk_map = None
     
-    # Save data
-    save_data(embeddings_dir, file_paths, embeddings, index)
+    if SHARD_BY_LANGUAGE:
+        # One FAISS index per language
+        save_shards(embeddings_dir, split_by_language(code_files, file_paths, embeddings, chunk_map))
+    else:
+        # Create FAISS index
+        index, index_params = create_faiss_index(embeddings)
+        
+        # Save data
+        save_data(embeddings_dir, file_paths, embeddings, index, chunk_map, index_params)
+        
+        # search_api serves the language shards while they exist
+        shards_dir = embeddings_dir / "shards"
+        if shards_dir.exists():
+            shutil.rmtree(shards_dir)
+            print(f"Removed language shards in {shards_dir}")
     
     print("=" * 80)
     print("Embedding generation and indexing complete!")
@@ -32,6 +32,7 @@ class SimilarFile(BaseModel):
     file_path: str
     similarity_score: float
     content: str = ""  # This will hold the actual code content
+    line_ranges: List[List[int]] = []  # If set, only these [start_line, end_line] ranges are sent to the LLM
 
 class PlagiarismCheckRequest(BaseModel):
     user_code: str
@@ -42,6 +43,9 @@ class PlagiarismCheckResponse(BaseModel):
     explanation: str = ""  # Optional explanation from the LLM
     llm_response: str = ""  # Raw LLM response for debugging
 
+# Lines of context kept around each matching line range
+EXCERPT_CONTEXT_LINES = int(os.getenv("EXCERPT_CONTEXT_LINES", "5"))
+
 # Configuration
 class LLMConfig:
     def __init__(self):
@@ -233,6 +237,25 @@ def get_file_content(file_path: str) -> str:
         print(f"❌ ERROR reading file {file_path}: {str(e)}")
         return f"[Error reading file {file_path}: {str(e)}]"
 
+def extract_line_ranges(content: str, line_ranges: List[List[int]]) -> str:
+    """Keep only the given 1-based line ranges (plus context) of a file, merging overlaps."""
+    lines = content.split('\n')
+    
+    # Widen each range by the context and merge overlapping ranges
+    merged = []
+    for start, end in sorted(line_ranges):
+        start = max(1, start - EXCERPT_CONTEXT_LINES)
+        end = min(len(lines), end + EXCERPT_CONTEXT_LINES)
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    
+    excerpts = []
+    for start, end in merged:
+        excerpts.append(f"// ... lines {start}-{end} ...\n" + '\n'.join(lines[start - 1:end]))
+    return '\n'.join(excerpts)
+
 # Endpoint to check for plagiarism
 @app.post("/check_plagiarism", response_model=PlagiarismCheckResponse)
 async def check_plagiarism(
@@ -267,7 +290,8 @@ async def check_plagiarism(
             similar_file = SimilarFile(
                 file_path=file.file_path,
                 similarity_score=file.similarity_score,
-                content=file.content
+                content=file.content,
+                line_ranges=file.line_ranges
             )
             
             # If content is empty, read it from the file
@@ -275,6 +299,10 @@ async def check_plagiarism(
                 print(f"Reading content for file: {file.file_path}")
                 similar_file.content = get_file_content(file.file_path)
             
+            # Only send the matching parts of the file if the search returned line ranges
+            if similar_file.line_ranges:
+                similar_file.content = extract_line_ranges(similar_file.content, similar_file.line_ranges)
+            
             similar_files_with_content.append(similar_file)
             
             print(f"Similar file {i+1}: {file.file_path} (Score: {file.similarity_score}, Content length: {len(similar_file.content)} chars)")
@@ -12,10 +12,24 @@ This service:
 
 import os
 import json
-import requests
+import time
+import uuid
+import sqlite3
+import zipfile
+import tarfile
+import tempfile
+import zlib
+import hashlib
+import asyncio
+import httpx
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import List, Dict, Any
-from fastapi import FastAPI, HTTPException, Body
+from urllib.parse import urlparse
+from typing import List, Dict, Any, Optional, Iterator, Tuple
+from fastapi import FastAPI, HTTPException, Body, Request
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
 
 # Initialize FastAPI app
@@ -27,23 +41,279 @@ app = FastAPI(
 
 # Configuration
 SEARCH_API_URL = "http://search_api:8003/search"
+SEARCH_API_BATCH_URL = "http://search_api:8003/search_batch"
+SEARCH_API_PAIRWISE_URL = "http://search_api:8003/pairwise"
 LLM_API_URL = "http://llm_service:8005/check_plagiarism"
+SEARCH_API_HEALTH_URL = "http://search_api:8003/health"
+LLM_API_HEALTH_URL = "http://llm_service:8005/health"
+
+# Upstream connection pool settings
+SEARCH_API_MAX_CONNECTIONS = int(os.getenv("SEARCH_API_MAX_CONNECTIONS", "32"))
+LLM_API_MAX_CONNECTIONS = int(os.getenv("LLM_API_MAX_CONNECTIONS", "16"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "16"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+SEARCH_API_TIMEOUT = 30
+
+# Search options forwarded to the search API. With a similarity cutoff, checks where
+# no reference file scores at least SEARCH_MIN_SIMILARITY are answered without the LLM.
+SEARCH_TOP_K = int(os.getenv("SEARCH_TOP_K", "0"))  # 0 uses the search API default
+SEARCH_MIN_SIMILARITY = float(os.getenv("SEARCH_MIN_SIMILARITY", "-1"))  # -1 disables the cutoff
+LLM_API_TIMEOUT = 60
+HEALTH_CHECK_TIMEOUT = 5
+
+# Verdict cache: /check results keyed by the hash of the processed code and the search
+# index version. Entries expire after VERDICT_CACHE_TTL seconds, the least recently used
+# ones are evicted beyond VERDICT_CACHE_SIZE entries, and the whole cache is dropped when
+# the index version changes. VERDICT_CACHE_SIZE=0 disables it.
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "10000"))
+VERDICT_CACHE_TTL = float(os.getenv("VERDICT_CACHE_TTL", "86400"))
+INDEX_VERSION_CHECK_INTERVAL = float(os.getenv("INDEX_VERSION_CHECK_INTERVAL", "10"))  # Seconds; 0 disables polling
+
+# Similarity bands for skipping the LLM, applied to the best similar file's similarity_score.
+# At or above LLM_BYPASS_HIGH a check is answered "plagiarized" if the deterministic verifier
+# confirms it; below LLM_BYPASS_LOW it is answered "original". Only the band in between goes
+# to the LLM. The defaults never bypass.
+LLM_BYPASS_HIGH = float(os.getenv("LLM_BYPASS_HIGH", "2"))
+LLM_BYPASS_LOW = float(os.getenv("LLM_BYPASS_LOW", "-2"))
+
+# High-band verifier: minimum fraction of the submission's normalized token n-grams found in the
+# best file (lexical_overlap from the search API's hybrid search, LEXICAL_SEARCH=true). When the search
+# API reports no overlap, the high band is decided by similarity alone.
+LLM_BYPASS_MIN_OVERLAP = float(os.getenv("LLM_BYPASS_MIN_OVERLAP", "0.5"))
+
+# Asynchronous jobs: POST /jobs stores a check in a SQLite database and returns at once,
+# JOB_WORKERS background workers run the queued checks, and GET /jobs/{id} returns the result.
+# Jobs survive restarts; checks interrupted by a restart are run again.
+JOBS_DB = Path(os.getenv("JOBS_DB", "/app/data/jobs.sqlite3"))
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_MAX = int(os.getenv("JOB_QUEUE_MAX", "10000"))  # Queued jobs beyond this are refused with 429
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))  # Runs per job before it is marked failed
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "5"))  # Seconds before a failed job runs again, doubled per failure
+JOB_RETRY_MAX_DELAY = float(os.getenv("JOB_RETRY_MAX_DELAY", "300"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", "604800"))  # Seconds finished jobs are kept
+# Callback URLs may only point at these hosts
+JOB_CALLBACK_HOSTS = {host.strip() for host in os.getenv("JOB_CALLBACK_HOSTS", "localhost,127.0.0.1").split(",") if host.strip()}
+JOB_CALLBACK_TIMEOUT = 10
+JOB_CALLBACK_ATTEMPTS = 3
+
+# Bulk checks: POST /check_archive reads a zip or tar of submissions entry by entry and sends them to the
+# search API's /search_batch BULK_BATCH_SIZE at a time (one code processor call, one embedding call and one
+# search per batch). Up to BULK_PIPELINE_DEPTH batches are searched while earlier ones are decided, with at
+# most BULK_LLM_CONCURRENCY LLM calls at a time.
+BULK_BATCH_SIZE = int(os.getenv("BULK_BATCH_SIZE", "64"))  # At most the search API's SEARCH_BATCH_MAX_SIZE
+BULK_PIPELINE_DEPTH = int(os.getenv("BULK_PIPELINE_DEPTH", "2"))
+BULK_LLM_CONCURRENCY = int(os.getenv("BULK_LLM_CONCURRENCY", "8"))
+BULK_MAX_ARCHIVE_BYTES = int(os.getenv("BULK_MAX_ARCHIVE_BYTES", str(200 * 1024 * 1024)))
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", "5000"))
+BULK_MAX_FILE_BYTES = int(os.getenv("BULK_MAX_FILE_BYTES", str(1024 * 1024)))
+BULK_EXTENSIONS = {ext.strip().lower() for ext in os.getenv("BULK_EXTENSIONS", ".py,.java,.c,.cc,.cpp,.h,.js").split(",") if ext.strip()}
+BULK_SPOOL_BYTES = 32 * 1024 * 1024  # Archives larger than this are spooled to a temporary file
+SEARCH_API_BATCH_TIMEOUT = 300
+
+# Collusion checks: POST /check_collusion compares the submissions of an archive with each other
+# through the search API's /pairwise and sends only the COLLUSION_LLM_PAIRS most similar pairs to the LLM
+COLLUSION_LLM_PAIRS = int(os.getenv("COLLUSION_LLM_PAIRS", "20"))
+
+# Long-lived async HTTP clients, created on startup and closed on shutdown
+search_client: httpx.AsyncClient = None
+llm_client: httpx.AsyncClient = None
+callback_client: httpx.AsyncClient = None
+
+class VerdictCache:
+    """LRU cache of /check verdicts with a TTL, valid for one search index version.
+    
+    Verdicts are stored under the hash of the processed code. The hash of the raw
+    submission is kept as an alias of it, so byte-identical resubmissions are answered
+    without calling any service; resubmissions that only differ in comments or
+    formatting hit after the search, before the LLM call.
+    """
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.index_version: Optional[str] = None
+        self.verdicts = OrderedDict()  # processed code hash -> (expiry time, verdict)
+        self.aliases = OrderedDict()  # raw code hash -> processed code hash
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+    
+    def set_index_version(self, version: Optional[str]):
+        """Record the current index version, dropping every entry if it changed."""
+        if version is None or version == self.index_version:
+            return
+        if self.index_version is not None:
+            print(f"Search index changed from {self.index_version} to {version}, clearing {len(self.verdicts)} cached verdicts")
+            self.stats["invalidations"] += 1
+        self.verdicts.clear()
+        self.aliases.clear()
+        self.index_version = version
+    
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached verdict for a processed code hash, or None."""
+        entry = self.verdicts.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.verdicts[key]
+            return None
+        self.verdicts.move_to_end(key)
+        return entry[1]
+    
+    def get_alias(self, raw_key: str) -> Optional[Dict[str, Any]]:
+        """Return the cached verdict for a raw submission hash, or None."""
+        key = self.aliases.get(raw_key)
+        if key is None:
+            return None
+        self.aliases.move_to_end(raw_key)
+        return self.get(key)
+    
+    def put(self, key: str, raw_key: str, verdict: Dict[str, Any], index_version: Optional[str]):
+        """Cache a verdict computed against index_version; ignored unless that is the current version."""
+        if self.max_size <= 0 or index_version is None or index_version != self.index_version:
+            return
+        self.verdicts[key] = (time.monotonic() + self.ttl, verdict)
+        self.verdicts.move_to_end(key)
+        self.add_alias(raw_key, key)
+        while len(self.verdicts) > self.max_size:
+            self.verdicts.popitem(last=False)
+            self.stats["evictions"] += 1
+    
+    def add_alias(self, raw_key: str, key: str):
+        """Point a raw submission hash at the verdict of its processed code."""
+        self.aliases[raw_key] = key
+        self.aliases.move_to_end(raw_key)
+        while len(self.aliases) > self.max_size:
+            self.aliases.popitem(last=False)
+
+verdict_cache = VerdictCache(VERDICT_CACHE_SIZE, VERDICT_CACHE_TTL)
+index_version_task: asyncio.Task = None
+
+# How uncached checks were decided since startup, reported by /metrics
+decision_stats = {
+    "similarity_high": 0,  # Best match at or above LLM_BYPASS_HIGH and confirmed by the verifier, if any
+    "high_without_overlap": 0,  # Of those, decided by similarity alone (no lexical_overlap reported)
+    "similarity_low": 0,  # Best match below LLM_BYPASS_LOW
+    "no_similar_files": 0,  # Nothing scored above SEARCH_MIN_SIMILARITY
+    "llm": 0,
+    "high_unverified": 0  # In the high band but not confirmed by the verifier; also counted under llm
+}
+
+# Job queue state, set up on startup
+jobs_db: sqlite3.Connection = None
+jobs_db_executor: ThreadPoolExecutor = None  # Single thread that runs every job database call
+job_queue: asyncio.Queue = None
+job_workers: List[asyncio.Task] = []
+job_retry_timers: Dict[str, asyncio.TimerHandle] = {}  # Failed jobs waiting for their next attempt
+callback_tasks: set = set()  # Callbacks resumed on startup
 
 # Models for internal use
 class SimilarFile(BaseModel):
     file_path: str
     similarity_score: float
     content: str = ""  # Keep this for backward compatibility
+    line_ranges: List[List[int]] = []  # Best-matching [start_line, end_line] ranges from a chunk-level index
 
 # Helper function to get the root directory of the project
 def get_root_dir():
     """Get the root directory of the project."""
     return os.getenv("PROJECT_ROOT", "/app")
 
+# Helper function to create a pooled HTTP client for one upstream service
+def create_upstream_client(max_connections: int, read_timeout: float) -> httpx.AsyncClient:
+    """Create a pooled async HTTP client with keep-alive for one upstream service."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(UPSTREAM_MAX_KEEPALIVE, max_connections),
+        ),
+        timeout=httpx.Timeout(
+            read_timeout,
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+    )
+
+@app.on_event("startup")
+async def startup_http_clients():
+    """Create the pooled HTTP clients used to call the search and LLM services."""
+    global search_client, llm_client, callback_client
+    
+    search_client = create_upstream_client(SEARCH_API_MAX_CONNECTIONS, SEARCH_API_TIMEOUT)
+    llm_client = create_upstream_client(LLM_API_MAX_CONNECTIONS, LLM_API_TIMEOUT)
+    callback_client = httpx.AsyncClient(timeout=JOB_CALLBACK_TIMEOUT)
+
+@app.on_event("shutdown")
+async def shutdown_http_clients():
+    """Close the pooled HTTP clients."""
+    for client in (search_client, llm_client, callback_client):
+        if client is not None:
+            await client.aclose()
+
+# Keep the verdict cache in step with the search index
+async def watch_index_version():
+    """Poll the search API's index version and drop cached verdicts when it changes."""
+    while True:
+        try:
+            response = await search_client.get(SEARCH_API_HEALTH_URL, timeout=HEALTH_CHECK_TIMEOUT)
+            if response.status_code == 200:
+                verdict_cache.set_index_version(response.json().get("index_version"))
+        except httpx.HTTPError as e:
+            print(f"Could not read the search index version: {str(e)}")
+        await asyncio.sleep(INDEX_VERSION_CHECK_INTERVAL)
+
+@app.on_event("startup")
+async def startup_index_version_watcher():
+    """Start polling the search index version if the verdict cache is enabled."""
+    global index_version_task
+    
+    if VERDICT_CACHE_SIZE > 0 and INDEX_VERSION_CHECK_INTERVAL > 0:
+        index_version_task = asyncio.create_task(watch_index_version())
+
+@app.on_event("shutdown")
+async def shutdown_index_version_watcher():
+    """Stop polling the search index version."""
+    if index_version_task is not None:
+        index_version_task.cancel()
+
+# Decide a check from the best match's similarity without the LLM
+def similarity_band(best_file: Dict[str, Any]) -> Optional[str]:
+    """Return "similarity_high" or "similarity_low" if the best match falls in a bypass band, None if the LLM decides.
+    
+    When the search API reports a token n-gram overlap (hybrid search), the high
+    band is only trusted if the overlap confirms that the submission reuses the
+    file's code; without one it is decided by similarity alone.
+    """
+    score = best_file["similarity_score"]
+    if score >= LLM_BYPASS_HIGH:
+        overlap = best_file.get("lexical_overlap")
+        if overlap is None:
+            decision_stats["high_without_overlap"] += 1
+            return "similarity_high"
+        if overlap >= LLM_BYPASS_MIN_OVERLAP:
+            return "similarity_high"
+        decision_stats["high_unverified"] += 1
+        return None
+    if score < LLM_BYPASS_LOW:
+        return "similarity_low"
+    return None
+
+# Hash code for the verdict cache
+def code_hash(code: str) -> str:
+    """Return the SHA-256 hex digest of code."""
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+# Search options forwarded with every search API request
+def search_options() -> Dict[str, Any]:
+    """Return the configured search options as search API request fields."""
+    options = {}
+    if SEARCH_TOP_K > 0:
+        options["top_k"] = SEARCH_TOP_K
+    if SEARCH_MIN_SIMILARITY > -1:
+        options["min_similarity"] = SEARCH_MIN_SIMILARITY
+    return options
+
 # Helper function to convert code text to JSON format
 def convert_code_to_json(text):
-    """Convert plain text code to a JSON payload."""
-    return {"code": text}
+    """Convert plain text code to a JSON payload, including the configured search options."""
+    return {"code": text, **search_options()}
 
 # Call the search API to find similar files
 async def call_search_api(code: str):
@@ -54,18 +324,38 @@ async def call_search_api(code: str):
         # Convert code to JSON format
         json_data = convert_code_to_json(code)
         
-        response = requests.post(
+        response = await search_client.post(
             SEARCH_API_URL,
-            json=json_data,
-            timeout=30
+            json=json_data
         )
         
         response.raise_for_status()
         return response.json()
     
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error calling search API: {str(e)}")
-        if hasattr(e, 'response') and e.response:
+        if isinstance(e, httpx.HTTPStatusError):
+            print(f"Response: {e.response.text}")
+        raise HTTPException(status_code=500, detail=f"Error calling search API: {str(e)}")
+
+# Call the search API for many submissions at once
+async def call_search_batch_api(code_snippets: Dict[str, str]):
+    """Call the search API's batch endpoint; results are keyed like code_snippets."""
+    try:
+        print(f"Calling search API batch endpoint with {len(code_snippets)} snippets")
+        
+        response = await search_client.post(
+            SEARCH_API_BATCH_URL,
+            json={"code_snippets": code_snippets, **search_options()},
+            timeout=httpx.Timeout(SEARCH_API_BATCH_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+        )
+        
+        response.raise_for_status()
+        return response.json()
+    
+    except httpx.HTTPError as e:
+        print(f"Error calling search API batch endpoint: {str(e)}")
+        if isinstance(e, httpx.HTTPStatusError):
             print(f"Response: {e.response.text}")
         raise HTTPException(status_code=500, detail=f"Error calling search API: {str(e)}")
 
@@ -75,24 +365,150 @@ async def call_llm_api(user_code: str, similar_files: List[SimilarFile]):
     try:
         print(f"Calling LLM API with {len(similar_files)} similar files")
         
-        response = requests.post(
+        response = await llm_client.post(
             LLM_API_URL,
             json={
                 "user_code": user_code,
                 "similar_files": [file.dict() for file in similar_files]
-            },
-            timeout=60
+            }
         )
         
         response.raise_for_status()
         return response.json()
     
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         print(f"Error calling LLM API: {str(e)}")
-        if hasattr(e, 'response') and e.response:
+        if isinstance(e, httpx.HTTPStatusError):
             print(f"Response: {e.response.text}")
         raise HTTPException(status_code=500, detail=f"Error calling LLM API: {str(e)}")
 
+# Run one plagiarism check: verdict cache, search, similarity bands, then the LLM
+async def run_check(code: str) -> Dict[str, Any]:
+    """Return the plagiarism verdict for code; errors from the search or LLM service propagate.
+    
+    Verdicts are cached per processed code and index version: identical resubmissions
+    are answered from the cache directly, and resubmissions that only differ in
+    comments or formatting skip the LLM call.
+    """
+    print(f"Running plagiarism check for code of length: {len(code)}")
+    
+    # Byte-identical resubmission against the current index
+    raw_key = code_hash(code)
+    cached = verdict_cache.get_alias(raw_key)
+    if cached is not None:
+        verdict_cache.stats["hits"] += 1
+        print("Returning cached verdict for an identical submission")
+        return cached
+    
+    # Call the search API
+    search_results = await call_search_api(code)
+    return await decide_verdict(code, raw_key, search_results)
+
+# Decide a check from its search results: verdict cache, similarity bands, then the LLM
+async def decide_verdict(code: str, raw_key: str, search_results: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the verdict for code given its search API results and cache it under raw_key and the processed code."""
+    index_version = search_results.get("index_version")
+    verdict_cache.set_index_version(index_version)
+    
+    # Get the similar files and processed code
+    similar_files_data = search_results.get("similar_files", [])
+    processed_code = search_results.get("processed_code", code)
+    
+    # Same processed code checked before against this index version
+    key = code_hash(processed_code)
+    cached = verdict_cache.get(key)
+    if cached is not None:
+        verdict_cache.stats["hits"] += 1
+        verdict_cache.add_alias(raw_key, key)
+        print("Returning cached verdict for equivalent processed code")
+        return cached
+    verdict_cache.stats["misses"] += 1
+    
+    print(f"Search API found {len(similar_files_data)} similar files")
+    
+    # If no similar files found (none scored above the cutoff), skip the LLM and return not plagiarized
+    if not similar_files_data:
+        decision_stats["no_similar_files"] += 1
+        verdict = {
+            "plagiarism": False,
+            "llm_response": "No similar files found",
+            "similar_files": [],
+            "decided_by": "no_similar_files"
+        }
+        verdict_cache.put(key, raw_key, verdict, index_version)
+        return verdict
+    
+    # Obvious copies and obviously original code are decided by similarity alone
+    best_file = max(similar_files_data, key=lambda file_data: file_data["similarity_score"])
+    band = similarity_band(best_file)
+    if band is not None:
+        decision_stats[band] += 1
+        if band == "similarity_high":
+            overlap = best_file.get("lexical_overlap")
+            shared = f" and shares {overlap:.0%} of the code's token n-grams" if overlap is not None else ""
+            llm_response = (
+                f"Plagiarized: {best_file['file_path']} has similarity {best_file['similarity_score']:.3f}"
+                f"{shared} (LLM not consulted)"
+            )
+        else:
+            llm_response = (
+                f"Original: the most similar file {best_file['file_path']} has similarity "
+                f"{best_file['similarity_score']:.3f}, below {LLM_BYPASS_LOW} (LLM not consulted)"
+            )
+        print(f"Decided without the LLM ({band}): {llm_response}")
+        verdict = {
+            "plagiarism": band == "similarity_high",
+            "llm_response": llm_response,
+            "similar_files": [
+                {
+                    "file_path": file_data["file_path"],
+                    "similarity_score": file_data["similarity_score"]
+                }
+                for file_data in similar_files_data
+            ],
+            "decided_by": band
+        }
+        verdict_cache.put(key, raw_key, verdict, index_version)
+        return verdict
+    decision_stats["llm"] += 1
+    
+    # Prepare the similar files (without reading content)
+    similar_files = []
+    for file_data in similar_files_data:
+        similar_file = SimilarFile(
+            file_path=file_data["file_path"],
+            similarity_score=file_data["similarity_score"],
+            content="",  # Empty content - LLM service will read the files
+            line_ranges=[[match["start_line"], match["end_line"]] for match in file_data.get("matches", [])]
+        )
+        similar_files.append(similar_file)
+        
+        print(f"Added file path: {file_data['file_path']}")
+    
+    # Call the LLM API
+    llm_results = await call_llm_api(processed_code, similar_files)
+    
+    is_plagiarized = llm_results.get("is_plagiarized", False)
+    llm_response = llm_results.get("llm_response", "")
+    
+    print(f"LLM result: is_plagiarized={is_plagiarized}, response='{llm_response}'")
+    
+    # Return the result in the specified format
+    verdict = {
+        "plagiarism": is_plagiarized,
+        "llm_response": llm_response,
+        "similar_files": [
+            {
+                "file_path": file.file_path,
+                "similarity_score": file.similarity_score
+            }
+            for file in similar_files
+        ],
+        "decided_by": "llm"
+    }
+    verdict_cache.put(key, raw_key, verdict, index_version)
+    return verdict
+
 # Main endpoint for text-based plagiarism check
 @app.post("/check")
 async def check_plagiarism(code: str = Body(..., media_type="text/plain")):
@@ -105,59 +521,12 @@ async def check_plagiarism(code: str = Body(..., media_type="text/plain")):
     3. Calls the search API to find similar files
     4. Calls the LLM service to check for plagiarism (LLM service will read file contents)
     5. Returns a JSON response with the results
+    
+    The connection stays open for the whole check; use POST /jobs for bursts of submissions.
     """
     try:
         print(f"Received plagiarism check request for code of length: {len(code)}")
-        
-        # Call the search API
-        search_results = await call_search_api(code)
-        
-        # Get the similar files and processed code
-        similar_files_data = search_results.get("similar_files", [])
-        processed_code = search_results.get("processed_code", code)
-        
-        print(f"Search API found {len(similar_files_data)} similar files")
-        
-        # If no similar files found, return not plagiarized
-        if not similar_files_data:
-            return {
-                "plagiarism": False,
-                "llm_response": "No similar files found",
-                "similar_files": []
-            }
-        
-        # Prepare the similar files (without reading content)
-        similar_files = []
-        for file_data in similar_files_data:
-            similar_file = SimilarFile(
-                file_path=file_data["file_path"],
-                similarity_score=file_data["similarity_score"],
-                content=""  # Empty content - LLM service will read the files
-            )
-            similar_files.append(similar_file)
-            
-            print(f"Added file path: {file_data['file_path']}")
-        
-        # Call the LLM API
-        llm_results = await call_llm_api(processed_code, similar_files)
-        
-        is_plagiarized = llm_results.get("is_plagiarized", False)
-        llm_response = llm_results.get("llm_response", "")
-        
-        print(f"LLM result: is_plagiarized={is_plagiarized}, response='{llm_response}'")
-        
-        # Return the result in the specified format
-        return {
-            "plagiarism": is_plagiarized,
-            "llm_response": llm_response,
-            "similar_files": [
-                {
-                    "file_path": file.file_path,
-                    "similarity_score": file.similarity_score
-                }
-                for file in similar_files
-            ]
-        }
+        return await run_check(code)
     
     except Exception as e:
         print(f"Error in check_plagiarism: {str(e)}")
@@ -169,23 +538,647 @@ async def check_plagiarism(code: str = Body(..., media_type="text/plain")):
             "similar_files": []
         }
 
+# Open the job database, creating it on first use
+def open_jobs_db() -> sqlite3.Connection:
+    """Open the SQLite job database in autocommit mode with write-ahead logging."""
+    JOBS_DB.parent.mkdir(parents=True, exist_ok=True)
+    db = sqlite3.connect(JOBS_DB, isolation_level=None, check_same_thread=False)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            status TEXT NOT NULL,
+            code TEXT NOT NULL,
+            callback_url TEXT,
+            result TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            callback_status TEXT,
+            next_attempt_at REAL
+        )
+    """)
+    # Databases created before retries were delayed lack next_attempt_at
+    columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+    if "next_attempt_at" not in columns:
+        db.execute("ALTER TABLE jobs ADD COLUMN next_attempt_at REAL")
+    db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    return db
+
+# Run one statement on the job database thread
+def execute_jobs_sql(sql: str, params: tuple) -> Tuple[List[sqlite3.Row], int]:
+    """Execute sql against the job database and return the fetched rows and the row count."""
+    cursor = jobs_db.execute(sql, params)
+    return cursor.fetchall(), cursor.rowcount
+
+# Query the job database without blocking the event loop
+async def jobs_sql(sql: str, params: tuple = ()) -> Tuple[List[sqlite3.Row], int]:
+    """Run sql on the single job database thread, which owns the connection."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(jobs_db_executor, execute_jobs_sql, sql, params)
+
+# Fetch one job row
+async def fetch_job(job_id: str) -> Optional[sqlite3.Row]:
+    """Return the row of a job, or None if it does not exist."""
+    rows, _ = await jobs_sql("SELECT * FROM jobs WHERE id = ?", (job_id,))
+    return rows[0] if rows else None
+
+# Convert a job row to its API representation
+def job_record(row: sqlite3.Row) -> Dict[str, Any]:
+    """Return a job as returned by GET /jobs/{id} and sent to callbacks, without the code."""
+    return {
+        "job_id": row["id"],
+        "status": row["status"],
+        "result": json.loads(row["result"]) if row["result"] is not None else None,
+        "error": row["error"],
+        "attempts": row["attempts"],
+        "created_at": row["created_at"],
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "next_attempt_at": row["next_attempt_at"],
+        "callback_url": row["callback_url"],
+        "callback_status": row["callback_status"]
+    }
+
+# Delete finished jobs older than the retention period
+async def purge_jobs():
+    """Delete done and failed jobs that finished more than JOB_RETENTION seconds ago."""
+    _, purged = await jobs_sql(
+        "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?",
+        (time.time() - JOB_RETENTION,)
+    )
+    if purged:
+        print(f"Purged {purged} finished jobs")
+
+# Count jobs per status
+async def job_counts() -> Dict[str, int]:
+    """Return the number of jobs in each status."""
+    counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+    rows, _ = await jobs_sql("SELECT status, COUNT(*) AS n FROM jobs GROUP BY status")
+    for row in rows:
+        counts[row["status"]] = row["n"]
+    return counts
+
+# Delay before the next run of a job that failed
+def retry_delay(attempts: int) -> float:
+    """Return JOB_RETRY_DELAY doubled for every failed run after the first, capped at JOB_RETRY_MAX_DELAY."""
+    return min(JOB_RETRY_DELAY * 2 ** (attempts - 1), JOB_RETRY_MAX_DELAY)
+
+# Put a queued job on the queue once it is due
+def schedule_job(job_id: str, next_attempt_at: Optional[float] = None):
+    """Enqueue a job now, or from a timer if its next attempt is still in the future."""
+    delay = (next_attempt_at or 0) - time.time()
+    if delay <= 0:
+        job_queue.put_nowait(job_id)
+        return
+    if job_id in job_retry_timers:
+        return
+    
+    def enqueue():
+        job_retry_timers.pop(job_id, None)
+        job_queue.put_nowait(job_id)
+    
+    job_retry_timers[job_id] = asyncio.get_running_loop().call_later(delay, enqueue)
+
+# Deliver a finished job to its callback URL
+async def send_callback(job_id: str):
+    """POST the finished job to its callback URL, retrying with backoff, and record the outcome."""
+    row = await fetch_job(job_id)
+    if row is None or not row["callback_url"]:
+        return
+    
+    status = "failed"
+    for attempt in range(JOB_CALLBACK_ATTEMPTS):
+        try:
+            response = await callback_client.post(row["callback_url"], json=job_record(row))
+            response.raise_for_status()
+            status = "delivered"
+            break
+        except httpx.HTTPError as e:
+            print(f"Callback for job {job_id} to {row['callback_url']} failed (attempt {attempt + 1}): {str(e)}")
+            status = f"failed: {str(e)}"
+            if attempt + 1 < JOB_CALLBACK_ATTEMPTS:
+                await asyncio.sleep(2 ** attempt)
+    await jobs_sql("UPDATE jobs SET callback_status = ? WHERE id = ?", (status, job_id))
+
+# Run one queued job
+async def run_job(job_id: str):
+    """Run the check of a queued job and store its verdict, retrying it with backoff until JOB_MAX_ATTEMPTS."""
+    row = await fetch_job(job_id)
+    if row is None or row["status"] != "queued":
+        return
+    if row["next_attempt_at"] is not None and row["next_attempt_at"] > time.time():
+        # Not due yet; it goes back on the queue when it is
+        schedule_job(job_id, row["next_attempt_at"])
+        return
+    attempts = row["attempts"] + 1
+    await jobs_sql(
+        "UPDATE jobs SET status = 'running', attempts = ?, started_at = ?, next_attempt_at = NULL WHERE id = ?",
+        (attempts, time.time(), job_id)
+    )
+    
+    try:
+        verdict = await run_check(row["code"])
+    except Exception as e:
+        print(f"Error in job {job_id} (attempt {attempts}): {str(e)}")
+        if attempts < JOB_MAX_ATTEMPTS:
+            next_attempt_at = time.time() + retry_delay(attempts)
+            await jobs_sql(
+                "UPDATE jobs SET status = 'queued', error = ?, next_attempt_at = ? WHERE id = ?",
+                (str(e), next_attempt_at, job_id)
+            )
+            schedule_job(job_id, next_attempt_at)
+            return
+        await jobs_sql(
+            "UPDATE jobs SET status = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (str(e), time.time(), job_id)
+        )
+    else:
+        await jobs_sql(
+            "UPDATE jobs SET status = 'done', result = ?, error = NULL, finished_at = ? WHERE id = ?",
+            (json.dumps(verdict), time.time(), job_id)
+        )
+    await send_callback(job_id)
+
+# Background worker draining the job queue
+async def job_worker():
+    """Run queued jobs one at a time; JOB_WORKERS of these bound the number of concurrent jobs."""
+    while True:
+        job_id = await job_queue.get()
+        try:
+            await run_job(job_id)
+        except Exception as e:
+            print(f"Job worker error for job {job_id}: {str(e)}")
+        finally:
+            job_queue.task_done()
+
+@app.on_event("startup")
+async def startup_jobs():
+    """Open the job database, recover jobs left by the previous run and start the workers."""
+    global jobs_db, jobs_db_executor, job_queue, job_workers
+    
+    jobs_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jobs-db")
+    jobs_db = await asyncio.get_running_loop().run_in_executor(jobs_db_executor, open_jobs_db)
+    job_queue = asyncio.Queue()
+    await purge_jobs()
+    
+    # Checks interrupted by a restart count as an attempt and are run again
+    await jobs_sql(
+        "UPDATE jobs SET status = 'failed', error = 'Interrupted by a restart', finished_at = ? "
+        "WHERE status = 'running' AND attempts >= ?",
+        (time.time(), JOB_MAX_ATTEMPTS)
+    )
+    await jobs_sql("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+    queued, _ = await jobs_sql("SELECT id, next_attempt_at FROM jobs WHERE status = 'queued' ORDER BY created_at")
+    for row in queued:
+        schedule_job(row["id"], row["next_attempt_at"])
+    
+    # Callbacks that were not attempted before the restart
+    pending_callbacks, _ = await jobs_sql(
+        "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND callback_url IS NOT NULL AND callback_status IS NULL"
+    )
+    for row in pending_callbacks:
+        task = asyncio.create_task(send_callback(row["id"]))
+        callback_tasks.add(task)
+        task.add_done_callback(callback_tasks.discard)
+    
+    job_workers = [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
+    print(f"Started {JOB_WORKERS} job workers with {len(queued)} queued jobs from {JOBS_DB}")
+
+@app.on_event("shutdown")
+async def shutdown_jobs():
+    """Stop the workers; running jobs stay marked running and are requeued on the next startup."""
+    for timer in job_retry_timers.values():
+        timer.cancel()
+    job_retry_timers.clear()
+    tasks = job_workers + list(callback_tasks)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if jobs_db is not None:
+        await asyncio.get_running_loop().run_in_executor(jobs_db_executor, jobs_db.close)
+    if jobs_db_executor is not None:
+        jobs_db_executor.shutdown()
+
+# Check that a callback URL points at an allowed host
+def validate_callback_url(callback_url: str):
+    """Raise a 400 unless callback_url is an http(s) URL on one of JOB_CALLBACK_HOSTS."""
+    parsed = urlparse(callback_url)
+    if parsed.scheme not in ("http", "https") or parsed.hostname not in JOB_CALLBACK_HOSTS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"callback_url must be an http(s) URL on one of: {', '.join(sorted(JOB_CALLBACK_HOSTS))}"
+        )
+
+# Queue a plagiarism check
+@app.post("/jobs", status_code=202)
+async def create_job(code: str = Body(..., media_type="text/plain"), callback_url: Optional[str] = None):
+    """
+    Queue a plagiarism check of the provided code text and return its job ID at once.
+    
+    Poll GET /jobs/{job_id} for the result, or pass callback_url to have the finished
+    job POSTed to it. The result has the same format as the /check response.
+    """
+    if callback_url is not None:
+        validate_callback_url(callback_url)
+    if job_queue.qsize() + len(job_retry_timers) >= JOB_QUEUE_MAX:
+        raise HTTPException(status_code=429, detail=f"Job queue is full ({JOB_QUEUE_MAX} queued jobs)")
+    
+    await purge_jobs()
+    job_id = uuid.uuid4().hex
+    await jobs_sql(
+        "INSERT INTO jobs (id, status, code, callback_url, created_at) VALUES (?, 'queued', ?, ?, ?)",
+        (job_id, code, callback_url, time.time())
+    )
+    job_queue.put_nowait(job_id)
+    print(f"Queued job {job_id} for code of length: {len(code)}")
+    
+    return {
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/jobs/{job_id}"
+    }
+
+# Fetch a job's status and result
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Return the status of a job and, once it is done, its verdict."""
+    row = await fetch_job(job_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail=f"Job {job_id} not found")
+    return job_record(row)
+
+# Whether an archive entry is a submission to check
+def is_submission(name: str) -> bool:
+    """Return True for files with one of BULK_EXTENSIONS, skipping hidden files and macOS metadata."""
+    path = Path(name)
+    if any(part.startswith(".") or part == "__MACOSX" for part in path.parts):
+        return False
+    return path.suffix.lower() in BULK_EXTENSIONS
+
+# Decode one archive entry
+def decode_entry(name: str, data: bytes) -> Tuple[str, Optional[str], Optional[str]]:
+    """Return (name, code, None), or (name, None, error) for oversized or non-UTF-8 files."""
+    if len(data) > BULK_MAX_FILE_BYTES:
+        return name, None, f"File is larger than {BULK_MAX_FILE_BYTES} bytes"
+    try:
+        return name, data.decode("utf-8"), None
+    except UnicodeDecodeError:
+        return name, None, "File is not UTF-8 text"
+
+# Open an uploaded archive
+def open_archive(spool):
+    """Open a zip or tar (optionally gzip, bz2 or xz compressed) archive, raising a 400 for anything else."""
+    if zipfile.is_zipfile(spool):
+        spool.seek(0)
+        return zipfile.ZipFile(spool)
+    spool.seek(0)
+    try:
+        return tarfile.open(fileobj=spool, mode="r:*")
+    except tarfile.TarError:
+        raise HTTPException(status_code=400, detail="Body must be a zip or tar archive (optionally gzip, bz2 or xz compressed)")
+
+# Receive an uploaded archive
+async def receive_archive(request: Request):
+    """Spool the request body and open it as an archive; returns the archive and its spool file, which the caller closes."""
+    spool = tempfile.SpooledTemporaryFile(max_size=BULK_SPOOL_BYTES)
+    try:
+        size = 0
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > BULK_MAX_ARCHIVE_BYTES:
+                raise HTTPException(status_code=413, detail=f"Archive is larger than {BULK_MAX_ARCHIVE_BYTES} bytes")
+            spool.write(chunk)
+        spool.seek(0)
+        archive = open_archive(spool)
+    except BaseException:
+        spool.close()
+        raise
+    
+    print(f"Received archive of {size} bytes")
+    return archive, spool
+
+# Read the submissions of an archive one entry at a time
+def archive_entries(archive) -> Iterator[Tuple[str, Optional[str], Optional[str]]]:
+    """Yield (name, code, error) for each submission in an open zip or tar archive.
+    
+    Entries are read into memory one at a time, never extracted to disk.
+    """
+    if isinstance(archive, zipfile.ZipFile):
+        for info in archive.infolist():
+            if info.is_dir() or not is_submission(info.filename):
+                continue
+            if info.file_size > BULK_MAX_FILE_BYTES:
+                yield info.filename, None, f"File is larger than {BULK_MAX_FILE_BYTES} bytes"
+                continue
+            try:
+                with archive.open(info) as f:
+                    data = f.read(BULK_MAX_FILE_BYTES + 1)
+            except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError) as e:
+                yield info.filename, None, f"Could not read file: {str(e)}"
+                continue
+            yield decode_entry(info.filename, data)
+        return
+    
+    for member in archive:
+        if not member.isfile() or not is_submission(member.name):
+            continue
+        if member.size > BULK_MAX_FILE_BYTES:
+            yield member.name, None, f"File is larger than {BULK_MAX_FILE_BYTES} bytes"
+            continue
+        yield decode_entry(member.name, archive.extractfile(member).read())
+
+# Per-file line of the bulk report
+def file_report(name: Optional[str], verdict: Optional[Dict[str, Any]] = None, error: Optional[str] = None) -> Dict[str, Any]:
+    """Return the NDJSON report line for one file: its verdict, or an error."""
+    if error is not None:
+        return {"file": name, "error": error}
+    return {"file": name, **verdict}
+
+# Check one batch of archive entries
+async def check_archive_batch(
+    batch: List[Tuple[str, Optional[str], Optional[str]]],
+    out: asyncio.Queue,
+    llm_slots: asyncio.Semaphore,
+    batch_slots: asyncio.Semaphore,
+    stats: Dict[str, int]
+):
+    """Search a batch with one /search_batch call, then decide each file and put its report line on out.
+    
+    The batch's pipeline slot is released once the search is done, so the next batch
+    is searched while this one waits for the LLM.
+    """
+    names = []
+    codes = []
+    try:
+        for name, code, error in batch:
+            if error is not None:
+                out.put_nowait(file_report(name, error=error))
+                continue
+            cached = verdict_cache.get_alias(code_hash(code))
+            if cached is not None:
+                verdict_cache.stats["hits"] += 1
+                out.put_nowait(file_report(name, cached))
+                continue
+            names.append(name)
+            codes.append(code)
+        if not codes:
+            return
+        
+        # Archive names may repeat, so snippets are keyed by position in the batch
+        try:
+            search_results = await call_search_batch_api({str(i): code for i, code in enumerate(codes)})
+            stats["search_batches"] += 1
+        except Exception as e:
+            for name in names:
+                out.put_nowait(file_report(name, error=str(e)))
+            return
+    finally:
+        batch_slots.release()
+    
+    async def decide(i: int):
+        result = search_results["results"].get(str(i))
+        if result is None or result.get("error"):
+            out.put_nowait(file_report(names[i], error=result.get("error") if result else "No search result"))
+            return
+        try:
+            async with llm_slots:
+                verdict = await decide_verdict(
+                    codes[i], code_hash(codes[i]), {**result, "index_version": search_results.get("index_version")}
+                )
+            out.put_nowait(file_report(names[i], verdict))
+        except Exception as e:
+            print(f"Error checking {names[i]}: {str(e)}")
+            out.put_nowait(file_report(names[i], error=str(e)))
+    
+    await asyncio.gather(*(decide(i) for i in range(len(codes))))
+
+# Stream the bulk report of an archive
+async def archive_report(archive, spool):
+    """Check every submission in the archive and yield one NDJSON line per file as it is decided, then a summary."""
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    out = asyncio.Queue()
+    entries = archive_entries(archive)
+    stats = {"search_batches": 0, "truncated": False}
+    
+    def read_batch(read: int) -> List[Tuple[str, Optional[str], Optional[str]]]:
+        batch = list(islice(entries, min(BULK_BATCH_SIZE, BULK_MAX_FILES - read)))
+        if not batch and read >= BULK_MAX_FILES and next(entries, None) is not None:
+            stats["truncated"] = True
+        return batch
+    
+    async def produce():
+        batch_slots = asyncio.Semaphore(BULK_PIPELINE_DEPTH)
+        llm_slots = asyncio.Semaphore(BULK_LLM_CONCURRENCY)
+        tasks = []
+        read = 0
+        try:
+            try:
+                while True:
+                    await batch_slots.acquire()
+                    batch = await loop.run_in_executor(None, read_batch, read)
+                    if not batch:
+                        batch_slots.release()
+                        break
+                    read += len(batch)
+                    tasks.append(asyncio.create_task(check_archive_batch(batch, out, llm_slots, batch_slots, stats)))
+            except Exception as e:
+                print(f"Error reading archive: {str(e)}")
+                out.put_nowait(file_report(None, error=f"Error reading archive: {str(e)}"))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            out.put_nowait(None)
+    
+    summary = {"files": 0, "errors": 0, "plagiarized": 0, "decided_by": {}}
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            line = await out.get()
+            if line is None:
+                break
+            if "error" in line:
+                summary["errors"] += 1
+            else:
+                summary["plagiarized"] += int(bool(line.get("plagiarism")))
+                decided_by = line.get("decided_by", "llm")
+                summary["decided_by"][decided_by] = summary["decided_by"].get(decided_by, 0) + 1
+            if line["file"] is not None:
+                summary["files"] += 1
+            yield json.dumps(line) + "\n"
+        
+        summary.update(stats)
+        summary["seconds"] = round(time.perf_counter() - start, 3)
+        print(f"Checked archive: {summary}")
+        yield json.dumps({"summary": summary}) + "\n"
+    finally:
+        producer.cancel()
+        archive.close()
+        spool.close()
+
+# Bulk endpoint for checking an archive of submissions
+@app.post("/check_archive")
+async def check_archive(request: Request):
+    """
+    Check every submission in a zip or tar archive sent as the request body.
+    
+    Submissions are searched BULK_BATCH_SIZE at a time through the search API's
+    batch endpoint and then decided like /check, with bounded LLM concurrency.
+    The response is NDJSON: one line per file in the order files are decided
+    ({"file": ..., "plagiarism": ..., ...} or {"file": ..., "error": ...}),
+    followed by a {"summary": ...} line.
+    """
+    archive, spool = await receive_archive(request)
+    return StreamingResponse(archive_report(archive, spool), media_type="application/x-ndjson")
+
+# Read every submission of an archive
+def read_submissions(archive) -> Tuple[Dict[str, str], Dict[str, str], bool]:
+    """Return the archive's submissions and per-file errors, keyed by unique name, and whether BULK_MAX_FILES cut it short."""
+    submissions = {}
+    errors = {}
+    entries = archive_entries(archive)
+    for name, code, error in islice(entries, BULK_MAX_FILES):
+        # Archive names may repeat
+        key = name
+        suffix = 2
+        while key in submissions or key in errors:
+            key = f"{name}#{suffix}"
+            suffix += 1
+        if error is not None:
+            errors[key] = error
+        else:
+            submissions[key] = code
+    return submissions, errors, next(entries, None) is not None
+
+# Call the search API to compare submissions with each other
+async def call_pairwise_api(code_snippets: Dict[str, str], min_similarity: Optional[float] = None):
+    """Call the search API's pairwise endpoint; returns suspicious pairs, most similar first, and their clusters."""
+    try:
+        print(f"Calling search API pairwise endpoint with {len(code_snippets)} snippets")
+        
+        payload = {"code_snippets": code_snippets}
+        if min_similarity is not None:
+            payload["min_similarity"] = min_similarity
+        response = await search_client.post(
+            SEARCH_API_PAIRWISE_URL,
+            json=payload,
+            timeout=httpx.Timeout(SEARCH_API_BATCH_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT, pool=UPSTREAM_POOL_TIMEOUT)
+        )
+        
+        response.raise_for_status()
+        return response.json()
+    
+    except httpx.HTTPError as e:
+        print(f"Error calling search API pairwise endpoint: {str(e)}")
+        if isinstance(e, httpx.HTTPStatusError):
+            print(f"Response: {e.response.text}")
+        raise HTTPException(status_code=500, detail=f"Error calling search API: {str(e)}")
+
+# Ask the LLM about one suspicious pair
+async def check_pair(pair: Dict[str, Any], submissions: Dict[str, str], llm_slots: asyncio.Semaphore):
+    """Add the LLM's verdict on whether pair["a"] copies pair["b"] to the pair, or an error."""
+    try:
+        async with llm_slots:
+            llm_results = await call_llm_api(
+                submissions[pair["a"]],
+                [SimilarFile(file_path=pair["b"], similarity_score=pair["similarity"], content=submissions[pair["b"]])]
+            )
+        pair["plagiarism"] = llm_results.get("is_plagiarized", False)
+        pair["llm_response"] = llm_results.get("llm_response", "")
+    except Exception as e:
+        print(f"Error checking pair {pair['a']} / {pair['b']}: {str(e)}")
+        pair["error"] = str(e)
+
+# Collusion endpoint: compare the submissions of an archive with each other
+@app.post("/check_collusion")
+async def check_collusion(request: Request, min_similarity: Optional[float] = None, llm_pairs: Optional[int] = None):
+    """
+    Find groups of submissions in a zip or tar archive that are suspiciously similar to each other.
+    
+    The search API embeds every submission once and compares all of them with one
+    vectorized search (/pairwise); the reference corpus is not involved. Only the
+    llm_pairs most similar pairs (default COLLUSION_LLM_PAIRS) go to the LLM, with at
+    most BULK_LLM_CONCURRENCY calls at a time. min_similarity overrides the search
+    API's PAIRWISE_MIN_SIMILARITY.
+    """
+    start = time.perf_counter()
+    llm_pairs = COLLUSION_LLM_PAIRS if llm_pairs is None else llm_pairs
+    if llm_pairs < 0:
+        raise HTTPException(status_code=400, detail="llm_pairs must be at least 0")
+    
+    archive, spool = await receive_archive(request)
+    try:
+        submissions, errors, truncated = await asyncio.get_running_loop().run_in_executor(None, read_submissions, archive)
+    finally:
+        archive.close()
+        spool.close()
+    
+    result = {"suspicious_pairs": 0, "pairs": [], "clusters": []}
+    if len(submissions) > 1:
+        result = await call_pairwise_api(submissions, min_similarity)
+        errors.update(result.get("errors", {}))
+    
+    # The most similar pairs get an LLM verdict; clusters count the pairs it confirmed
+    llm_slots = asyncio.Semaphore(BULK_LLM_CONCURRENCY)
+    checked = result["pairs"][:llm_pairs]
+    await asyncio.gather(*(check_pair(pair, submissions, llm_slots) for pair in checked))
+    for cluster in result["clusters"]:
+        members = set(cluster["members"])
+        cluster["confirmed_pairs"] = sum(
+            1 for pair in checked if pair.get("plagiarism") and pair["a"] in members and pair["b"] in members
+        )
+    
+    print(
+        f"Compared {len(submissions)} submissions: {result['suspicious_pairs']} suspicious pairs, "
+        f"{len(result['clusters'])} clusters, {len(checked)} LLM calls"
+    )
+    return {
+        "submissions": len(submissions),
+        "suspicious_pairs": result["suspicious_pairs"],
+        "llm_calls": len(checked),
+        "clusters": result["clusters"],
+        "pairs": result["pairs"],
+        "errors": errors,
+        "truncated": truncated,
+        "seconds": round(time.perf_counter() - start, 3)
+    }
+
+# Probe a single upstream health endpoint
+async def probe_health(client: httpx.AsyncClient, url: str) -> str:
+    """Return "healthy" if the upstream health endpoint answers 200, "unhealthy" otherwise."""
+    try:
+        response = await client.get(url, timeout=HEALTH_CHECK_TIMEOUT)
+        return "healthy" if response.status_code == 200 else "unhealthy"
+    except httpx.HTTPError as e:
+        print(f"Health probe to {url} failed: {str(e)}")
+        return "unhealthy"
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
     """Health check endpoint."""
     try:
-        # Check search API
-        search_health = requests.get("http://search_api:8003/health", timeout=5)
-        search_status = "healthy" if search_health.status_code == 200 else "unhealthy"
-        
-        # Check LLM API
-        llm_health = requests.get("http://llm_service:8005/health", timeout=5)
-        llm_status = "healthy" if llm_health.status_code == 200 else "unhealthy"
+        # Probe search API and LLM API in parallel
+        search_status, llm_status = await asyncio.gather(
+            probe_health(search_client, SEARCH_API_HEALTH_URL),
+            probe_health(llm_client, LLM_API_HEALTH_URL),
+        )
         
         return {
             "status": "healthy" if search_status == "healthy" and llm_status == "healthy" else "unhealthy",
             "search_api": search_status,
-            "llm_service": llm_status
+            "llm_service": llm_status,
+            "jobs": {"workers": JOB_WORKERS, **(await job_counts())},
+            "verdict_cache": {
+                "entries": len(verdict_cache.verdicts),
+                "index_version": verdict_cache.index_version,
+                **verdict_cache.stats
+            }
         }
     except Exception as e:
         return {
@@ -193,6 +1186,24 @@ async def health_check():
             "error": str(e)
         }
 
+# Decision metrics endpoint
+@app.get("/metrics")
+async def metrics():
+    """How uncached checks were decided since startup, as counts and shares.
+    
+    Compare the bypass shares with the accuracy per decided_by reported by
+    evaluation/simple_evaluation.py when tuning LLM_BYPASS_HIGH and LLM_BYPASS_LOW.
+    """
+    checks = sum(decision_stats[name] for name in ("similarity_high", "similarity_low", "no_similar_files", "llm"))
+    return {
+        "bands": {"high": LLM_BYPASS_HIGH, "low": LLM_BYPASS_LOW, "min_overlap": LLM_BYPASS_MIN_OVERLAP},
+        "checks": checks,
+        "decisions": dict(decision_stats),
+        "shares": {name: count / checks if checks else 0.0 for name, count in decision_stats.items()},
+        "llm_bypass_rate": 1 - decision_stats["llm"] / checks if checks else 0.0,
+        "verdict_cache": dict(verdict_cache.stats)
+    }
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -203,7 +1214,12 @@ async def root():
         "endpoints": [
             {"path": "/", "method": "GET", "description": "This information"},
             {"path": "/health", "method": "GET", "description": "Health check"},
-            {"path": "/check", "method": "POST", "description": "Check if code is plagiarized (text input)"}
+            {"path": "/metrics", "method": "GET", "description": "How checks were decided (similarity bands, LLM)"},
+            {"path": "/check", "method": "POST", "description": "Check if code is plagiarized (text input)"},
+            {"path": "/jobs", "method": "POST", "description": "Queue a plagiarism check (text input) and return a job ID"},
+            {"path": "/jobs/{job_id}", "method": "GET", "description": "Status and result of a queued check"},
+            {"path": "/check_archive", "method": "POST", "description": "Check every file in a zip or tar archive (NDJSON report)"},
+            {"path": "/check_collusion", "method": "POST", "description": "Find similar groups among the files of a zip or tar archive"}
         ]
     }
 
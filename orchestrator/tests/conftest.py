@@ -0,0 +1,16 @@
+"""Fixtures for the orchestrator tests."""
+
+import pytest
+
+from orchestrator_helpers import FakeServices, orchestrator
+
+@pytest.fixture
+def services(monkeypatch):
+    """Fake search and LLM services, a fresh verdict cache and zeroed decision counters."""
+    fake = FakeServices()
+    monkeypatch.setattr(orchestrator, "call_search_api", fake.call_search_api)
+    monkeypatch.setattr(orchestrator, "call_search_batch_api", fake.call_search_batch_api)
+    monkeypatch.setattr(orchestrator, "call_llm_api", fake.call_llm_api)
+    monkeypatch.setattr(orchestrator, "verdict_cache", orchestrator.VerdictCache(100, 3600))
+    monkeypatch.setattr(orchestrator, "decision_stats", {name: 0 for name in orchestrator.decision_stats})
+    return fake
@@ -0,0 +1,57 @@
+"""Helpers for the orchestrator tests: the service module loaded from main.py and fake search and LLM services."""
+
+import importlib.util
+import sys
+from pathlib import Path
+from typing import Any, Dict
+
+ROOT = Path(__file__).resolve().parents[2]
+
+spec = importlib.util.spec_from_file_location("orchestrator_main", ROOT / "orchestrator" / "main.py")
+orchestrator = importlib.util.module_from_spec(spec)
+sys.modules["orchestrator_main"] = orchestrator
+spec.loader.exec_module(orchestrator)
+
+class FakeServices:
+    """Search and LLM services answering from dicts, recording every call.
+
+    results maps submitted code to its similar files; code without an entry has none.
+    The next search_failures searches fail, and so does every search while search_error is set.
+    Processed code strips surrounding whitespace, like a formatting-insensitive code processor.
+    """
+
+    def __init__(self):
+        self.results: Dict[str, list] = {}
+        self.index_version = "v1"
+        self.plagiarized = True
+        self.search_calls = []
+        self.batch_calls = []
+        self.llm_calls = []
+        self.search_error = None
+        self.search_failures = 0
+
+    def search_response(self, code: str) -> Dict[str, Any]:
+        return {
+            "similar_files": [dict(file) for file in self.results.get(code.strip(), [])],
+            "processed_code": code.strip(),
+            "index_version": self.index_version
+        }
+
+    async def call_search_api(self, code: str):
+        self.search_calls.append(code)
+        if self.search_failures > 0:
+            self.search_failures -= 1
+            raise RuntimeError("search API unavailable")
+        if self.search_error is not None:
+            raise self.search_error
+        return self.search_response(code)
+
+    async def call_search_batch_api(self, code_snippets: Dict[str, str]):
+        self.batch_calls.append(dict(code_snippets))
+        if self.search_error is not None:
+            raise self.search_error
+        return {"results": {key: self.search_response(code) for key, code in code_snippets.items()}}
+
+    async def call_llm_api(self, user_code, similar_files):
+        self.llm_calls.append(user_code)
+        return {"is_plagiarized": self.plagiarized, "llm_response": "LLM verdict"}
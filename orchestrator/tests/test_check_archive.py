@@ -0,0 +1,110 @@
+"""/check_archive: batched checks of every submission in a zip or tar archive, streamed as NDJSON."""
+
+import asyncio
+import io
+import json
+import tarfile
+import zipfile
+
+import httpx
+import pytest
+
+from orchestrator_helpers import orchestrator
+
+SUBMISSIONS = {f"hw1/student{i}.py": f"print({i})" for i in range(5)}
+
+@pytest.fixture
+def bulk(services, monkeypatch):
+    """Small batches and files; student0 has a match the LLM judges."""
+    monkeypatch.setattr(orchestrator, "BULK_BATCH_SIZE", 2)
+    monkeypatch.setattr(orchestrator, "BULK_MAX_FILE_BYTES", 1000)
+    services.results["print(0)"] = [{"file_path": "course/reference.py", "similarity_score": 0.7}]
+    return services
+
+def zip_archive(files):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, data in files.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+def tar_archive(files):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for name, data in files.items():
+            data = data.encode("utf-8") if isinstance(data, str) else data
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+def post_archive(body):
+    """POST body to /check_archive; returns the status code and the decoded NDJSON lines (or error body)."""
+    async def run():
+        transport = httpx.ASGITransport(app=orchestrator.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://orchestrator") as client:
+            response = await client.post("/check_archive", content=body)
+        if response.status_code != 200:
+            return response.status_code, response.json()
+        return response.status_code, [json.loads(line) for line in response.text.splitlines()]
+
+    return asyncio.run(run())
+
+@pytest.mark.parametrize("pack", [zip_archive, tar_archive])
+def test_every_submission_gets_a_line_and_a_summary(bulk, pack):
+    status, lines = post_archive(pack({**SUBMISSIONS, "hw1/README.txt": "notes", "__MACOSX/hw1/._student0.py": "x"}))
+    assert status == 200
+    summary = lines[-1]["summary"]
+    reports = {line["file"]: line for line in lines[:-1]}
+    assert sorted(reports) == sorted(SUBMISSIONS)
+    assert reports["hw1/student0.py"]["decided_by"] == "llm"
+    assert reports["hw1/student0.py"]["plagiarism"] is True
+    assert reports["hw1/student1.py"]["decided_by"] == "no_similar_files"
+    assert summary["files"] == 5 and summary["errors"] == 0 and summary["plagiarized"] == 1
+    assert summary["search_batches"] == 3
+    assert [len(call) for call in bulk.batch_calls] == [2, 2, 1]
+    assert bulk.llm_calls == ["print(0)"]
+
+def test_unreadable_files_are_reported_without_stopping_the_archive(bulk):
+    files = {"a.py": "print(0)", "latin1.py": "print('é')".encode("latin-1"), "big.py": "#" * 2000}
+    status, lines = post_archive(zip_archive(files))
+    reports = {line["file"]: line for line in lines[:-1]}
+    assert reports["latin1.py"] == {"file": "latin1.py", "error": "File is not UTF-8 text"}
+    assert reports["big.py"]["error"].startswith("File is larger than")
+    assert reports["a.py"]["plagiarism"] is True
+    assert lines[-1]["summary"]["errors"] == 2
+
+def test_a_failed_search_fails_only_its_batch(bulk, monkeypatch):
+    call_search_batch_api = bulk.call_search_batch_api
+    batches = []
+
+    async def fail_second_batch(code_snippets):
+        batches.append(code_snippets)
+        if len(batches) == 2:
+            raise RuntimeError("search API timed out")
+        return await call_search_batch_api(code_snippets)
+
+    monkeypatch.setattr(orchestrator, "call_search_batch_api", fail_second_batch)
+    monkeypatch.setattr(orchestrator, "BULK_PIPELINE_DEPTH", 1)
+    _, lines = post_archive(zip_archive(SUBMISSIONS))
+    errors = sorted(line["file"] for line in lines[:-1] if line.get("error") == "search API timed out")
+    assert errors == ["hw1/student2.py", "hw1/student3.py"]
+    assert lines[-1]["summary"]["errors"] == 2
+
+def test_cached_verdicts_are_reused(bulk):
+    asyncio.run(orchestrator.run_check("print(0)"))
+    _, lines = post_archive(zip_archive(SUBMISSIONS))
+    assert all("print(0)" not in call.values() for call in bulk.batch_calls)
+    assert len(bulk.llm_calls) == 1
+    assert lines[-1]["summary"]["plagiarized"] == 1
+
+def test_archives_beyond_the_file_limit_are_truncated(bulk, monkeypatch):
+    monkeypatch.setattr(orchestrator, "BULK_MAX_FILES", 3)
+    _, lines = post_archive(zip_archive(SUBMISSIONS))
+    assert lines[-1]["summary"]["files"] == 3
+    assert lines[-1]["summary"]["truncated"] is True
+
+def test_other_bodies_are_refused(bulk, monkeypatch):
+    assert post_archive(b"print(1)")[0] == 400
+    monkeypatch.setattr(orchestrator, "BULK_MAX_ARCHIVE_BYTES", 100)
+    assert post_archive(zip_archive(SUBMISSIONS))[0] == 413
@@ -0,0 +1,157 @@
+"""The persistent job API: workers, retries with backoff, callbacks and recovery after a restart."""
+
+import asyncio
+import json
+import sqlite3
+import time
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+from orchestrator_helpers import orchestrator
+
+RETRY_DELAY = 0.1
+
+@pytest.fixture
+def jobs(services, tmp_path, monkeypatch):
+    """A job database in tmp_path, fast retries and a callback receiver recording what it gets."""
+    monkeypatch.setattr(orchestrator, "JOBS_DB", tmp_path / "jobs.sqlite3")
+    monkeypatch.setattr(orchestrator, "JOB_WORKERS", 2)
+    monkeypatch.setattr(orchestrator, "JOB_RETRY_DELAY", RETRY_DELAY)
+    monkeypatch.setattr(orchestrator, "JOB_RETRY_MAX_DELAY", 10 * RETRY_DELAY)
+    for name, value in (("jobs_db", None), ("jobs_db_executor", None), ("job_queue", None), ("job_workers", []),
+                        ("job_retry_timers", {}), ("callback_tasks", set())):
+        monkeypatch.setattr(orchestrator, name, value)
+
+    services.callbacks = []
+
+    def receive(request):
+        services.callbacks.append((str(request.url), json.loads(request.content)))
+        return httpx.Response(200)
+
+    monkeypatch.setattr(orchestrator, "callback_client", httpx.AsyncClient(transport=httpx.MockTransport(receive)))
+    services.results["copied"] = [{"file_path": "course/student1.py", "similarity_score": 0.7}]
+    return services
+
+def run_service(scenario):
+    """Run scenario between the job startup and shutdown hooks."""
+    async def run():
+        await orchestrator.startup_jobs()
+        try:
+            return await scenario()
+        finally:
+            await orchestrator.shutdown_jobs()
+
+    return asyncio.run(run())
+
+async def finished(job_id, timeout=5.0):
+    """Poll GET /jobs/{job_id} until the job is done or failed."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = await orchestrator.get_job(job_id)
+        if job["status"] in ("done", "failed"):
+            return job
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Job {job_id} did not finish: {job}")
+
+def test_a_job_returns_the_check_verdict(jobs):
+    async def scenario():
+        job_id = (await orchestrator.create_job("copied"))["job_id"]
+        return await finished(job_id)
+
+    job = run_service(scenario)
+    assert job["attempts"] == 1
+    assert job["result"]["decided_by"] == "llm"
+    assert job["result"]["similar_files"] == [{"file_path": "course/student1.py", "similarity_score": 0.7}]
+
+def test_failed_runs_are_retried_with_growing_delays(jobs, monkeypatch):
+    jobs.search_failures = 2
+    search_times = []
+    call_search_api = orchestrator.call_search_api
+
+    async def timed_search(code):
+        search_times.append(time.monotonic())
+        return await call_search_api(code)
+
+    monkeypatch.setattr(orchestrator, "call_search_api", timed_search)
+
+    async def scenario():
+        job_id = (await orchestrator.create_job("copied", callback_url="http://localhost:9000/done"))["job_id"]
+        await asyncio.sleep(RETRY_DELAY / 2)
+        waiting = await orchestrator.get_job(job_id)
+        assert waiting["status"] == "queued"
+        assert waiting["error"] == "search API unavailable"
+        assert waiting["next_attempt_at"] > time.time()
+        job = await finished(job_id)
+        await asyncio.sleep(0.05)  # The callback is sent after the job is marked done
+        return job
+
+    job = run_service(scenario)
+    assert job["status"] == "done" and job["attempts"] == 3 and job["error"] is None
+    first_gap, second_gap = search_times[1] - search_times[0], search_times[2] - search_times[1]
+    assert first_gap >= RETRY_DELAY * 0.9
+    assert second_gap >= 2 * RETRY_DELAY * 0.9
+    assert [(url, record["status"], record["attempts"]) for url, record in jobs.callbacks] == [
+        ("http://localhost:9000/done", "done", 3)
+    ]
+
+def test_a_job_fails_after_its_last_attempt(jobs):
+    jobs.search_error = RuntimeError("search API down")
+
+    async def scenario():
+        return await finished((await orchestrator.create_job("copied"))["job_id"])
+
+    job = run_service(scenario)
+    assert job["status"] == "failed"
+    assert job["attempts"] == orchestrator.JOB_MAX_ATTEMPTS
+    assert job["error"] == "search API down"
+    assert len(jobs.search_calls) == orchestrator.JOB_MAX_ATTEMPTS
+
+def test_retry_delays_double_up_to_the_maximum(jobs):
+    assert [orchestrator.retry_delay(attempts) for attempts in range(1, 7)] == pytest.approx(
+        [RETRY_DELAY, 2 * RETRY_DELAY, 4 * RETRY_DELAY, 8 * RETRY_DELAY, 10 * RETRY_DELAY, 10 * RETRY_DELAY]
+    )
+
+def test_jobs_left_by_a_previous_run_are_recovered(jobs):
+    now = time.time()
+    rows = [
+        ("interrupted", "running", "copied", 1, now, None),
+        ("exhausted", "running", "copied", orchestrator.JOB_MAX_ATTEMPTS, now, None),
+        ("waiting", "queued", "copied", 1, now, now + 3 * RETRY_DELAY),
+    ]
+
+    async def scenario():
+        # Stop the service, leave jobs behind as a crash would and start it again
+        await orchestrator.shutdown_jobs()
+        db = sqlite3.connect(orchestrator.JOBS_DB, isolation_level=None)
+        db.executemany(
+            "INSERT INTO jobs (id, status, code, attempts, created_at, next_attempt_at) VALUES (?, ?, ?, ?, ?, ?)", rows
+        )
+        db.close()
+        await orchestrator.startup_jobs()
+        await asyncio.sleep(RETRY_DELAY)
+        not_due = await orchestrator.get_job("waiting")
+        return not_due, {job_id: await finished(job_id) for job_id, *_ in rows}
+
+    not_due, recovered = run_service(scenario)
+    assert not_due["status"] == "queued"
+    assert recovered["interrupted"]["status"] == "done" and recovered["interrupted"]["attempts"] == 2
+    assert recovered["exhausted"]["status"] == "failed"
+    assert recovered["exhausted"]["error"] == "Interrupted by a restart"
+    assert recovered["waiting"]["status"] == "done"
+
+def test_full_queues_and_foreign_callbacks_are_refused(jobs, monkeypatch):
+    monkeypatch.setattr(orchestrator, "JOB_QUEUE_MAX", 1)
+
+    async def scenario():
+        for worker in orchestrator.job_workers:
+            worker.cancel()
+        await orchestrator.create_job("copied")
+        with pytest.raises(HTTPException) as full:
+            await orchestrator.create_job("copied")
+        with pytest.raises(HTTPException) as foreign:
+            await orchestrator.create_job("copied", callback_url="http://example.com/hook")
+        return full.value.status_code, foreign.value.status_code
+
+    assert run_service(scenario) == (429, 400)
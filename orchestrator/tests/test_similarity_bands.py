@@ -0,0 +1,51 @@
+"""Verdicts decided by similarity alone, with and without a lexical overlap from hybrid search."""
+
+import asyncio
+
+import pytest
+
+from orchestrator_helpers import orchestrator
+
+@pytest.fixture
+def bands(services, monkeypatch):
+    monkeypatch.setattr(orchestrator, "LLM_BYPASS_HIGH", 0.9)
+    monkeypatch.setattr(orchestrator, "LLM_BYPASS_LOW", 0.3)
+    monkeypatch.setattr(orchestrator, "LLM_BYPASS_MIN_OVERLAP", 0.5)
+    return services
+
+def check(code):
+    return asyncio.run(orchestrator.run_check(code))
+
+def match(score, overlap=None):
+    file_data = {"file_path": "course/student1.py", "similarity_score": score}
+    if overlap is not None:
+        file_data["lexical_overlap"] = overlap
+    return [file_data]
+
+def test_high_band_without_lexical_search_uses_similarity_alone(bands):
+    bands.results["copy"] = match(0.95)
+    verdict = check("copy")
+    assert verdict["plagiarism"] is True
+    assert verdict["decided_by"] == "similarity_high"
+    assert "token n-grams" not in verdict["llm_response"]
+    assert bands.llm_calls == []
+    assert orchestrator.decision_stats["high_without_overlap"] == 1
+
+def test_high_band_with_confirming_overlap(bands):
+    bands.results["copy"] = match(0.95, overlap=0.8)
+    verdict = check("copy")
+    assert verdict["decided_by"] == "similarity_high"
+    assert "80% of the code's token n-grams" in verdict["llm_response"]
+    assert orchestrator.decision_stats["high_without_overlap"] == 0
+
+def test_high_band_with_low_overlap_asks_the_llm(bands):
+    bands.results["renamed"] = match(0.95, overlap=0.1)
+    verdict = check("renamed")
+    assert verdict["decided_by"] == "llm"
+    assert bands.llm_calls == ["renamed"]
+    assert orchestrator.decision_stats["high_unverified"] == 1
+
+@pytest.mark.parametrize("score, decided_by", [(0.1, "similarity_low"), (0.6, "llm")])
+def test_low_and_middle_bands(bands, score, decided_by):
+    bands.results["code"] = match(score)
+    assert check("code")["decided_by"] == decided_by
@@ -0,0 +1,76 @@
+"""The /check verdict cache: raw and processed code keys, index versions, TTL and LRU eviction."""
+
+import asyncio
+
+import pytest
+
+from orchestrator_helpers import orchestrator
+
+CODE = "def add(a, b):\n    return a + b\n"
+
+@pytest.fixture
+def reference(services):
+    """Search results with a middle-band match, so every uncached check asks the LLM."""
+    services.results[CODE.strip()] = [{"file_path": "course/student1.py", "similarity_score": 0.7}]
+    return services
+
+def check(code):
+    return asyncio.run(orchestrator.run_check(code))
+
+def test_identical_resubmissions_call_no_service(reference):
+    first = check(CODE)
+    assert check(CODE) == first
+    assert len(reference.search_calls) == 1
+    assert len(reference.llm_calls) == 1
+    assert orchestrator.verdict_cache.stats["hits"] == 1
+
+def test_reformatted_resubmissions_skip_the_llm(reference):
+    first = check(CODE)
+    assert check("\n\n" + CODE + "   \n") == first
+    assert len(reference.search_calls) == 2
+    assert len(reference.llm_calls) == 1
+    # The reformatted submission is now an alias of the same verdict
+    check("\n\n" + CODE + "   \n")
+    assert len(reference.search_calls) == 2
+
+def test_a_new_index_version_invalidates_every_verdict(reference):
+    check(CODE)
+    reference.index_version = "v2"
+    check("\n" + CODE)  # Seen with the new version by the search
+    assert len(reference.llm_calls) == 2
+    assert orchestrator.verdict_cache.stats["invalidations"] == 1
+    # The alias cached before the change is gone; the search finds the verdict made against v2
+    check(CODE)
+    assert len(reference.search_calls) == 3
+    assert len(reference.llm_calls) == 2
+
+def test_failed_checks_are_not_cached(reference):
+    reference.search_error = RuntimeError("search API unavailable")
+    with pytest.raises(RuntimeError):
+        check(CODE)
+    reference.search_error = None
+    assert check(CODE)["decided_by"] == "llm"
+    assert len(reference.llm_calls) == 1
+
+def test_verdicts_computed_against_an_old_version_are_dropped():
+    cache = orchestrator.VerdictCache(10, 3600)
+    cache.set_index_version("v2")
+    cache.put("key", "raw", {"plagiarism": True}, "v1")
+    assert cache.get("key") is None
+    cache.put("key", "raw", {"plagiarism": True}, "v2")
+    assert cache.get_alias("raw") == {"plagiarism": True}
+
+def test_expired_and_least_recently_used_entries_are_evicted(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(orchestrator.time, "monotonic", lambda: now[0])
+    cache = orchestrator.VerdictCache(2, 60)
+    cache.set_index_version("v1")
+    for key in ("a", "b"):
+        cache.put(key, f"raw-{key}", {"key": key}, "v1")
+    cache.get("a")
+    cache.put("c", "raw-c", {"key": "c"}, "v1")
+    assert cache.get("b") is None
+    assert cache.stats["evictions"] == 1
+    now[0] += 61
+    assert cache.get("a") is None
+    assert cache.get_alias("raw-c") is None
@@ -9,12 +9,21 @@ This service:
 """
 
 import os
+import re
 import json
+import time
+import fcntl
+import base64
+import hashlib
+import struct
+import asyncio
 import numpy as np
-import requests
+import httpx
 import faiss
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import List, Dict
+from typing import List, Dict, Any, Optional, Tuple
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel
 
@@ -27,9 +36,105 @@ app = FastAPI(
 
 # Constants
 EMBEDDING_DIM = 768
-TOP_K = 3  # Number of similar files to return
+TOP_K = int(os.getenv("TOP_K", "3"))  # Default number of similar files to return; overridable per request
+MAX_TOP_K = int(os.getenv("MAX_TOP_K", "100"))  # Upper bound on top_k, and on range search results
+MIN_SIMILARITY = float(os.getenv("MIN_SIMILARITY", "-1"))  # Default similarity cutoff; -1 keeps every result
+SEARCH_BATCH_MAX_SIZE = int(os.getenv("SEARCH_BATCH_MAX_SIZE", "512"))  # Snippets accepted per /search_batch request
+
+# Pairwise comparison of submissions with each other (/pairwise). Each submission keeps its
+# PAIRWISE_NEIGHBORS nearest other submissions at or above PAIRWISE_MIN_SIMILARITY (cosine).
+PAIRWISE_MAX_SIZE = int(os.getenv("PAIRWISE_MAX_SIZE", "5000"))  # Snippets accepted per /pairwise request
+PAIRWISE_NEIGHBORS = int(os.getenv("PAIRWISE_NEIGHBORS", "10"))
+PAIRWISE_MIN_SIMILARITY = float(os.getenv("PAIRWISE_MIN_SIMILARITY", "0.95"))
+PAIRWISE_MAX_PAIRS = int(os.getenv("PAIRWISE_MAX_PAIRS", "200"))  # Default number of pairs returned
+
+# Chunk-level search: number of chunk hits retrieved per query chunk, how chunk
+# scores are aggregated per file ("max" or "sum" of the top CHUNK_TOP_M chunks)
+# and how many matching line ranges are reported per file
+CHUNK_CANDIDATES = int(os.getenv("CHUNK_CANDIDATES", "20"))
+CHUNK_AGGREGATION = os.getenv("CHUNK_AGGREGATION", "max")
+CHUNK_TOP_M = int(os.getenv("CHUNK_TOP_M", "3"))
+
+# Query-time knobs for approximate indexes; 0 uses the defaults saved in index_params.json.
+# Both can be overridden per request.
+SEARCH_NPROBE = int(os.getenv("SEARCH_NPROBE", "0"))  # IVF lists probed per query
+SEARCH_EF_SEARCH = int(os.getenv("SEARCH_EF_SEARCH", "0"))  # HNSW candidate list size
+
+# Exact re-ranking for approximate indexes: fetch RERANK_FACTOR * k candidates and
+# re-score them against the original vectors in embeddings.npy. 1 disables it;
+# can be overridden per request up to MAX_RERANK_FACTOR.
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", "1"))
+MAX_RERANK_FACTOR = int(os.getenv("MAX_RERANK_FACTOR", "32"))
 EMBEDDING_API_URL = "http://embedding_api:8002/embed"  # URL of the embedding API
 CODE_PROCESSOR_API_URL = "http://code_processor:8004/process"  # URL of the code processor API
+EMBEDDING_API_BATCH_URL = "http://embedding_api:8002/embed_batch"
+CODE_PROCESSOR_BATCH_URL = "http://code_processor:8004/process_batch"
+EMBEDDING_API_HEALTH_URL = "http://embedding_api:8002/health"
+CODE_PROCESSOR_HEALTH_URL = "http://code_processor:8004/health"
+
+# Binary embedding transport (see embedding_api): 16-byte header followed by the matrix
+EMBEDDING_MEDIA_TYPE = "application/x-embeddings"
+EMBEDDING_MAGIC = b"EMB1"
+EMBEDDING_HEADER = struct.Struct("<4sBxxxII")
+EMBEDDING_DTYPE_CODES = {0: "<f4", 1: "<f2"}
+EMBEDDING_TRANSPORT_DTYPE = os.getenv("EMBEDDING_TRANSPORT_DTYPE", "float32")  # float32 or float16
+
+# Upstream connection pool settings (one pooled client per upstream service)
+EMBEDDING_API_MAX_CONNECTIONS = int(os.getenv("EMBEDDING_API_MAX_CONNECTIONS", "32"))
+CODE_PROCESSOR_MAX_CONNECTIONS = int(os.getenv("CODE_PROCESSOR_MAX_CONNECTIONS", "32"))
+UPSTREAM_MAX_KEEPALIVE = int(os.getenv("UPSTREAM_MAX_KEEPALIVE", "16"))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", "5"))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", "30"))
+UPSTREAM_POOL_TIMEOUT = float(os.getenv("UPSTREAM_POOL_TIMEOUT", "10"))
+
+# Memory-map the FAISS index and embeddings instead of reading them into RAM, so
+# workers and containers on one host share the page cache
+INDEX_MMAP = os.getenv("INDEX_MMAP", "true").lower() == "true"
+
+# Seconds between checks for a newly written index; 0 disables the watcher
+# (POST /admin/reload_index still works)
+INDEX_RELOAD_INTERVAL = float(os.getenv("INDEX_RELOAD_INTERVAL", "30"))
+
+# Incremental updates: documents added or deleted through /documents are recorded in
+# an append-only log and folded into a new base index once the log holds
+# COMPACT_AFTER_RECORDS records (0 disables automatic compaction)
+COMPACT_AFTER_RECORDS = int(os.getenv("COMPACT_AFTER_RECORDS", "1000"))
+
+# Language shards: the indexer writes one index per language under embeddings/shards
+# and queries are routed to the shard of their language. With CROSS_LANGUAGE_FALLBACK
+# all shards are searched when the query's shard returns fewer than top_k files or its
+# best match scores below CROSS_LANGUAGE_MIN_SIMILARITY, so a wrong language guess
+# does not hide the real matches.
+CROSS_LANGUAGE_FALLBACK = os.getenv("CROSS_LANGUAGE_FALLBACK", "true").lower() == "true"
+CROSS_LANGUAGE_MIN_SIMILARITY = float(os.getenv("CROSS_LANGUAGE_MIN_SIMILARITY", "0.5"))
+
+# Hybrid lexical search: an inverted index of normalized token n-grams over processed_codefiles,
+# scored with BM25 and fused with the FAISS ranking by reciprocal rank fusion. Identifiers,
+# numbers and string literals are normalized, so copies with renamed identifiers still match.
+# Opt-in: it changes the /search ranking from FAISS order to the fused order.
+LEXICAL_SEARCH = os.getenv("LEXICAL_SEARCH", "false").lower() == "true"
+LEXICAL_NGRAM = int(os.getenv("LEXICAL_NGRAM", "5"))  # Tokens per n-gram
+LEXICAL_CANDIDATES = int(os.getenv("LEXICAL_CANDIDATES", "20"))  # Files taken from each ranking before fusion
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+RRF_K = int(os.getenv("RRF_K", "60"))  # Reciprocal rank fusion constant
+
+# Answer from the lexical hits alone, scored exactly against the query embedding but without a
+# FAISS search, when the best file of every query contains at least this fraction of the query's
+# n-grams; 0 disables
+LEXICAL_SHORTCUT_OVERLAP = float(os.getenv("LEXICAL_SHORTCUT_OVERLAP", "0"))
+
+# Tokens kept verbatim by the lexical tokenizer; other identifiers become ID
+LEXICAL_KEYWORDS = frozenset("""
+    abstract and as assert async await bool boolean break byte case catch char class const continue def default
+    del delete do double elif else enum except export extends false final finally float for from function global
+    goto if implements import in instanceof int interface is lambda let long new none nonlocal not null or pass
+    private protected public raise return self short signed sizeof static struct super switch template this
+    throw throws true try typedef typeof union unsigned var virtual void volatile while with yield
+""".split())
+
+# String literals, identifiers and keywords, numbers, and single punctuation characters
+LEXICAL_TOKEN_PATTERN = re.compile(r""""(?:\\.|[^"\\\n])*"|'(?:\\.|[^'\\\n])*'|[A-Za-z_]\w*|\d[\w.]*|\S""")
 
 # Path setup
 def get_root_dir():
@@ -40,54 +145,915 @@ def get_root_dir():
 # Paths
 ROOT_DIR = get_root_dir()
 EMBEDDINGS_DIR = Path("/app/shared/embeddings")
-FILE_PATHS_JSON = EMBEDDINGS_DIR / "file_paths.json"
-EMBEDDINGS_NPY = EMBEDDINGS_DIR / "embeddings.npy"
-FAISS_INDEX = EMBEDDINGS_DIR / "faiss_index.bin"
+SHARDS_DIR = EMBEDDINGS_DIR / "shards"  # One index directory per language when the indexer shards by language
+SHARDS_MANIFEST = SHARDS_DIR / "shards.json"  # Languages of the current shard set, written after the shards
+UNSHARDED = "all"  # Shard name of an index written directly to EMBEDDINGS_DIR
+
+# Files of one index, relative to its directory (EMBEDDINGS_DIR or a shard directory)
+FILE_PATHS_JSON = "file_paths.json"
+EMBEDDINGS_NPY = "embeddings.npy"
+FAISS_INDEX = "faiss_index.bin"
+CHUNKS_JSON = "chunks.json"  # Only present for chunk-level indexes
+INDEX_PARAMS_JSON = "index_params.json"  # Build parameters written by the indexer
+UPDATES_LOG = "updates.log"  # Append-only log of incremental adds and deletes
+UPDATES_LOCK = ".updates.lock"  # flock()ed by every worker while it appends to, replays or compacts the log
+PROCESSED_CODEFILES_DIR = Path("/app/shared/processed_codefiles")
+
+# Normalize code into lexical tokens
+def lexical_tokens(code: str) -> List[str]:
+    """Split code into tokens, replacing identifiers, numbers and string literals by placeholders.
+    
+    Keywords and punctuation are kept, so the token stream keeps the structure of
+    the code but not its names.
+    """
+    tokens = []
+    for token in LEXICAL_TOKEN_PATTERN.findall(code):
+        if token[0] in "\"'":
+            tokens.append("STR")
+        elif token[0].isdigit():
+            tokens.append("NUM")
+        elif token[0].isalpha() or token[0] == "_":
+            tokens.append(token if token.lower() in LEXICAL_KEYWORDS else "ID")
+        else:
+            tokens.append(token)
+    return tokens
+
+def lexical_ngrams(code: str) -> Dict[int, int]:
+    """Return the hashed LEXICAL_NGRAM-token n-grams of code with their counts."""
+    tokens = lexical_tokens(code)
+    counts = {}
+    for i in range(max(len(tokens) - LEXICAL_NGRAM + 1, 1 if tokens else 0)):
+        # Stable across processes and restarts, unlike the salted builtin hash()
+        gram = int.from_bytes(
+            hashlib.blake2b("\x1f".join(tokens[i:i + LEXICAL_NGRAM]).encode("utf-8"), digest_size=8).digest(), "little"
+        )
+        counts[gram] = counts.get(gram, 0) + 1
+    return counts
+
+class LexicalIndex:
+    """BM25 inverted index of normalized token n-grams over the documents of one shard.
+    
+    Documents are numbered in insertion order. Removed documents keep their
+    postings until the next rebuild but are masked out of results and statistics.
+    Added documents are collected in Python lists and merged into the posting
+    arrays by flush(), once per batch of adds rather than once per add.
+    """
+    def __init__(self):
+        self.doc_ids = []  # slot -> doc_id
+        self.slots = {}  # doc_id -> slot of its current version
+        self.lengths = np.zeros(0, dtype="float32")  # n-grams per slot
+        self.alive = np.zeros(0, dtype=bool)
+        self.total_length = 0
+        self.postings = {}  # n-gram -> (slots, counts) arrays
+        self.pending = {}  # n-gram -> ([slots], [counts]) added since the last flush
+        self.pending_lengths = []  # n-grams per slot added since the last flush
+    
+    @property
+    def n_documents(self) -> int:
+        return len(self.slots)
+    
+    @classmethod
+    def build(cls, documents: Dict[str, str]) -> "LexicalIndex":
+        """Index many documents at once, converting the postings to arrays once at the end."""
+        lexical = cls()
+        for doc_id, code in documents.items():
+            lexical.add(doc_id, code)
+        lexical.flush()
+        return lexical
+    
+    def add(self, doc_id: str, code: str):
+        """Index (or re-index) one document; it is searchable after the next flush()."""
+        self.remove(doc_id)
+        grams = lexical_ngrams(code)
+        slot = len(self.doc_ids)
+        self.doc_ids.append(doc_id)
+        self.slots[doc_id] = slot
+        length = sum(grams.values())
+        self.pending_lengths.append(length)
+        self.total_length += length
+        for gram, count in grams.items():
+            posting = self.pending.setdefault(gram, ([], []))
+            posting[0].append(slot)
+            posting[1].append(count)
+    
+    def flush(self):
+        """Merge the documents added since the last flush into the posting arrays."""
+        if not self.pending_lengths:
+            return
+        # Slot arrays grow before the postings that refer to them, for searches running in a worker thread
+        self.lengths = np.concatenate([self.lengths, np.array(self.pending_lengths, dtype="float32")])
+        self.alive = np.concatenate([self.alive, np.ones(len(self.pending_lengths), dtype=bool)])
+        for gram, (slots, counts) in self.pending.items():
+            added = (np.array(slots, dtype="int64"), np.array(counts, dtype="float32"))
+            posting = self.postings.get(gram)
+            self.postings[gram] = added if posting is None else (
+                np.concatenate([posting[0], added[0]]), np.concatenate([posting[1], added[1]])
+            )
+        self.pending, self.pending_lengths = {}, []
+    
+    def remove(self, doc_id: str):
+        """Mask a document out of search results."""
+        slot = self.slots.pop(doc_id, None)
+        if slot is not None:
+            if slot >= len(self.alive):
+                self.flush()
+            self.alive[slot] = False
+            self.total_length -= int(self.lengths[slot])
+    
+    def search(self, grams: Dict[int, int], k: int) -> List[Tuple[str, float, float]]:
+        """Return up to k (doc_id, BM25 score, overlap) triples for a query's n-grams, best first.
+        
+        overlap is the fraction of the query's n-grams that occur in the document.
+        """
+        if not grams or not self.slots:
+            return []
+        n_documents = self.n_documents
+        # Slots flushed before this search started; a concurrent flush may add more
+        alive = self.alive
+        n_slots = len(alive)
+        lengths = self.lengths[:n_slots]
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * lengths / max(self.total_length / n_documents, 1.0))
+        scores = np.zeros(n_slots, dtype="float32")
+        matched = np.zeros(n_slots, dtype="float32")
+        for gram, query_count in grams.items():
+            posting = self.postings.get(gram)
+            if posting is None:
+                continue
+            slots, counts = posting
+            if len(slots) and slots[-1] >= n_slots:
+                slots, counts = slots[slots < n_slots], counts[slots < n_slots]
+            idf = np.log(1 + (n_documents - len(slots) + 0.5) / (len(slots) + 0.5))
+            scores[slots] += idf * counts * (BM25_K1 + 1) / (counts + norm[slots])
+            matched[slots] += np.minimum(counts, query_count)
+        scores[~alive] = 0
+        
+        top = np.argsort(-scores, kind="stable")[:k]
+        top = top[scores[top] > 0]
+        total = sum(grams.values())
+        return [(self.doc_ids[slot], float(scores[slot]), float(matched[slot] / total)) for slot in top]
+
+# Read a processed code file
+def read_processed_file(doc_id: str) -> Optional[str]:
+    """Return the processed code of a document, or None if the file is missing or unreadable."""
+    try:
+        return (PROCESSED_CODEFILES_DIR / doc_id).read_text(encoding='utf-8')
+    except (OSError, UnicodeDecodeError):
+        return None
+
+class IndexSnapshot:
+    """One loaded version of the index and its metadata.
+    
+    Reloads build a new snapshot and swap it in as a whole; requests hold on to the
+    snapshot they started with, so in-flight searches finish on the old version.
+    """
+    def __init__(self, language: str, directory: Path, version: str, signature, index, file_paths: List[str],
+                 embeddings: np.ndarray, chunk_map: Optional[np.ndarray], index_params: Dict):
+        self.language = language  # Shard name; UNSHARDED for a single index over all languages
+        self.directory = directory  # Directory holding the index files and update log
+        self.version = version
+        self.signature = signature  # File signature the snapshot was loaded from
+        self.index = index
+        self.file_paths = file_paths
+        self.embeddings = embeddings  # Read-only memory map of embeddings.npy; pages are only read when touched
+        self.chunk_map = chunk_map  # (n_vectors, 3) array of file index, start line, end line; None for file-level indexes
+        self.index_params = index_params
+        self.loaded_at = time.time()
+        self.path_index = {path: i for i, path in enumerate(file_paths)}
+        
+        # Incremental updates on top of the base index, replayed from the update log.
+        # Added vectors live in an ID-mapped flat index with ids after the base rows;
+        # deleted base rows are excluded from base searches with an ID selector.
+        metric = faiss.METRIC_INNER_PRODUCT if self.is_cosine() else faiss.METRIC_L2
+        self.delta_index = faiss.IndexIDMap2(faiss.IndexFlat(index.d, metric))
+        self.delta_rows = {}  # vector id -> (doc_id, start_line, end_line)
+        self.delta_docs = {}  # doc_id -> vector ids in delta_index, in insertion order
+        self.deleted_docs = set()  # Base documents deleted or replaced since the base was built
+        self.tombstones = np.zeros(0, dtype="int64")  # Base rows excluded from search
+        self.base_selector = None
+        self.next_id = index.ntotal
+        self.log_inode = None  # Update log file and read position
+        self.log_offset = 0
+        self.log_records = 0
+        self.lexical: Optional[LexicalIndex] = None  # Token n-gram index of the same documents, if LEXICAL_SEARCH
+    
+    def is_cosine(self) -> bool:
+        """Return True if the index holds L2-normalized vectors searched by inner product."""
+        return self.index_params.get("metric") == "cosine"
+    
+    def is_approximate(self) -> bool:
+        """Return True if base search results can differ from an exact search."""
+        return not isinstance(self.index, faiss.IndexFlat)
+    
+    @property
+    def ntotal(self) -> int:
+        """Number of searchable vectors, including incremental updates."""
+        return self.index.ntotal - len(self.tombstones) + self.delta_index.ntotal
+    
+    @property
+    def content_version(self) -> str:
+        """Version of the searchable content: the base version plus the number of updates applied on top."""
+        return f"{self.version}+{self.log_records}" if self.log_records else self.version
+    
+    @property
+    def n_documents(self) -> int:
+        """Number of searchable documents, including incremental updates."""
+        return len(self.file_paths) - len(self.deleted_docs) + len(self.delta_docs)
+    
+    def has_document(self, doc_id: str) -> bool:
+        """Return True if doc_id is currently searchable."""
+        return doc_id in self.delta_docs or (doc_id in self.path_index and doc_id not in self.deleted_docs)
+    
+    def base_rows(self, file_idx: int) -> np.ndarray:
+        """Base index rows holding the vectors of one base document."""
+        if self.chunk_map is None:
+            return np.array([file_idx], dtype="int64")
+        return np.flatnonzero(self.chunk_map[:, 0] == file_idx).astype("int64")
+    
+    def document_ids(self, doc_id: str) -> np.ndarray:
+        """Vector ids of a searchable document (base rows or delta ids); empty if it is not indexed."""
+        if doc_id in self.delta_docs:
+            return np.array(self.delta_docs[doc_id], dtype="int64")
+        if doc_id in self.path_index and doc_id not in self.deleted_docs:
+            return self.base_rows(self.path_index[doc_id])
+        return np.zeros(0, dtype="int64")
+    
+    def remove_document(self, doc_id: str) -> bool:
+        """Remove a document's vectors from search. Returns False if it was not indexed."""
+        removed = False
+        if doc_id in self.delta_docs:
+            ids = np.array(self.delta_docs.pop(doc_id), dtype="int64")
+            self.delta_index.remove_ids(ids)
+            for vector_id in ids:
+                del self.delta_rows[int(vector_id)]
+            removed = True
+        if doc_id in self.path_index and doc_id not in self.deleted_docs:
+            self.deleted_docs.add(doc_id)
+            self.tombstones = np.concatenate([self.tombstones, self.base_rows(self.path_index[doc_id])])
+            self.base_selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(self.tombstones))
+            removed = True
+        if self.lexical is not None:
+            self.lexical.remove(doc_id)
+        return removed
+    
+    def add_document(self, doc_id: str, vectors: np.ndarray, spans: Optional[List[List[int]]] = None):
+        """Add (or replace) a document's vectors; spans are the chunk line ranges for chunk-level indexes."""
+        self.remove_document(doc_id)
+        ids = np.arange(self.next_id, self.next_id + len(vectors), dtype="int64")
+        self.next_id += len(vectors)
+        self.delta_index.add_with_ids(np.ascontiguousarray(vectors, dtype="float32"), ids)
+        for i, vector_id in enumerate(ids):
+            start_line, end_line = spans[i] if spans else (0, 0)
+            self.delta_rows[int(vector_id)] = (doc_id, start_line, end_line)
+        self.delta_docs[doc_id] = ids.tolist()
+    
+    def apply_update(self, record: Dict):
+        """Apply one update log record."""
+        if record["op"] == "add":
+            vectors = np.frombuffer(base64.b64decode(record["vectors"]), dtype="<f4").reshape(-1, self.index.d)
+            self.add_document(record["doc_id"], vectors, record.get("spans"))
+            # /documents saves the processed code before logging the add
+            code = read_processed_file(record["doc_id"]) if self.lexical is not None else None
+            if code is not None:
+                self.lexical.add(record["doc_id"], code)
+        elif record["op"] == "delete":
+            self.remove_document(record["doc_id"])
+        self.log_records += 1
+    
+    def search(self, queries: np.ndarray, k: int, params=None):
+        """Search the base index (minus deleted rows) and the delta index, merged per query.
+        
+        Returns (distances, vector ids) like faiss; resolve ids with resolve().
+        """
+        results = []
+        for index, index_params in ((self.index, params), (self.delta_index, None)):
+            # An empty base (every document deleted and compacted) cannot be searched
+            if index.ntotal:
+                results.append(index.search(queries, min(k, index.ntotal), params=index_params))
+        if not results:
+            return np.zeros((len(queries), 0), dtype="float32"), np.zeros((len(queries), 0), dtype="int64")
+        if len(results) == 1:
+            return results[0]
+        distances, ids = np.hstack([r[0] for r in results]), np.hstack([r[1] for r in results])
+        order = np.argsort(-distances if self.is_cosine() else distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    
+    def exact_distances(self, queries: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """Exact distances (inner product or squared L2) between each query row and its candidate ids.
+        
+        Base vectors are read from the memory-mapped embeddings, so only the
+        candidates' pages are touched. Missing (-1) ids get the worst distance.
+        """
+        exact = np.full(ids.shape, -np.inf if self.is_cosine() else np.inf, dtype="float32")
+        for q in range(len(queries)):
+            base = (ids[q] >= 0) & (ids[q] < self.index.ntotal)
+            delta = ids[q] >= self.index.ntotal
+            for mask, vectors in (
+                (base, lambda rows: np.asarray(self.embeddings[rows], dtype="float32")),
+                (delta, self.delta_index.reconstruct_batch)
+            ):
+                if not mask.any():
+                    continue
+                candidates = vectors(ids[q][mask])
+                if self.is_cosine():
+                    exact[q][mask] = candidates @ queries[q]
+                else:
+                    exact[q][mask] = np.sum((candidates - queries[q]) ** 2, axis=1)
+        return exact
+    
+    def rerank(self, queries: np.ndarray, ids: np.ndarray, k: int):
+        """Re-score candidate ids exactly and return the best k (distances, ids) per query."""
+        exact = self.exact_distances(queries, ids)
+        order = np.argsort(-exact if self.is_cosine() else exact, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(exact, order, axis=1), np.take_along_axis(ids, order, axis=1)
+    
+    def range_search(self, queries: np.ndarray, radius: float, params=None):
+        """Return every vector within radius of each query, from the base and delta indexes.
+        
+        radius is in FAISS distance units (inner product for cosine, squared L2
+        otherwise). Returns one (distances, vector ids) pair per query, best first.
+        """
+        results = [[] for _ in range(len(queries))]
+        for index, index_params in ((self.index, params), (self.delta_index, None)):
+            if not index.ntotal:
+                continue
+            lims, distances, ids = index.range_search(queries, radius, params=index_params)
+            for q in range(len(queries)):
+                results[q].append((distances[lims[q]:lims[q + 1]], ids[lims[q]:lims[q + 1]]))
+        
+        merged = []
+        for parts in results:
+            distances = np.concatenate([d for d, _ in parts]) if parts else np.zeros(0, dtype="float32")
+            ids = np.concatenate([i for _, i in parts]) if parts else np.zeros(0, dtype="int64")
+            order = np.argsort(-distances if self.is_cosine() else distances, kind="stable")
+            merged.append((distances[order], ids[order]))
+        return merged
+    
+    def resolve(self, vector_id: int) -> Tuple[str, int, int]:
+        """Return (file path, start line, end line) of a vector; lines are 0 for file-level indexes."""
+        if vector_id >= self.index.ntotal:
+            return self.delta_rows[int(vector_id)]
+        if self.chunk_map is None:
+            return self.file_paths[vector_id], 0, 0
+        file_idx, start_line, end_line = self.chunk_map[vector_id]
+        return self.file_paths[file_idx], int(start_line), int(end_line)
 
-# Load file paths, embeddings and FAISS index at startup
-file_paths = []
-index = None
+# Index snapshots serving requests, one per language shard, loaded at startup. Reloads
+# build a new dict and swap it in whole, so a request pins every shard with one read.
+shards: Dict[str, IndexSnapshot] = {}
+reload_lock: asyncio.Lock = None  # Serializes reloads, updates and compaction; at most two versions are resident
+reload_task: asyncio.Task = None
+compaction_task: asyncio.Task = None
+last_reload_error: Optional[str] = None
+failed_signatures: Dict[str, tuple] = {}  # Shard files that last failed to load, not retried until they change
+
+# Re-ranking statistics since startup, reported by /metrics
+rerank_stats = {"queries": 0, "rerank_ms": 0.0, "changed": 0}
+
+# Shard routing statistics since startup, reported by /metrics
+routing_stats = {"queries": 0, "vectors_searched": 0, "fallbacks": 0, "unrouted": 0, "shards": {}}
+
+# Language detection rules of the current shard set, saved by the indexer in SHARDS_MANIFEST,
+# so queries are routed by the same rules that assigned files to shards
+language_rules: Dict[str, Any] = {"extensions": {}, "markers": [], "patterns": {}}
+
+# Hybrid lexical search statistics since startup, reported by /metrics
+lexical_stats = {"queries": 0, "lexical_ms": 0.0, "shortcuts": 0, "rescued": 0}
+
+# Long-lived async HTTP clients, created on startup and closed on shutdown
+embedding_client: httpx.AsyncClient = None
+code_processor_client: httpx.AsyncClient = None
+
+def create_upstream_client(max_connections: int) -> httpx.AsyncClient:
+    """Create a pooled async HTTP client with keep-alive for one upstream service."""
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=min(UPSTREAM_MAX_KEEPALIVE, max_connections),
+        ),
+        timeout=httpx.Timeout(
+            UPSTREAM_READ_TIMEOUT,
+            connect=UPSTREAM_CONNECT_TIMEOUT,
+            pool=UPSTREAM_POOL_TIMEOUT,
+        ),
+        headers={"Content-Type": "application/json"},
+    )
 
 # Input and output models
 class CodeRequest(BaseModel):
     code: str
+    nprobe: Optional[int] = None  # IVF indexes only
+    ef_search: Optional[int] = None  # HNSW indexes only
+    top_k: Optional[int] = None  # Files to return, at most MAX_TOP_K (default TOP_K)
+    min_similarity: Optional[float] = None  # Drop matches scoring below this (default MIN_SIMILARITY)
+    range_search: bool = False  # Return every file scoring at least min_similarity, up to top_k or MAX_TOP_K
+    rerank_factor: Optional[int] = None  # Re-rank rerank_factor * k candidates exactly (default RERANK_FACTOR)
+    language: Optional[str] = None  # Shard to search, by name or file extension; detected from the code if omitted
+    cross_language: bool = False  # Search every language shard
+
+class ChunkMatch(BaseModel):
+    start_line: int  # Line range in the reference file (1-based, inclusive)
+    end_line: int
+    query_start_line: int  # Line range in the processed query code
+    query_end_line: int
+    similarity_score: float
 
 class SimilarFile(BaseModel):
     file_path: str
     similarity_score: float
+    matches: List[ChunkMatch] = []  # Best-matching line ranges, chunk-level indexes only
+    lexical_score: Optional[float] = None  # BM25 score of the file's token n-grams, hybrid search only
+    lexical_overlap: Optional[float] = None  # Fraction of the query's token n-grams found in the file
+    fusion_score: Optional[float] = None  # Reciprocal rank fusion score results are ordered by
 
 class SimilarFilesResponse(BaseModel):
     similar_files: List[SimilarFile]
     processed_code: str
+    index_version: Optional[str] = None  # Index version searched; changes with every reload and document update
 
-# Load the model and tokenizer
+class BatchCodeRequest(BaseModel):
+    code_snippets: Dict[str, str]  # key: query id, value: code
+    nprobe: Optional[int] = None  # IVF indexes only
+    ef_search: Optional[int] = None  # HNSW indexes only
+    top_k: Optional[int] = None
+    min_similarity: Optional[float] = None
+    range_search: bool = False
+    rerank_factor: Optional[int] = None
+    language: Optional[str] = None  # Applies to every snippet; detected per snippet if omitted
+    cross_language: bool = False
+
+# Resolved per-request search options
+class SearchOptions(BaseModel):
+    top_k: int
+    min_similarity: float
+    range_search: bool
+    rerank_factor: int
+    nprobe: Optional[int] = None
+    ef_search: Optional[int] = None
+
+class BatchSearchResult(SimilarFilesResponse):
+    error: Optional[str] = None  # Set when this snippet could not be searched
+
+class BatchSearchResponse(BaseModel):
+    results: Dict[str, BatchSearchResult]  # key: query id
+    index_version: Optional[str] = None  # Index version searched, as in SimilarFilesResponse
+
+class PairwiseRequest(BaseModel):
+    code_snippets: Dict[str, str]  # key: submission id, value: code
+    neighbors: Optional[int] = None  # Nearest other submissions considered per submission
+    min_similarity: Optional[float] = None  # Cosine similarity at which a pair is suspicious
+    max_pairs: Optional[int] = None  # Pairs returned, most similar first; clusters use every suspicious pair
+
+class SubmissionPair(BaseModel):
+    a: str
+    b: str
+    similarity: float  # Cosine similarity of the two submissions' embeddings
+    lexical_overlap: float  # Fraction of the smaller submission's token n-grams found in the other
+
+class SubmissionCluster(BaseModel):
+    members: List[str]
+    pairs: int  # Suspicious pairs within the cluster
+    max_similarity: float
+    mean_similarity: float
+
+class PairwiseResponse(BaseModel):
+    submissions: int  # Submissions compared
+    suspicious_pairs: int  # Pairs at or above min_similarity, before max_pairs
+    pairs: List[SubmissionPair]
+    clusters: List[SubmissionCluster]  # Connected groups of suspicious pairs, largest first
+    errors: Dict[str, str] = {}  # Submissions that could not be compared
+
+class DocumentRequest(BaseModel):
+    doc_id: str  # Path relative to processed_codefiles, as returned in search results
+    code: str
+
+# Create the upstream HTTP clients
 @app.on_event("startup")
-async def startup_load_index():
-    """Load the FAISS index and file paths on startup."""
-    global index, file_paths, embeddings
+async def startup_http_clients():
+    """Create the pooled HTTP clients used to call the code processor and embedding APIs."""
+    global embedding_client, code_processor_client
     
-    print("Loading FAISS index and file paths...")
-    if not FAISS_INDEX.exists() or not FILE_PATHS_JSON.exists() or not EMBEDDINGS_NPY.exists():
+    embedding_client = create_upstream_client(EMBEDDING_API_MAX_CONNECTIONS)
+    code_processor_client = create_upstream_client(CODE_PROCESSOR_MAX_CONNECTIONS)
+
+@app.on_event("shutdown")
+async def shutdown_http_clients():
+    """Close the pooled HTTP clients."""
+    for client in (embedding_client, code_processor_client):
+        if client is not None:
+            await client.aclose()
+
+# Open the FAISS index file
+def read_faiss_index(path: Path, index_type: str):
+    """Read a FAISS index, memory-mapped and read-only when INDEX_MMAP is enabled.
+
+    Flat and HNSW indexes are mapped in place (IO_FLAG_MMAP_IFC). IVF indexes map
+    their inverted lists instead (IO_FLAG_MMAP), since FAISS cannot combine both
+    for them. Falls back to a full read if the index cannot be mapped.
+    """
+    if not INDEX_MMAP:
+        return faiss.read_index(str(path))
+    
+    in_place = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+    if index_type.startswith("ivf") or in_place is None:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    else:
+        flags = in_place | faiss.IO_FLAG_READ_ONLY
+    try:
+        return faiss.read_index(str(path), flags)
+    except RuntimeError as e:
+        print(f"Could not memory-map FAISS index, reading it into memory: {str(e)}")
+        return faiss.read_index(str(path))
+
+# Fingerprint of the index files on disk
+def index_signature(directory: Path):
+    """Return (mtime_ns, size) of an index's files, used to detect a newly written index."""
+    signature = []
+    for name in (FAISS_INDEX, FILE_PATHS_JSON, EMBEDDINGS_NPY, CHUNKS_JSON, INDEX_PARAMS_JSON):
+        try:
+            stat = (directory / name).stat()
+            signature.append((stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append(None)
+    return tuple(signature)
+
+# Find the index directories written by the indexer
+def discover_shards() -> Dict[str, Path]:
+    """Return the index directory of each shard.
+    
+    Language shards listed in SHARDS_MANIFEST take precedence; without them the
+    index in EMBEDDINGS_DIR is served as the single shard UNSHARDED. The manifest's
+    language detection rules replace language_rules.
+    """
+    global language_rules
+    
+    try:
+        with open(SHARDS_MANIFEST, 'r') as f:
+            manifest = json.load(f)
+        languages = manifest["languages"]
+    except FileNotFoundError:
+        languages = []
+    except (ValueError, KeyError) as e:
+        raise RuntimeError(f"Unreadable shard manifest {SHARDS_MANIFEST}: {str(e)}")
+    if languages:
+        if "patterns" not in manifest and not language_rules["patterns"]:
+            print(f"WARNING: {SHARDS_MANIFEST} has no language detection rules; re-run generate_embeddings.py "
+                  f"to route queries without a language to their shard")
+        language_rules = {key: manifest.get(key, default) for key, default in language_rules.items()}
+        return {language: SHARDS_DIR / language for language in languages}
+    return {UNSHARDED: EMBEDDINGS_DIR}
+
+# Load and validate one version of the index
+def load_index_snapshot(language: str = UNSHARDED, directory: Path = EMBEDDINGS_DIR) -> IndexSnapshot:
+    """Load the FAISS index, file paths, embeddings and chunk map of one shard into a new snapshot.
+    
+    Raises RuntimeError if the files are missing, inconsistent with each other, or
+    were rewritten while they were being read.
+    """
+    if not (directory / FAISS_INDEX).exists() or not (directory / FILE_PATHS_JSON).exists() or not (directory / EMBEDDINGS_NPY).exists():
         raise RuntimeError(
-            "FAISS index, file paths, or embeddings not found! "
+            f"FAISS index, file paths, or embeddings not found in {directory}! "
             "Please run generate_embeddings.py first."
         )
+    signature = index_signature(directory)
     
     # Load file paths
-    with open(FILE_PATHS_JSON, 'r') as f:
+    with open(directory / FILE_PATHS_JSON, 'r') as f:
         file_paths = json.load(f)
     
-    # Load embeddings
-    embeddings = np.load(EMBEDDINGS_NPY)
+    # Map the embeddings; nothing is read from disk until a row is accessed
+    embeddings = np.load(directory / EMBEDDINGS_NPY, mmap_mode='r' if INDEX_MMAP else None)
+    
+    # Load the index build parameters
+    index_params = {"index_type": "flat"}
+    if (directory / INDEX_PARAMS_JSON).exists():
+        with open(directory / INDEX_PARAMS_JSON, 'r') as f:
+            index_params = json.load(f)
     
     # Load FAISS index
-    index = faiss.read_index(str(FAISS_INDEX))
+    index = read_faiss_index(directory / FAISS_INDEX, index_params["index_type"])
+    
+    # Load the chunk map of chunk-level indexes
+    chunk_map = None
+    if (directory / CHUNKS_JSON).exists():
+        with open(directory / CHUNKS_JSON, 'r') as f:
+            chunk_map = np.array(json.load(f), dtype="int64").reshape(-1, 3)
+    
+    if index_signature(directory) != signature:
+        raise RuntimeError("Index files changed while loading; the indexer is probably still writing them")
+    
+    # Validate that the files belong to the same build
+    if index.d != EMBEDDING_DIM:
+        raise RuntimeError(f"FAISS index has dimension {index.d}, expected {EMBEDDING_DIM}")
+    if embeddings.shape != (index.ntotal, index.d):
+        raise RuntimeError(f"Embeddings have shape {embeddings.shape} but the FAISS index has {index.ntotal} vectors of dimension {index.d}")
+    if index_params.get("ntotal", index.ntotal) != index.ntotal:
+        raise RuntimeError(f"index_params.json records {index_params['ntotal']} vectors but the FAISS index has {index.ntotal}")
+    if chunk_map is None and index.ntotal != len(file_paths):
+        raise RuntimeError(f"FAISS index has {index.ntotal} vectors but there are {len(file_paths)} file paths")
+    if chunk_map is not None:
+        if len(chunk_map) != index.ntotal:
+            raise RuntimeError(
+                f"Chunk map has {len(chunk_map)} entries but the FAISS index has {index.ntotal} vectors. "
+                "Please re-run generate_embeddings.py."
+            )
+        if len(chunk_map) and chunk_map[:, 0].max() >= len(file_paths):
+            raise RuntimeError(f"Chunk map refers to files beyond the {len(file_paths)} file paths")
+    
+    version = index_params.get("version") or str(signature[0][0])
+    snapshot = IndexSnapshot(language, directory, version, signature, index, file_paths, embeddings, chunk_map, index_params)
+    
+    # Index the token n-grams of the same files for hybrid search
+    if LEXICAL_SEARCH:
+        documents = {path: read_processed_file(path) for path in file_paths}
+        missing = [path for path, code in documents.items() if code is None]
+        if missing:
+            print(f"WARNING: {len(missing)} indexed files are missing from {PROCESSED_CODEFILES_DIR}; they are only searched by embedding")
+        snapshot.lexical = LexicalIndex.build({path: code for path, code in documents.items() if code is not None})
+    
+    # Replay incremental updates made since the base was built
+    fd = os.open(directory / UPDATES_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        replay_update_log(snapshot)
+    finally:
+        os.close(fd)
+    return snapshot
+
+def check_shards(layout: Dict[str, IndexSnapshot]):
+    """Raise RuntimeError unless all shards share a metric and granularity.
+    
+    Queries are embedded once and searched in several shards, so every shard
+    must expect the same query vectors.
+    """
+    kinds = {(snapshot.is_cosine(), snapshot.chunk_map is not None) for snapshot in layout.values()}
+    if len(kinds) > 1:
+        raise RuntimeError("Shards mix metrics or file- and chunk-level indexes; re-run generate_embeddings.py")
+
+# Incremental update log
+@asynccontextmanager
+async def shard_lock(directory: Path):
+    """Hold an exclusive flock on a shard's update log lock file.
+    
+    reload_lock only serializes one worker; this lock also keeps the other workers
+    from appending to the log while it is folded into a new base and emptied.
+    The lock is taken in a worker thread so a long compaction elsewhere does not
+    block the event loop.
+    """
+    fd = os.open(directory / UPDATES_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    acquired = asyncio.get_running_loop().run_in_executor(None, fcntl.flock, fd, fcntl.LOCK_EX)
+    try:
+        await asyncio.shield(acquired)
+        yield
+    finally:
+        # Closing the descriptor releases the lock; wait for a pending flock first
+        if acquired.done():
+            os.close(fd)
+        else:
+            acquired.add_done_callback(lambda _: os.close(fd))
+
+def replay_update_log(snapshot: IndexSnapshot):
+    """Apply update log records the snapshot has not seen yet.
     
-    print(f"Successfully loaded {len(file_paths)} file paths and FAISS index with {index.ntotal} vectors")
+    Records are JSON lines. Replaying is idempotent (adds replace, deletes of missing
+    documents are no-ops), so a log written against an older base is safe to replay.
+    A trailing partial line is left for the next call.
+    """
+    log_path = snapshot.directory / UPDATES_LOG
+    try:
+        stat = log_path.stat()
+    except FileNotFoundError:
+        return
+    if stat.st_ino != snapshot.log_inode or stat.st_size < snapshot.log_offset:
+        snapshot.log_inode, snapshot.log_offset = stat.st_ino, 0
+    if stat.st_size == snapshot.log_offset:
+        return
+    
+    with open(log_path, 'rb') as f:
+        f.seek(snapshot.log_offset)
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]
+    for line in complete.splitlines():
+        if not line.strip():
+            continue
+        try:
+            snapshot.apply_update(json.loads(line))
+        except (ValueError, KeyError) as e:
+            print(f"WARNING: Skipping unreadable update log record: {str(e)}")
+    snapshot.log_offset += len(complete)
+    # One merge of the lexical postings for all records replayed
+    if snapshot.lexical is not None:
+        snapshot.lexical.flush()
+
+def append_update_log(snapshot: IndexSnapshot, record: Dict):
+    """Durably append one record to the update log of the snapshot's shard; hold shard_lock around it."""
+    with open(snapshot.directory / UPDATES_LOG, 'a+b') as f:
+        # Terminate a partial line left by a crash so this record stays readable
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+        f.write(json.dumps(record).encode("utf-8") + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def replace_file(path: Path, write):
+    """Write a file through a temporary sibling and rename it into place, leaving mapped readers on the old file."""
+    tmp_path = path.with_name(f".tmp-{path.name}")
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+def save_json(path: Path, data, indent=None):
+    """Atomically write data to path as JSON."""
+    def write(tmp_path):
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, indent=indent)
+    replace_file(path, write)
+
+# Fold incremental updates into a new base index
+def write_compacted_index(snapshot: IndexSnapshot):
+    """Write the snapshot's searchable documents as a new base index and empty the update log.
+    
+    The base index file is re-read into memory and refilled, which keeps the trained
+    IVF/PQ quantizers and HNSW settings without retraining.
+    """
+    keep = np.setdiff1d(np.arange(snapshot.index.ntotal, dtype="int64"), snapshot.tombstones)
+    delta_ids = np.array([i for ids in snapshot.delta_docs.values() for i in ids], dtype="int64")
+    vectors = np.vstack([
+        np.asarray(snapshot.embeddings[keep], dtype="float32"),
+        snapshot.delta_index.reconstruct_batch(delta_ids) if len(delta_ids) else np.zeros((0, snapshot.index.d), dtype="float32")
+    ])
+    
+    file_paths, file_index, chunk_map = [], {}, []
+    for vector_id in np.concatenate([keep, delta_ids]):
+        doc_id, start_line, end_line = snapshot.resolve(int(vector_id))
+        if doc_id not in file_index:
+            file_index[doc_id] = len(file_paths)
+            file_paths.append(doc_id)
+        chunk_map.append([file_index[doc_id], start_line, end_line])
+    
+    directory = snapshot.directory
+    index = faiss.read_index(str(directory / FAISS_INDEX))
+    index.reset()
+    index.add(vectors)
+    
+    index_params = dict(snapshot.index_params)
+    index_params.update({
+        "ntotal": index.ntotal,
+        "version": datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ"),
+        "compacted_from": snapshot.version
+    })
+    
+    # Same write order as the indexer: parameters (with the version) last
+    save_json(directory / FILE_PATHS_JSON, file_paths, indent=2)
+    if snapshot.chunk_map is not None:
+        save_json(directory / CHUNKS_JSON, chunk_map)
+    replace_file(directory / EMBEDDINGS_NPY, lambda tmp_path: np.save(tmp_path, vectors))
+    replace_file(directory / FAISS_INDEX, lambda tmp_path: faiss.write_index(index, str(tmp_path)))
+    save_json(directory / INDEX_PARAMS_JSON, index_params, indent=2)
+    replace_file(directory / UPDATES_LOG, lambda tmp_path: open(tmp_path, 'wb').close())
+    print(f"Compacted {snapshot.log_records} update log records of shard {snapshot.language} into index version {index_params['version']}")
+
+def describe_snapshot(snapshot: IndexSnapshot) -> str:
+    """One-line summary of a snapshot for the logs."""
+    params = snapshot.index_params
+    unit = "chunks" if snapshot.chunk_map is not None else "vectors"
+    return (
+        f"shard {snapshot.language} version {snapshot.version}: {snapshot.ntotal} {unit} over {snapshot.n_documents} files, "
+        f"{params.get('factory', params['index_type'])} index, metric {params.get('metric', 'l2')}"
+    )
+
+# Swap in a new index version
+async def reload_index(force: bool = False) -> bool:
+    """Load changed shard index files in the background and swap them in.
+    
+    Changed shards are loaded in a worker thread while requests keep using the
+    current ones; the swap is a single reference assignment of the shard dict.
+    Returns True if anything was swapped in. A shard that fails to load keeps
+    serving its current version and the error is raised after the swap.
+    """
+    global shards, last_reload_error
+    
+    async with reload_lock:
+        loop = asyncio.get_running_loop()
+        layout = discover_shards()
+        updated, errors, changed = {}, [], False
+        for language, directory in layout.items():
+            current = shards.get(language)
+            if current is not None and current.directory != directory:
+                current = None
+            signature = index_signature(directory)
+            if not force and (
+                (current is not None and signature == current.signature) or signature == failed_signatures.get(language)
+            ):
+                if current is not None:
+                    # Same base; pick up updates appended to the log by other workers
+                    async with shard_lock(directory):
+                        replay_update_log(current)
+                    updated[language] = current
+                continue
+            try:
+                updated[language] = await loop.run_in_executor(None, load_index_snapshot, language, directory)
+            except Exception as e:
+                failed_signatures[language] = signature
+                errors.append(f"shard {language}: {str(e)}")
+                if current is not None:
+                    print(f"Index reload failed, still serving shard {language} version {current.version}: {str(e)}")
+                    updated[language] = current
+                else:
+                    print(f"Index reload failed for new shard {language}: {str(e)}")
+                continue
+            failed_signatures.pop(language, None)
+            changed = True
+            print(f"Reloaded index {describe_snapshot(updated[language])}")
+        
+        changed = changed or set(updated) != set(shards)
+        if changed:
+            try:
+                if not updated:
+                    raise RuntimeError("No shard could be loaded")
+                check_shards(updated)
+            except RuntimeError as e:
+                errors.append(str(e))
+                changed = False
+            else:
+                shards = updated
+        last_reload_error = "; ".join(errors) or None
+        if errors:
+            raise RuntimeError(last_reload_error)
+        return changed
+
+async def compact_index(min_records: int = 1) -> List[str]:
+    """Fold the update logs of shards with at least min_records records into new base indexes.
+    
+    Returns the shards that were compacted. Updates wait while it runs;
+    searches continue on the current snapshots.
+    """
+    global shards
+    
+    compacted = []
+    async with reload_lock:
+        loop = asyncio.get_running_loop()
+        for language, snapshot in list(shards.items()):
+            # Other workers' appends wait until the log is folded in and emptied
+            async with shard_lock(snapshot.directory):
+                replay_update_log(snapshot)
+                if snapshot.log_records < max(min_records, 1):
+                    continue
+                if index_signature(snapshot.directory) != snapshot.signature:
+                    raise RuntimeError(f"Index files of shard {language} changed on disk since they were loaded; reload before compacting")
+                
+                await loop.run_in_executor(None, write_compacted_index, snapshot)
+            reloaded = await loop.run_in_executor(None, load_index_snapshot, language, snapshot.directory)
+            shards = {**shards, language: reloaded}
+            compacted.append(language)
+            print(f"Reloaded index {describe_snapshot(reloaded)}")
+    return compacted
+
+async def run_compaction():
+    """Background compaction; failures are logged and the update logs are kept."""
+    try:
+        await compact_index(COMPACT_AFTER_RECORDS)
+    except Exception as e:
+        print(f"Index compaction failed: {str(e)}")
+
+def schedule_compaction():
+    """Start a background compaction once a shard's update log reaches COMPACT_AFTER_RECORDS."""
+    global compaction_task
+    
+    if COMPACT_AFTER_RECORDS <= 0 or all(snapshot.log_records < COMPACT_AFTER_RECORDS for snapshot in shards.values()):
+        return
+    if compaction_task is None or compaction_task.done():
+        compaction_task = asyncio.create_task(run_compaction())
+
+async def watch_index():
+    """Poll the index files and reload them when the indexer writes a new version."""
+    while True:
+        await asyncio.sleep(INDEX_RELOAD_INTERVAL)
+        try:
+            await reload_index()
+        except Exception:
+            pass  # Logged by reload_index; retried on the next poll
+
+# Load the model and tokenizer
+@app.on_event("startup")
+async def startup_load_index():
+    """Load the FAISS index shards and file paths on startup and start the index watcher."""
+    global shards, reload_lock, reload_task
+    
+    print("Loading FAISS index and file paths...")
+    layout = {language: load_index_snapshot(language, directory) for language, directory in discover_shards().items()}
+    check_shards(layout)
+    shards = layout
+    for snapshot in shards.values():
+        print(f"Successfully loaded index {describe_snapshot(snapshot)}")
+    
+    reload_lock = asyncio.Lock()
+    if INDEX_RELOAD_INTERVAL > 0:
+        reload_task = asyncio.create_task(watch_index())
     
     # Check if embedding API is available
     try:
-        response = requests.get("http://embedding_api:8002/health")
+        response = await embedding_client.get(EMBEDDING_API_HEALTH_URL)
         if response.status_code == 200 and response.json().get("status") == "healthy":
             print("Successfully connected to embedding API")
         else:
@@ -95,15 +1061,20 @@ async def startup_load_index():
     except Exception as e:
         print(f"WARNING: Could not connect to embedding API: {str(e)}")
 
+@app.on_event("shutdown")
+async def shutdown_index_watcher():
+    """Stop the index watcher and any running compaction."""
+    for task in (reload_task, compaction_task):
+        if task is not None:
+            task.cancel()
+
 # Process code by calling the code processor API
 async def process_code(code: str):
     """Process code by removing comments, imports, and empty lines using the code processor API."""
     try:
-        response = requests.post(
+        response = await code_processor_client.post(
             CODE_PROCESSOR_API_URL,
-            json={"code": code},
-            headers={"Content-Type": "application/json"},
-            timeout=30
+            json={"code": code}
         )
         
         if response.status_code != 200:
@@ -117,21 +1088,61 @@ async def process_code(code: str):
         print(f"Error calling code processor API: {str(e)}")
         raise Exception(f"Failed to process code: {str(e)}")
 
+# Process many code snippets with one call to the code processor API
+async def process_code_batch(code_snippets: Dict[str, str]) -> Dict[str, str]:
+    """Process code snippets in one request; returns processed code per key."""
+    try:
+        response = await code_processor_client.post(
+            CODE_PROCESSOR_BATCH_URL,
+            json={"code_snippets": code_snippets}
+        )
+        
+        if response.status_code != 200:
+            print(f"Error from code processor API: {response.text}")
+            raise Exception(f"Code processor API returned status code {response.status_code}")
+        
+        return response.json()["processed_snippets"]
+    except Exception as e:
+        print(f"Error calling code processor API: {str(e)}")
+        raise Exception(f"Failed to process code: {str(e)}")
+
+# Decode a binary embeddings payload
+def decode_embeddings(payload: bytes) -> np.ndarray:
+    """Unpack a binary embeddings payload into a float32 (rows, dim) matrix."""
+    magic, dtype_code, rows, dim = EMBEDDING_HEADER.unpack_from(payload)
+    if magic != EMBEDDING_MAGIC or dtype_code not in EMBEDDING_DTYPE_CODES:
+        raise Exception("Unexpected binary embedding payload")
+    matrix = np.frombuffer(
+        payload, dtype=EMBEDDING_DTYPE_CODES[dtype_code], count=rows * dim, offset=EMBEDDING_HEADER.size
+    )
+    return matrix.reshape(rows, dim).astype("float32")
+
+# Read the JSON trailer of a binary embeddings payload
+def decode_embedding_metadata(payload: bytes) -> Dict:
+    """Return the JSON trailer of a binary embeddings payload, or {} if there is none."""
+    magic, dtype_code, rows, dim = EMBEDDING_HEADER.unpack_from(payload)
+    itemsize = np.dtype(EMBEDDING_DTYPE_CODES[dtype_code]).itemsize
+    trailer = payload[EMBEDDING_HEADER.size + rows * dim * itemsize:]
+    return json.loads(trailer) if trailer else {}
+
 # Generate embedding for code by calling the embedding API
-async def generate_embedding(code: str):
+async def generate_embedding(code: str, normalize: bool = False):
     """Generate embedding for a single code snippet using the embedding API."""
     try:
-        response = requests.post(
+        response = await embedding_client.post(
             EMBEDDING_API_URL,
-            json={"code": code},  # Changed from data=code to json={"code": code}
-            headers={"Content-Type": "application/json"},  # Changed content type
-            timeout=30
+            json={"code": code, "normalize": normalize},
+            headers={"Accept": f"{EMBEDDING_MEDIA_TYPE}; dtype={EMBEDDING_TRANSPORT_DTYPE}, application/json;q=0.5"}
         )
         
         if response.status_code != 200:
             print(f"Error from embedding API: {response.text}")
             raise Exception(f"Embedding API returned status code {response.status_code}")
         
+        # Fall back to JSON if the embedding API does not speak the binary format
+        if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+            return decode_embeddings(response.content)[0]
+        
         embedding_data = response.json()
         embedding = np.array(embedding_data["embedding"], dtype="float32")
         return embedding
@@ -139,32 +1150,644 @@ async def generate_embedding(code: str):
         print(f"Error calling embedding API: {str(e)}")
         raise Exception(f"Failed to generate embedding: {str(e)}")
 
-# Find similar files
-def find_similar_files(embedding: np.ndarray, top_k: int = TOP_K):
-    """Find top_k similar files using FAISS."""
-    # Reshape to (1, EMBEDDING_DIM)
-    embedding = embedding.reshape(1, -1)
+# Generate chunk embeddings for code by calling the embedding API
+async def generate_chunk_embeddings(code: str, normalize: bool = False):
+    """Generate sliding-window chunk embeddings for a code snippet.
+    
+    Returns the (n_chunks, dim) chunk embeddings and an (n_chunks, 2) array of
+    start and end lines of each chunk within the code.
+    """
+    try:
+        response = await embedding_client.post(
+            EMBEDDING_API_URL,
+            json={"code": code, "mode": "chunks", "normalize": normalize},
+            headers={"Accept": f"{EMBEDDING_MEDIA_TYPE}; dtype={EMBEDDING_TRANSPORT_DTYPE}, application/json;q=0.5"}
+        )
+        
+        if response.status_code != 200:
+            print(f"Error from embedding API: {response.text}")
+            raise Exception(f"Embedding API returned status code {response.status_code}")
+        
+        if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+            # Spans are [snippet_index, start_line, end_line, n_tokens]
+            spans = decode_embedding_metadata(response.content)["spans"]
+            return decode_embeddings(response.content), np.array([span[1:3] for span in spans], dtype="int64")
+        
+        chunks = response.json()["chunks"]
+        embeddings = np.array([chunk["embedding"] for chunk in chunks], dtype="float32")
+        spans = np.array([[chunk["start_line"], chunk["end_line"]] for chunk in chunks], dtype="int64")
+        return embeddings, spans
+    except Exception as e:
+        print(f"Error calling embedding API: {str(e)}")
+        raise Exception(f"Failed to generate embedding: {str(e)}")
+
+# Generate embeddings for many snippets with one call to the embedding API
+async def generate_embeddings_batch(code_snippets: Dict[str, str], normalize: bool = False) -> np.ndarray:
+    """Return an (n_snippets, dim) matrix with one embedding per snippet, in key order."""
+    try:
+        response = await embedding_client.post(
+            EMBEDDING_API_BATCH_URL,
+            json={"code_snippets": code_snippets, "normalize": normalize},
+            headers={"Accept": f"{EMBEDDING_MEDIA_TYPE}; dtype={EMBEDDING_TRANSPORT_DTYPE}, application/json;q=0.5"}
+        )
+        
+        if response.status_code != 200:
+            print(f"Error from embedding API: {response.text}")
+            raise Exception(f"Embedding API returned status code {response.status_code}")
+        
+        # Binary rows follow the key order of code_snippets
+        if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+            return decode_embeddings(response.content)
+        
+        embeddings = response.json()["embeddings"]
+        return np.array([embeddings[key] for key in code_snippets], dtype="float32")
+    except Exception as e:
+        print(f"Error calling embedding API: {str(e)}")
+        raise Exception(f"Failed to generate embeddings: {str(e)}")
+
+async def generate_chunk_embeddings_batch(code_snippets: Dict[str, str], normalize: bool = False):
+    """Generate chunk embeddings for many snippets with one call to the embedding API.
+    
+    Returns the (n_chunks, dim) chunk embeddings of all snippets, an (n_chunks, 2)
+    array of chunk line ranges and the index of the snippet each chunk belongs to.
+    """
+    try:
+        response = await embedding_client.post(
+            EMBEDDING_API_BATCH_URL,
+            json={"code_snippets": code_snippets, "mode": "chunks", "normalize": normalize},
+            headers={"Accept": f"{EMBEDDING_MEDIA_TYPE}; dtype={EMBEDDING_TRANSPORT_DTYPE}, application/json;q=0.5"}
+        )
+        
+        if response.status_code != 200:
+            print(f"Error from embedding API: {response.text}")
+            raise Exception(f"Embedding API returned status code {response.status_code}")
+        
+        if response.headers.get("content-type", "").startswith(EMBEDDING_MEDIA_TYPE):
+            # Spans are [snippet_index, start_line, end_line, n_tokens] in key order
+            spans = np.array(decode_embedding_metadata(response.content)["spans"], dtype="int64").reshape(-1, 4)
+            return decode_embeddings(response.content), spans[:, 1:3], spans[:, 0]
+        
+        chunks = response.json()["chunks"]
+        rows = [(i, chunk) for i, key in enumerate(code_snippets) for chunk in chunks.get(key, [])]
+        embeddings = np.array([chunk["embedding"] for _, chunk in rows], dtype="float32").reshape(-1, EMBEDDING_DIM)
+        spans = np.array([[chunk["start_line"], chunk["end_line"]] for _, chunk in rows], dtype="int64").reshape(-1, 2)
+        owners = np.array([i for i, _ in rows], dtype="int64")
+        return embeddings, spans, owners
+    except Exception as e:
+        print(f"Error calling embedding API: {str(e)}")
+        raise Exception(f"Failed to generate embeddings: {str(e)}")
+
+# All-pairs nearest neighbours among submissions
+def pairwise_neighbors(embeddings: np.ndarray, neighbors: int, min_similarity: float):
+    """Return the distinct pairs (a, b, similarity), a < b, among each row's nearest neighbours at or above min_similarity.
+    
+    embeddings must be L2-normalized. One exact inner-product search of every row
+    against all rows finds the neighbours, so memory stays O(n * neighbors).
+    """
+    n = len(embeddings)
+    index = faiss.IndexFlatIP(embeddings.shape[1])
+    index.add(embeddings)
+    k = min(neighbors + 1, n)  # +1 for the row itself
+    similarities, ids = index.search(embeddings, k)
+    
+    rows = np.repeat(np.arange(n), k)
+    cols = ids.ravel()
+    scores = similarities.ravel()
+    keep = (cols >= 0) & (cols != rows) & (scores >= min_similarity)
+    a = np.minimum(rows, cols)[keep]
+    b = np.maximum(rows, cols)[keep]
+    scores = scores[keep]
+    
+    # A pair found from both ends is kept once
+    _, first = np.unique(a * n + b, return_index=True)
+    a, b, scores = a[first], b[first], scores[first]
+    order = np.argsort(-scores, kind="stable")
+    return a[order], b[order], scores[order]
+
+# Group suspicious pairs into clusters
+def pair_clusters(n: int, a: np.ndarray, b: np.ndarray, scores: np.ndarray) -> List[Dict]:
+    """Return the connected components of the pair graph with their pair count and similarity, largest first."""
+    parent = list(range(n))
+    
+    def find(i: int) -> int:
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    for i, j in zip(a.tolist(), b.tolist()):
+        parent[find(i)] = find(j)
     
-    # Search in FAISS index
-    distances, indices = index.search(embedding, top_k)
+    clusters = {}
+    for i, j, score in zip(a.tolist(), b.tolist(), scores.tolist()):
+        cluster = clusters.setdefault(find(i), {"members": set(), "scores": []})
+        cluster["members"].update((i, j))
+        cluster["scores"].append(score)
+    return sorted(
+        (
+            {
+                "members": sorted(cluster["members"]),
+                "pairs": len(cluster["scores"]),
+                "max_similarity": max(cluster["scores"]),
+                "mean_similarity": sum(cluster["scores"]) / len(cluster["scores"])
+            }
+            for cluster in clusters.values()
+        ),
+        key=lambda cluster: (-len(cluster["members"]), -cluster["max_similarity"])
+    )
+
+# Token n-gram containment of two submissions
+def ngram_overlap(grams_a: Dict[int, int], grams_b: Dict[int, int]) -> float:
+    """Return the fraction of the smaller n-gram multiset found in the other."""
+    smaller, larger = (grams_a, grams_b) if sum(grams_a.values()) <= sum(grams_b.values()) else (grams_b, grams_a)
+    total = sum(smaller.values())
+    if not total:
+        return 0.0
+    return sum(min(count, larger.get(gram, 0)) for gram, count in smaller.items()) / total
+
+# Compare every submission with every other one
+def compare_submissions(keys: List[str], processed: Dict[str, str], embeddings: np.ndarray, neighbors: int, min_similarity: float, max_pairs: int) -> Dict:
+    """Find and cluster the suspicious pairs among embedded submissions; returns the /pairwise response fields."""
+    a, b, scores = pairwise_neighbors(embeddings, neighbors, min_similarity)
+    grams = {}
+    pairs = []
+    for i, j, score in zip(a[:max_pairs].tolist(), b[:max_pairs].tolist(), scores[:max_pairs].tolist()):
+        for key in (keys[i], keys[j]):
+            if key not in grams:
+                grams[key] = lexical_ngrams(processed[key])
+        pairs.append({
+            "a": keys[i],
+            "b": keys[j],
+            "similarity": score,
+            "lexical_overlap": ngram_overlap(grams[keys[i]], grams[keys[j]])
+        })
+    clusters = pair_clusters(len(keys), a, b, scores)
+    for cluster in clusters:
+        cluster["members"] = [keys[i] for i in cluster["members"]]
+    return {"suspicious_pairs": len(scores), "pairs": pairs, "clusters": clusters}
+
+# Similarity scoring for the index's metric
+def distance_to_similarity(snapshot: IndexSnapshot, distance: float) -> float:
+    """Convert a FAISS result distance to a similarity score.
+    
+    Cosine indexes return the inner product of unit vectors, which is the cosine
+    similarity itself; L2 indexes are mapped to 1 / (1 + distance).
+    """
+    if snapshot.is_cosine():
+        return float(np.clip(distance, -1.0, 1.0))
+    return float(1.0 / (1.0 + distance))
+
+def similarity_to_radius(snapshot: IndexSnapshot, similarity: float) -> float:
+    """Convert a minimum similarity score to a FAISS range search radius (inverse of distance_to_similarity).
+    
+    FAISS range search is strict, so the radius is widened by one float32 step;
+    results are filtered on min_similarity afterwards.
+    """
+    if snapshot.is_cosine():
+        return float(np.nextafter(np.float32(similarity), np.float32(-np.inf)))
+    if similarity <= 0:
+        return float(np.finfo("float32").max)
+    return float(np.nextafter(np.float32(1.0 / similarity - 1.0), np.float32(np.inf)))
+
+# Resolve the per-request result options
+def resolve_result_options(request) -> SearchOptions:
+    """Return the search options of a /search or /search_batch request, applying defaults and limits.
+    
+    Range searches return up to MAX_TOP_K files unless top_k is given.
+    """
+    top_k, min_similarity, rerank_factor = request.top_k, request.min_similarity, request.rerank_factor
+    if rerank_factor is not None and not 1 <= rerank_factor <= MAX_RERANK_FACTOR:
+        raise HTTPException(status_code=400, detail=f"rerank_factor must be between 1 and {MAX_RERANK_FACTOR}")
+    if top_k is not None and not 1 <= top_k <= MAX_TOP_K:
+        raise HTTPException(status_code=400, detail=f"top_k must be between 1 and {MAX_TOP_K}")
+    if top_k is None:
+        top_k = MAX_TOP_K if request.range_search else TOP_K
+    if min_similarity is None:
+        min_similarity = MIN_SIMILARITY
+    if request.range_search and min_similarity <= -1:
+        raise HTTPException(status_code=400, detail="range_search requires a min_similarity")
+    return SearchOptions(
+        top_k=top_k,
+        min_similarity=min_similarity,
+        range_search=request.range_search,
+        rerank_factor=rerank_factor or RERANK_FACTOR,
+        nprobe=request.nprobe,
+        ef_search=request.ef_search
+    )
+
+# Run the FAISS search for a batch of queries
+def search_queries(snapshot: IndexSnapshot, queries: np.ndarray, k: int, min_similarity: float, range_search: bool,
+                   search_params=None, rerank_factor: int = 1):
+    """Return one (distances, vector ids) pair per query row.
+    
+    With range_search every vector scoring at least min_similarity is returned;
+    otherwise the k nearest. For approximate indexes with rerank_factor > 1, the
+    k * rerank_factor nearest candidates are re-ranked exactly.
+    """
+    if range_search:
+        return snapshot.range_search(queries, similarity_to_radius(snapshot, min_similarity), search_params)
+    if rerank_factor <= 1 or not snapshot.is_approximate():
+        distances, indices = snapshot.search(queries, k, search_params)
+        return list(zip(distances, indices))
+    
+    _, candidates = snapshot.search(queries, k * rerank_factor, search_params)
+    start = time.perf_counter()
+    distances, indices = snapshot.rerank(queries, candidates, k)
+    rerank_stats["rerank_ms"] += (time.perf_counter() - start) * 1000
+    rerank_stats["queries"] += len(queries)
+    # Queries whose top k changed, i.e. where re-ranking recovered a neighbour the index ranked lower
+    rerank_stats["changed"] += sum(
+        set(before[:k][before[:k] >= 0]) != set(after[after >= 0]) for before, after in zip(candidates, indices)
+    )
+    return list(zip(distances, indices))
+
+# Build per-query search parameters for approximate indexes
+def build_search_params(snapshot: IndexSnapshot, nprobe: Optional[int] = None, ef_search: Optional[int] = None):
+    """Return FAISS SearchParameters for the snapshot's base index, or None for exact indexes without deletions.
+    
+    Precedence: request value, then SEARCH_NPROBE / SEARCH_EF_SEARCH, then the
+    defaults saved with the index. Deleted base rows are excluded via the selector.
+    """
+    index, selector = snapshot.index, snapshot.base_selector
+    if isinstance(index, faiss.IndexIVF):
+        nprobe = nprobe or SEARCH_NPROBE or snapshot.index_params.get("nprobe", 1)
+        return faiss.SearchParametersIVF(nprobe=min(nprobe, index.nlist), sel=selector)
+    if isinstance(index, faiss.IndexHNSW):
+        ef_search = ef_search or SEARCH_EF_SEARCH or snapshot.index_params.get("ef_search", 64)
+        return faiss.SearchParametersHNSW(efSearch=ef_search, sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+# Find similar files from chunk hits
+def aggregate_chunk_hits(snapshot: IndexSnapshot, query_hits, query_spans: np.ndarray, top_k: int = TOP_K, min_similarity: float = MIN_SIMILARITY):
+    """Score reference files from the (distances, vector ids) hits of one query's windows.
+    
+    Hits are grouped per reference file, keeping the best query chunk for each
+    reference chunk, and the file is scored by its best chunk ("max") or by the
+    sum of its top CHUNK_TOP_M chunks ("sum"). Chunks scoring below
+    min_similarity are ignored.
+    """
+    # file path -> {reference chunk id: (similarity, query chunk index)}
+    file_hits = {}
+    for q, (distances, indices) in enumerate(query_hits):
+        for idx, distance in zip(indices, distances):
+            if idx < 0:
+                continue
+            similarity = distance_to_similarity(snapshot, distance)
+            if similarity < min_similarity:
+                continue
+            hits = file_hits.setdefault(snapshot.resolve(idx)[0], {})
+            if similarity > hits.get(idx, (-1.0, -1))[0]:
+                hits[idx] = (similarity, q)
+    
+    similar_files = []
+    for file_path, hits in file_hits.items():
+        ranked = sorted(hits.items(), key=lambda hit: hit[1][0], reverse=True)[:CHUNK_TOP_M]
+        if CHUNK_AGGREGATION == "sum":
+            score = sum(similarity for _, (similarity, _) in ranked)
+        else:
+            score = ranked[0][1][0]
+        
+        similar_files.append({
+            "file_path": file_path,
+            "similarity_score": score,
+            "matches": [
+                {
+                    "start_line": snapshot.resolve(idx)[1],
+                    "end_line": snapshot.resolve(idx)[2],
+                    "query_start_line": int(query_spans[q][0]),
+                    "query_end_line": int(query_spans[q][1]),
+                    "similarity_score": similarity
+                }
+                for idx, (similarity, q) in ranked
+            ]
+        })
     
-    # Flatten arrays
-    distances = distances.flatten()
-    indices = indices.flatten()
+    # Sort by similarity score (descending)
+    similar_files.sort(key=lambda x: x["similarity_score"], reverse=True)
     
+    return similar_files[:top_k]
+
+# Find similar files
+def rank_file_hits(snapshot: IndexSnapshot, distances: np.ndarray, indices: np.ndarray, top_k: int = TOP_K, min_similarity: float = MIN_SIMILARITY):
+    """Turn one query's FAISS results in a file-level index into similar files."""
     # Get file paths and create result
     similar_files = []
     for i, (idx, distance) in enumerate(zip(indices, distances)):
-        if idx < len(file_paths):
-            similar_files.append({
-                "file_path": file_paths[idx],
-                "similarity_score": float(1.0 / (1.0 + distance))  # Convert distance to similarity score
-            })
+        if idx >= 0:  # Approximate indexes return -1 for missing results
+            similarity = distance_to_similarity(snapshot, distance)
+            if similarity >= min_similarity:
+                similar_files.append({
+                    "file_path": snapshot.resolve(idx)[0],
+                    "similarity_score": similarity
+                })
     
     # Sort by similarity score (descending)
     similar_files.sort(key=lambda x: x["similarity_score"], reverse=True)
     
-    return similar_files
+    return similar_files[:top_k]
+
+# Detect the language of a code snippet
+def detect_language(code: str, file_path: Optional[str] = None) -> Optional[str]:
+    """Return the language shard of code, from its file extension or else from its content.
+    
+    Uses the indexer's rules in language_rules: the first matching marker decides,
+    else each language is scored by its pattern matches. Returns None if nothing matches.
+    """
+    rules = language_rules
+    if file_path:
+        language = rules["extensions"].get(os.path.splitext(file_path)[1].lower())
+        if language:
+            return language
+    for language, marker in rules["markers"]:
+        if re.search(marker, code, re.MULTILINE):
+            return language
+    scores = {
+        language: sum(len(re.findall(pattern, code, re.MULTILINE)) for pattern in patterns)
+        for language, patterns in rules["patterns"].items()
+    }
+    if not scores:
+        return None
+    language, score = max(scores.items(), key=lambda item: item[1])
+    return language if score > 0 else None
+
+# Pick the shards a query is searched in
+def route_query(layout: Dict[str, IndexSnapshot], code: str, language: Optional[str] = None,
+                cross_language: bool = False) -> Tuple[List[str], List[str]]:
+    """Return (shards to search, fallback shards to search if their matches are weak).
+    
+    Queries go to the shard of their language, given by name or extension in the
+    request or detected from the raw code (comments and imports are kept there,
+    which helps detection). Queries of unknown language, languages without a
+    shard and cross_language queries search every shard.
+    """
+    names = list(layout)
+    if cross_language or len(names) == 1:
+        return names, []
+    if language:
+        language = language.lower().lstrip(".")
+        language = language_rules["extensions"].get(f".{language}", language)
+    else:
+        language = detect_language(code)
+    if language not in layout:
+        routing_stats["unrouted"] += 1
+        return names, []
+    fallback = [name for name in names if name != language] if CROSS_LANGUAGE_FALLBACK else []
+    return [language], fallback
+
+# Search one shard for many queries
+def search_shard(snapshot: IndexSnapshot, queries: np.ndarray, row_groups: Dict[str, np.ndarray], options: SearchOptions,
+                 query_spans: Optional[np.ndarray] = None) -> Dict[str, List[Dict]]:
+    """Search the rows of several queries in one shard with a single FAISS call.
+    
+    row_groups maps each query key to its rows in queries: one row for file-level
+    indexes, one per window for chunk-level indexes, whose windows retrieve
+    CHUNK_CANDIDATES chunks each. Returns the similar files per key.
+    """
+    keys = [key for key in row_groups if len(row_groups[key])]
+    results = {key: [] for key in row_groups}
+    if not keys:
+        return results
+    rows = np.concatenate([row_groups[key] for key in keys])
+    k = max(CHUNK_CANDIDATES, options.top_k) if snapshot.chunk_map is not None else options.top_k
+    search_params = build_search_params(snapshot, options.nprobe, options.ef_search)
+    hits = search_queries(
+        snapshot, queries[rows], k, options.min_similarity, options.range_search, search_params, options.rerank_factor
+    )
+    routing_stats["vectors_searched"] += snapshot.ntotal * len(keys)
+    routing_stats["shards"][snapshot.language] = routing_stats["shards"].get(snapshot.language, 0) + len(keys)
+    
+    offset = 0
+    for key in keys:
+        key_hits = hits[offset:offset + len(row_groups[key])]
+        offset += len(row_groups[key])
+        if snapshot.chunk_map is not None:
+            results[key] = aggregate_chunk_hits(
+                snapshot, key_hits, query_spans[row_groups[key]], options.top_k, options.min_similarity
+            )
+        else:
+            results[key] = rank_file_hits(snapshot, *key_hits[0], options.top_k, options.min_similarity)
+    return results
+
+def search_shards(layout: Dict[str, IndexSnapshot], routes: Dict[str, List[str]], queries: np.ndarray,
+                  row_groups: Dict[str, np.ndarray], options: SearchOptions, query_spans: Optional[np.ndarray] = None):
+    """Search each query in the shards routes lists for it and merge the results per query.
+    
+    Every shard is searched once for all queries routed to it. A document lives in
+    one shard, so merging is a sort by similarity.
+    """
+    results = {key: [] for key in routes}
+    for language, snapshot in layout.items():
+        groups = {key: row_groups[key] for key, names in routes.items() if language in names}
+        if groups:
+            for key, similar_files in search_shard(snapshot, queries, groups, options, query_spans).items():
+                results[key].extend(similar_files)
+    for similar_files in results.values():
+        similar_files.sort(key=lambda x: x["similarity_score"], reverse=True)
+        del similar_files[options.top_k:]
+    return results
+
+# Embed processed queries
+async def embed_queries(reference: IndexSnapshot, processed: Dict[str, str]):
+    """Embed processed queries with one embedding API call.
+    
+    Returns the query matrix, the window line ranges of chunk-level indexes (else
+    None) and the rows of each query in the matrix.
+    """
+    keys = list(processed)
+    query_spans = None
+    if reference.chunk_map is not None:
+        # Chunk-level index: embed the query's windows and aggregate chunk hits per file
+        if len(keys) == 1:
+            queries, query_spans = await generate_chunk_embeddings(processed[keys[0]], reference.is_cosine())
+            owners = np.zeros(len(queries), dtype="int64")
+        else:
+            queries, query_spans, owners = await generate_chunk_embeddings_batch(processed, reference.is_cosine())
+        row_groups = {key: np.flatnonzero(owners == i) for i, key in enumerate(keys)}
+    else:
+        if len(keys) == 1:
+            queries = (await generate_embedding(processed[keys[0]], reference.is_cosine())).reshape(1, -1)
+        else:
+            queries = await generate_embeddings_batch(processed, reference.is_cosine())
+        row_groups = {key: np.array([i], dtype="int64") for i, key in enumerate(keys)}
+    return queries, query_spans, row_groups
+
+# Lexical retrieval over the token n-gram indexes
+def search_lexical(layout: Dict[str, IndexSnapshot], routes: Dict[str, List[str]], processed: Dict[str, str], k: int):
+    """Return up to k (shard, doc_id, BM25 score, overlap) hits per query from the shards routes lists for it, best first."""
+    start = time.perf_counter()
+    results = {}
+    for key, names in routes.items():
+        grams = lexical_ngrams(processed[key])
+        hits = [(name, *hit) for name in names for hit in layout[name].lexical.search(grams, k)]
+        hits.sort(key=lambda hit: hit[2], reverse=True)
+        results[key] = hits[:k]
+    lexical_stats["lexical_ms"] += (time.perf_counter() - start) * 1000
+    lexical_stats["queries"] += len(routes)
+    return results
+
+# Score given documents against a query embedding
+def score_documents(snapshot: IndexSnapshot, queries: np.ndarray, query_spans: Optional[np.ndarray], doc_ids: List[str],
+                    min_similarity: float) -> List[Dict]:
+    """Score documents of one shard against one query's rows exactly, as if FAISS had returned all their vectors."""
+    ids = np.concatenate([snapshot.document_ids(doc_id) for doc_id in doc_ids])
+    if not len(ids):
+        return []
+    candidates = np.tile(ids, (len(queries), 1))
+    exact = snapshot.exact_distances(queries, candidates)
+    if snapshot.chunk_map is not None:
+        return aggregate_chunk_hits(snapshot, list(zip(exact, candidates)), query_spans, len(doc_ids), min_similarity)
+    return rank_file_hits(snapshot, exact[0], ids, len(doc_ids), min_similarity)
+
+# Fuse the dense and lexical rankings of one query
+def fuse_rankings(layout: Dict[str, IndexSnapshot], dense: List[Dict], lexical_hits: List[Tuple], queries: np.ndarray,
+                  query_spans: Optional[np.ndarray], rows: np.ndarray, options: SearchOptions) -> List[Dict]:
+    """Merge a query's FAISS and BM25 rankings by reciprocal rank fusion and keep the top_k files.
+    
+    Files found only lexically are scored against the query embedding exactly, so
+    every result has a similarity_score and min_similarity still applies.
+    """
+    files = {similar_file["file_path"]: similar_file for similar_file in dense}
+    fused = {file_path: 1.0 / (RRF_K + rank + 1) for rank, file_path in enumerate(files)}
+    lexical_only = {}
+    for rank, (language, doc_id, _, _) in enumerate(lexical_hits):
+        fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        if doc_id not in files:
+            lexical_only.setdefault(language, []).append(doc_id)
+    for language, doc_ids in lexical_only.items():
+        spans = query_spans[rows] if query_spans is not None else None
+        for similar_file in score_documents(layout[language], queries[rows], spans, doc_ids, options.min_similarity):
+            files[similar_file["file_path"]] = similar_file
+    for _, doc_id, score, overlap in lexical_hits:
+        if doc_id in files:
+            files[doc_id].update({"lexical_score": score, "lexical_overlap": overlap})
+    
+    ranked = sorted(files.values(), key=lambda x: fused[x["file_path"]], reverse=True)[:options.top_k]
+    dense_top = {similar_file["file_path"] for similar_file in dense[:options.top_k]}
+    for similar_file in ranked:
+        similar_file["fusion_score"] = fused[similar_file["file_path"]]
+    lexical_stats["rescued"] += sum(similar_file["file_path"] not in dense_top for similar_file in ranked)
+    return ranked
+
+def hybrid_search(layout: Dict[str, IndexSnapshot], routes: Dict[str, List[str]], processed: Dict[str, str],
+                  queries: np.ndarray, query_spans: Optional[np.ndarray], row_groups: Dict[str, np.ndarray],
+                  options: SearchOptions, lexical_hits: Optional[Dict[str, List[Tuple]]] = None):
+    """Search queries in their shards by embedding and by token n-grams and fuse the rankings per query."""
+    if lexical_hits is None:
+        lexical_hits = search_lexical(layout, routes, processed, LEXICAL_CANDIDATES)
+    # Take more dense candidates than top_k so both rankings contribute to the fused top_k
+    dense_options = SearchOptions(**{**vars(options), "top_k": max(options.top_k, LEXICAL_CANDIDATES)})
+    dense = search_shards(layout, routes, queries, row_groups, dense_options, query_spans)
+    return {
+        key: fuse_rankings(layout, dense[key], lexical_hits[key], queries, query_spans, row_groups[key], options)
+        for key in routes
+    }
+
+def lexical_results(layout: Dict[str, IndexSnapshot], lexical_hits: List[Tuple], queries: np.ndarray,
+                    query_spans: Optional[np.ndarray], rows: np.ndarray, options: SearchOptions) -> List[Dict]:
+    """Similar files from a query's lexical hits alone, without a FAISS search.
+    
+    The hits are scored against the query embedding exactly, like lexical-only
+    files in fuse_rankings, so similarity_score stays an embedding similarity.
+    """
+    by_language = {}
+    for language, doc_id, _, _ in lexical_hits:
+        by_language.setdefault(language, []).append(doc_id)
+    spans = query_spans[rows] if query_spans is not None else None
+    files = {}
+    for language, doc_ids in by_language.items():
+        for similar_file in score_documents(layout[language], queries[rows], spans, doc_ids, options.min_similarity):
+            files[similar_file["file_path"]] = similar_file
+    # Kept in lexical order, so the near-verbatim copy that triggered the shortcut comes first
+    ranked = []
+    for _, doc_id, score, overlap in lexical_hits:
+        if doc_id in files:
+            files[doc_id].update({"lexical_score": score, "lexical_overlap": overlap})
+            ranked.append(files[doc_id])
+    return ranked[:options.top_k]
+
+# Whether a routed query should also be searched in the other shards
+def weak_matches(similar_files: List[Dict], options: SearchOptions) -> bool:
+    """Return True if a query's own shard returned fewer than top_k files or none scoring CROSS_LANGUAGE_MIN_SIMILARITY.
+    
+    Range searches return every match above min_similarity, so only an empty result is short.
+    """
+    if not similar_files:
+        return True
+    if not options.range_search and len(similar_files) < options.top_k:
+        return True
+    return max(similar_file["similarity_score"] for similar_file in similar_files) < CROSS_LANGUAGE_MIN_SIMILARITY
+
+# Embed queries and search them in their language shards
+async def search_routed(layout: Dict[str, IndexSnapshot], codes: Dict[str, str], processed: Dict[str, str],
+                        options: SearchOptions, language: Optional[str] = None, cross_language: bool = False):
+    """Return the similar files of each processed query, keyed like processed.
+    
+    Queries are embedded with one embedding API call, routed by the language of
+    their raw code in codes, and searched in their shard. With LEXICAL_SEARCH the
+    BM25 n-gram search runs in a worker thread while the queries are embedded and
+    is fused with the FAISS ranking; obvious copies are answered from the lexical
+    hits alone, without a FAISS search (LEXICAL_SHORTCUT_OVERLAP). Queries their shard has only weak matches for
+    (weak_matches) are searched in all shards when CROSS_LANGUAGE_FALLBACK is on.
+    """
+    keys = list(processed)
+    reference = next(iter(layout.values()))  # Shards share metric and granularity (check_shards)
+    routes, fallbacks = {}, {}
+    for key in keys:
+        routes[key], fallbacks[key] = route_query(layout, codes[key], language, cross_language)
+    routing_stats["queries"] += len(keys)
+    
+    hybrid = LEXICAL_SEARCH and all(snapshot.lexical is not None for snapshot in layout.values())
+    if hybrid:
+        embedding = asyncio.ensure_future(embed_queries(reference, processed))
+        try:
+            lexical_hits = await asyncio.get_running_loop().run_in_executor(
+                None, search_lexical, layout, routes, processed, LEXICAL_CANDIDATES
+            )
+        except Exception:
+            embedding.cancel()
+            raise
+        queries, query_spans, row_groups = await embedding
+        if LEXICAL_SHORTCUT_OVERLAP > 0 and all(
+            hits and hits[0][3] >= LEXICAL_SHORTCUT_OVERLAP for hits in lexical_hits.values()
+        ):
+            # Every query has a near-verbatim copy; score the lexical hits without searching FAISS
+            lexical_stats["shortcuts"] += len(keys)
+            return {
+                key: lexical_results(layout, lexical_hits[key], queries, query_spans, row_groups[key], options)
+                for key in keys
+            }
+        results = hybrid_search(layout, routes, processed, queries, query_spans, row_groups, options, lexical_hits)
+    else:
+        queries, query_spans, row_groups = await embed_queries(reference, processed)
+        results = search_shards(layout, routes, queries, row_groups, options, query_spans)
+    
+    # Cross-language fallback; the query's own shard is searched again so all shards are ranked together
+    retry = {key: routes[key] + fallbacks[key] for key in keys if fallbacks[key] and weak_matches(results[key], options)}
+    if retry:
+        routing_stats["fallbacks"] += len(retry)
+        if hybrid:
+            results.update(hybrid_search(layout, retry, processed, queries, query_spans, row_groups, options))
+        else:
+            results.update(search_shards(layout, retry, queries, row_groups, options, query_spans))
+    return results
+
+# Version of the searchable content over all shards
+def index_version(layout: Dict[str, IndexSnapshot]) -> Optional[str]:
+    """Return a version string that changes whenever any shard is reloaded, compacted or updated."""
+    if len(layout) == 1:
+        return next(iter(layout.values())).content_version
+    return ",".join(f"{language}:{snapshot.content_version}" for language, snapshot in sorted(layout.items())) or None
+
+# Totals over all shards
+def index_totals(layout: Dict[str, IndexSnapshot]) -> Dict:
+    """Return document and vector counts and the combined version of all shards."""
+    return {
+        "files_indexed": sum(snapshot.n_documents for snapshot in layout.values()),
+        "vectors_indexed": sum(snapshot.ntotal for snapshot in layout.values()),
+        "index_version": index_version(layout)
+    }
 
 # API endpoint for code similarity search
 @app.post("/search", response_model=SimilarFilesResponse)
@@ -174,10 +1797,21 @@ async def search_similar_code(request: CodeRequest):
     
     The code is processed by the code processor API to remove comments, empty lines, and import statements,
     and then converted to an embedding via the embedding API. This embedding is 
-    used to search for similar files in the FAISS index.
+    used to search for similar files in the FAISS index shard of the code's language
+    (request.language, or detected from the code). With a chunk-level index the
+    query is embedded per window and chunk hits are aggregated per file. With
+    LEXICAL_SEARCH, a BM25 search over normalized token n-grams runs alongside and
+    both rankings are fused.
     
-    Returns the top 3 most similar files.
+    Returns the top_k (default 3) most similar files scoring at least min_similarity, with
+    their best-matching line ranges for chunk-level indexes. With range_search the result
+    holds every file scoring at least min_similarity instead of a fixed number.
     """
+    options = resolve_result_options(request)
+    
+    # Pin the current index version; a reload during this request does not affect it
+    layout = shards
+    version = index_version(layout)
     try:
         # Process code using the code processor API
         processed_code = await process_code(request.code)
@@ -188,26 +1822,133 @@ async def search_similar_code(request: CodeRequest):
                 detail="After processing, the code is empty. Please provide valid code."
             )
         
-        # Generate embedding using the embedding API
-        embedding = await generate_embedding(processed_code)
-        
         # Search for similar files
-        similar_files = find_similar_files(embedding)
+        results = await search_routed(
+            layout, {"query": request.code}, {"query": processed_code}, options, request.language, request.cross_language
+        )
         
         return {
-            "similar_files": similar_files,
-            "processed_code": processed_code
+            "similar_files": results["query"],
+            "processed_code": processed_code,
+            "index_version": version
+        }
+    
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
+# API endpoint for searching many snippets at once
+@app.post("/search_batch", response_model=BatchSearchResponse, response_model_exclude_none=True)
+async def search_similar_code_batch(request: BatchCodeRequest):
+    """
+    Search for similar code files for many code snippets in one request.
+    
+    All snippets are processed with one code processor call and embedded with one
+    embedding API call; each language shard is then searched once for all snippets
+    routed to it. Results are keyed like request.code_snippets; snippets that are
+    empty after processing get an error instead of failing the whole batch.
+    """
+    if len(request.code_snippets) > SEARCH_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {SEARCH_BATCH_MAX_SIZE} snippets can be searched per request"
+        )
+    options = resolve_result_options(request)
+    
+    # Pin the current index version; a reload during this request does not affect it
+    layout = shards
+    version = index_version(layout)
+    try:
+        processed = await process_code_batch(request.code_snippets) if request.code_snippets else {}
+        results = {
+            key: {"similar_files": [], "processed_code": code}
+            for key, code in processed.items()
         }
+        for key, code in processed.items():
+            if not code.strip():
+                results[key]["error"] = "After processing, the code is empty. Please provide valid code."
+        
+        queries = {key: code for key, code in processed.items() if code.strip()}
+        if not queries:
+            return {"results": results, "index_version": version}
+        
+        similar_files = await search_routed(
+            layout, request.code_snippets, queries, options, request.language, request.cross_language
+        )
+        for key, files in similar_files.items():
+            results[key]["similar_files"] = files
+        
+        return {"results": results, "index_version": version}
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
 
+# API endpoint for comparing submissions with each other
+@app.post("/pairwise", response_model=PairwiseResponse)
+async def pairwise_similarity(request: PairwiseRequest):
+    """
+    Find suspiciously similar pairs among a set of submissions, such as one assignment.
+    
+    The submissions are processed and embedded once, in batches of up to
+    SEARCH_BATCH_MAX_SIZE; every submission is then searched against all the others
+    with one exact FAISS search, keeping each one's nearest neighbours at or above
+    min_similarity. Pairs come most similar first with their token n-gram overlap;
+    clusters are the connected groups of suspicious pairs. The reference index is
+    not involved.
+    """
+    if len(request.code_snippets) > PAIRWISE_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {PAIRWISE_MAX_SIZE} snippets can be compared per request"
+        )
+    neighbors = request.neighbors if request.neighbors is not None else PAIRWISE_NEIGHBORS
+    min_similarity = request.min_similarity if request.min_similarity is not None else PAIRWISE_MIN_SIMILARITY
+    max_pairs = request.max_pairs if request.max_pairs is not None else PAIRWISE_MAX_PAIRS
+    if neighbors < 1 or max_pairs < 0:
+        raise HTTPException(status_code=400, detail="neighbors must be at least 1 and max_pairs at least 0")
+    
+    try:
+        keys = list(request.code_snippets)
+        batches = [keys[i:i + SEARCH_BATCH_MAX_SIZE] for i in range(0, len(keys), SEARCH_BATCH_MAX_SIZE)]
+        processed = {}
+        for batch in await asyncio.gather(*(
+            process_code_batch({key: request.code_snippets[key] for key in batch}) for batch in batches
+        )):
+            processed.update(batch)
+        
+        errors = {
+            key: "After processing, the code is empty. Please provide valid code."
+            for key in keys if not processed.get(key, "").strip()
+        }
+        keys = [key for key in keys if key not in errors]
+        if len(keys) < 2:
+            return {"submissions": len(keys), "suspicious_pairs": 0, "pairs": [], "clusters": [], "errors": errors}
+        
+        batches = [keys[i:i + SEARCH_BATCH_MAX_SIZE] for i in range(0, len(keys), SEARCH_BATCH_MAX_SIZE)]
+        embeddings = np.vstack(await asyncio.gather(*(
+            generate_embeddings_batch({key: processed[key] for key in batch}, normalize=True) for batch in batches
+        )))
+        
+        start = time.perf_counter()
+        result = await asyncio.get_running_loop().run_in_executor(
+            None, compare_submissions, keys, processed, embeddings, neighbors, min_similarity, max_pairs
+        )
+        print(
+            f"Compared {len(keys)} submissions in {(time.perf_counter() - start) * 1000:.1f}ms: "
+            f"{result['suspicious_pairs']} suspicious pairs in {len(result['clusters'])} clusters"
+        )
+        return {"submissions": len(keys), **result, "errors": errors}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+
 # Check service dependencies on startup
 @app.on_event("startup")
 async def check_dependencies():
     """Check if the code processor API is available at startup."""
     try:
-        response = requests.get("http://code_processor:8004/health")
+        response = await code_processor_client.get(CODE_PROCESSOR_HEALTH_URL)
         if response.status_code == 200 and response.json().get("status") == "healthy":
             print("Successfully connected to code processor API")
         else:
@@ -219,7 +1960,221 @@ async def check_dependencies():
 @app.get("/health")
 async def health_check():
     """Basic health check endpoint."""
-    return {"status": "healthy", "files_indexed": len(file_paths) if file_paths else 0}
+    layout = shards
+    response = {"status": "healthy", **index_totals(layout)}
+    response.update({
+        "pending_updates": sum(snapshot.log_records for snapshot in layout.values()),
+        "index_loaded_at": max((snapshot.loaded_at for snapshot in layout.values()), default=None),
+        "last_reload_error": last_reload_error,
+        "shards": {
+            language: {
+                "files_indexed": snapshot.n_documents,
+                "vectors_indexed": snapshot.ntotal,
+                "index_version": snapshot.version,
+                "pending_updates": snapshot.log_records,
+                "lexical_documents": snapshot.lexical.n_documents if snapshot.lexical is not None else 0,
+                "index": snapshot.index_params
+            }
+            for language, snapshot in layout.items()
+        }
+    })
+    return response
+
+# Search metrics endpoint
+@app.get("/metrics")
+async def metrics():
+    """Exact re-ranking, shard routing and lexical search statistics since startup.
+    
+    topk_changed_rate is the fraction of re-ranked queries whose top k differed
+    from the index's own top k, an online estimate of the recall re-ranking recovers.
+    mean_vectors_searched is the number of indexed vectors a query was searched
+    against, to compare with vectors_indexed over all shards. rescued_per_query
+    counts results the lexical ranking brought into the top k.
+    """
+    layout = shards
+    queries = rerank_stats["queries"]
+    routed = routing_stats["queries"]
+    lexical_queries = lexical_stats["queries"]
+    return {
+        "rerank": {
+            "factor": RERANK_FACTOR,
+            "approximate_index": any(snapshot.is_approximate() for snapshot in layout.values()),
+            "queries": queries,
+            "mean_rerank_ms": rerank_stats["rerank_ms"] / queries if queries else 0.0,
+            "topk_changed_rate": rerank_stats["changed"] / queries if queries else 0.0
+        },
+        "routing": {
+            "shards": list(layout),
+            "vectors_indexed": index_totals(layout)["vectors_indexed"],
+            "queries": routed,
+            "mean_vectors_searched": routing_stats["vectors_searched"] / routed if routed else 0.0,
+            "fallback_rate": routing_stats["fallbacks"] / routed if routed else 0.0,
+            "unrouted_rate": routing_stats["unrouted"] / routed if routed else 0.0,
+            "queries_per_shard": dict(routing_stats["shards"])
+        },
+        "lexical": {
+            "enabled": LEXICAL_SEARCH,
+            "ngram": LEXICAL_NGRAM,
+            "queries": lexical_queries,
+            "mean_lexical_ms": lexical_stats["lexical_ms"] / lexical_queries if lexical_queries else 0.0,
+            "shortcut_rate": lexical_stats["shortcuts"] / lexical_queries if lexical_queries else 0.0,
+            "rescued_per_query": lexical_stats["rescued"] / lexical_queries if lexical_queries else 0.0
+        }
+    }
+
+# Reload the index without restarting the service
+@app.post("/admin/reload_index")
+async def admin_reload_index(force: bool = False):
+    """
+    Load the index files written by the indexer and swap them in.
+    
+    In-flight searches finish on the previous version. With force=true the
+    files are reloaded even if they have not changed on disk.
+    """
+    try:
+        reloaded = await reload_index(force)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Index reload failed: {str(e)}")
+    totals = index_totals(shards)
+    return {
+        "status": "reloaded" if reloaded else "unchanged",
+        "index_version": totals["index_version"],
+        "vectors_indexed": totals["vectors_indexed"]
+    }
+
+# Fold incremental updates into a new base index
+@app.post("/admin/compact")
+async def admin_compact_index():
+    """
+    Write each shard's base index plus incremental updates as a new index version and empty its update log.
+    
+    Runs automatically once a shard's log holds COMPACT_AFTER_RECORDS updates. Searches
+    continue during compaction; adds and deletes wait for it to finish.
+    """
+    try:
+        compacted = await compact_index()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Index compaction failed: {str(e)}")
+    totals = index_totals(shards)
+    return {
+        "status": "compacted" if compacted else "unchanged",
+        "shards": compacted,
+        "index_version": totals["index_version"],
+        "vectors_indexed": totals["vectors_indexed"]
+    }
+
+# Resolve a document id to its file
+def document_path(doc_id: str) -> Tuple[str, Path]:
+    """Return the normalized doc_id and its path in processed_codefiles.
+    
+    Raises a 400 for ids that are empty or point outside processed_codefiles.
+    """
+    root = PROCESSED_CODEFILES_DIR.resolve()
+    path = (root / doc_id).resolve()
+    if root not in path.parents:
+        raise HTTPException(status_code=400, detail=f"Invalid document id: {doc_id}")
+    return path.relative_to(root).as_posix(), path
+
+# Pick the shard a document is indexed in
+def document_shard(layout: Dict[str, IndexSnapshot], doc_id: str, code: str) -> str:
+    """Return the shard for a new document, by its extension or else its content.
+    
+    Raises a 400 if the index is sharded and has no shard for the document's language.
+    """
+    if UNSHARDED in layout:
+        return UNSHARDED
+    language = detect_language(code, doc_id) or "other"
+    if language not in layout:
+        raise HTTPException(
+            status_code=400,
+            detail=f"No index shard for language {language}; re-run generate_embeddings.py to create it"
+        )
+    return language
+
+# Add or replace a document without re-indexing
+@app.post("/documents")
+async def add_document(request: DocumentRequest):
+    """
+    Add a code file to the index, or replace it if doc_id is already indexed.
+    
+    The code is processed and embedded like a search query, saved to processed_codefiles
+    (where the LLM service reads reference files) and recorded in the update log of
+    its language shard. It is searchable as soon as this returns.
+    """
+    doc_id, doc_path = document_path(request.doc_id)
+    language = document_shard(shards, doc_id, request.code)
+    snapshot = shards[language]
+    try:
+        processed_code = await process_code(request.code)
+        if not processed_code.strip():
+            raise HTTPException(
+                status_code=400,
+                detail="After processing, the code is empty. Please provide valid code."
+            )
+        
+        if snapshot.chunk_map is not None:
+            vectors, spans = await generate_chunk_embeddings(processed_code, snapshot.is_cosine())
+            spans = spans.tolist()
+        else:
+            vectors, spans = (await generate_embedding(processed_code, snapshot.is_cosine())).reshape(1, -1), None
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error processing request: {str(e)}")
+    
+    record = {
+        "op": "add",
+        "doc_id": doc_id,
+        "vectors": base64.b64encode(vectors.astype("<f4").tobytes()).decode("ascii"),
+        "spans": spans
+    }
+    async with reload_lock:
+        # The shard may have been reloaded while the code was embedded
+        if language not in shards:
+            raise HTTPException(status_code=503, detail=f"Index shard {language} is no longer loaded")
+        replaced = any(other.has_document(doc_id) for other in shards.values())
+        doc_path.parent.mkdir(parents=True, exist_ok=True)
+        replace_file(doc_path, lambda tmp_path: tmp_path.write_text(processed_code, encoding='utf-8'))
+        # A document whose detected language changed moves to its new shard
+        for other in shards.values():
+            if other.language != language and other.has_document(doc_id):
+                async with shard_lock(other.directory):
+                    append_update_log(other, {"op": "delete", "doc_id": doc_id})
+                    replay_update_log(other)
+        async with shard_lock(shards[language].directory):
+            append_update_log(shards[language], record)
+            replay_update_log(shards[language])
+    schedule_compaction()
+    
+    return {
+        "doc_id": doc_id,
+        "status": "replaced" if replaced else "added",
+        "shard": language,
+        "vectors_added": len(vectors),
+        "vectors_indexed": index_totals(shards)["vectors_indexed"]
+    }
+
+# Delete a document without re-indexing
+@app.delete("/documents/{doc_id:path}")
+async def delete_document(doc_id: str):
+    """Remove a code file from the index and from processed_codefiles."""
+    doc_id, doc_path = document_path(doc_id)
+    async with reload_lock:
+        holders = [snapshot for snapshot in shards.values() if snapshot.has_document(doc_id)]
+        if not holders:
+            raise HTTPException(status_code=404, detail=f"Document not found: {doc_id}")
+        for snapshot in holders:
+            async with shard_lock(snapshot.directory):
+                append_update_log(snapshot, {"op": "delete", "doc_id": doc_id})
+                replay_update_log(snapshot)
+        doc_path.unlink(missing_ok=True)
+    schedule_compaction()
+    
+    return {
+        "doc_id": doc_id,
+        "status": "deleted",
+        "vectors_indexed": index_totals(shards)["vectors_indexed"]
+    }
 
 # Root endpoint
 @app.get("x/")
@@ -231,7 +2186,14 @@ async def root():
         "endpoints": [
             {"path": "/", "method": "GET", "description": "This information"},
             {"path": "/health", "method": "GET", "description": "Health check"},
-            {"path": "/search", "method": "POST", "description": "Search for similar code files"}
+            {"path": "/metrics", "method": "GET", "description": "Re-ranking, routing and lexical search statistics"},
+            {"path": "/search", "method": "POST", "description": "Search for similar code files"},
+            {"path": "/search_batch", "method": "POST", "description": "Search for similar code files for many snippets"},
+            {"path": "/pairwise", "method": "POST", "description": "Find and cluster similar pairs among many snippets"},
+            {"path": "/documents", "method": "POST", "description": "Add or replace a code file in the index"},
+            {"path": "/documents/{doc_id}", "method": "DELETE", "description": "Remove a code file from the index"},
+            {"path": "/admin/reload_index", "method": "POST", "description": "Reload the FAISS index from disk"},
+            {"path": "/admin/compact", "method": "POST", "description": "Fold incremental updates into a new index version"}
         ]
     }
 
@@ -0,0 +1,50 @@
+"""Fixtures for the search_api tests: throwaway index directories and fake upstreams."""
+
+import numpy as np
+import pytest
+
+from search_api_helpers import generate_embeddings, search_api
+
+@pytest.fixture
+def index_dirs(tmp_path, monkeypatch):
+    """Point search_api and the indexer at empty embeddings and processed_codefiles directories."""
+    embeddings_dir = tmp_path / "embeddings"
+    embeddings_dir.mkdir()
+    processed_dir = tmp_path / "processed_codefiles"
+    processed_dir.mkdir()
+    monkeypatch.setattr(search_api, "EMBEDDINGS_DIR", embeddings_dir)
+    monkeypatch.setattr(search_api, "SHARDS_DIR", embeddings_dir / "shards")
+    monkeypatch.setattr(search_api, "SHARDS_MANIFEST", embeddings_dir / "shards" / "shards.json")
+    monkeypatch.setattr(search_api, "PROCESSED_CODEFILES_DIR", processed_dir)
+    monkeypatch.setattr(search_api, "COMPACT_AFTER_RECORDS", 0)
+    monkeypatch.setattr(search_api, "LEXICAL_SEARCH", False)
+    monkeypatch.setattr(search_api, "language_rules", {"extensions": {}, "markers": [], "patterns": {}})
+    monkeypatch.setattr(search_api, "shards", {})
+    monkeypatch.setattr(generate_embeddings, "METRIC", "cosine")
+    return embeddings_dir, processed_dir
+
+@pytest.fixture
+def embedder(monkeypatch):
+    """Replace the code processor and embedding API: code is kept as is and embedded by lookup.
+
+    Returns the code -> vector dict the fake embedding API reads; unknown code is an error.
+    """
+    vectors = {}
+
+    async def process_code(code):
+        return code
+
+    async def process_code_batch(code_snippets):
+        return dict(code_snippets)
+
+    async def generate_embedding(code, normalize=False):
+        return vectors[code]
+
+    async def generate_embeddings_batch(code_snippets, normalize=False):
+        return np.stack([vectors[code] for code in code_snippets.values()])
+
+    monkeypatch.setattr(search_api, "process_code", process_code)
+    monkeypatch.setattr(search_api, "process_code_batch", process_code_batch)
+    monkeypatch.setattr(search_api, "generate_embedding", generate_embedding)
+    monkeypatch.setattr(search_api, "generate_embeddings_batch", generate_embeddings_batch)
+    return vectors
@@ -0,0 +1,39 @@
+"""Helpers for the search_api tests: the service module loaded from main.py and index builders."""
+
+import importlib.util
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+ROOT = Path(__file__).resolve().parents[2]
+sys.path.insert(0, str(ROOT / "indexer"))
+import generate_embeddings  # noqa: E402
+
+spec = importlib.util.spec_from_file_location("search_api_main", ROOT / "search_api" / "main.py")
+search_api = importlib.util.module_from_spec(spec)
+sys.modules["search_api_main"] = search_api
+spec.loader.exec_module(search_api)
+
+DIM = 768
+
+def unit(vectors: np.ndarray) -> np.ndarray:
+    return (vectors / np.linalg.norm(vectors, axis=1, keepdims=True)).astype("float32")
+
+def random_vectors(n: int, seed: int = 0) -> np.ndarray:
+    return unit(np.random.default_rng(seed).normal(size=(n, DIM)))
+
+def write_index(directory: Path, file_paths: List[str], vectors: np.ndarray, index_type: str = "flat"):
+    """Build and save an index over vectors the way the indexer does."""
+    directory.mkdir(parents=True, exist_ok=True)
+    index, index_params = generate_embeddings.create_faiss_index(vectors, index_type)
+    generate_embeddings.save_data(directory, file_paths, vectors, index, None, index_params)
+
+def load_layout() -> Dict[str, "search_api.IndexSnapshot"]:
+    """Load every shard the way search_api does on startup and make it the served layout."""
+    layout = {language: search_api.load_index_snapshot(language, directory)
+              for language, directory in search_api.discover_shards().items()}
+    search_api.check_shards(layout)
+    search_api.shards = layout
+    return layout
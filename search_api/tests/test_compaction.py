@@ -0,0 +1,38 @@
+"""Compaction of a shard whose documents were all deleted."""
+
+import asyncio
+
+import pytest
+
+from search_api_helpers import random_vectors, search_api, write_index
+
+N_FILES = 200
+
+@pytest.fixture
+def shard(index_dirs, embedder):
+    """An unsharded cosine index of N_FILES random vectors, loaded as the only shard."""
+    embeddings_dir, _ = index_dirs
+    vectors = random_vectors(N_FILES)
+    file_paths = [f"course/student{i}.py" for i in range(N_FILES)]
+    write_index(embeddings_dir, file_paths, vectors)
+    embedder["print(1)"] = vectors[0]
+    search_api.shards = {search_api.UNSHARDED: search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)}
+    return file_paths
+
+def test_search_after_deleting_everything_and_compacting(shard):
+    async def run():
+        search_api.reload_lock = asyncio.Lock()
+        for doc_id in shard:
+            await search_api.delete_document(doc_id)
+        assert await search_api.compact_index() == [search_api.UNSHARDED]
+        assert search_api.shards[search_api.UNSHARDED].ntotal == 0
+
+        response = await search_api.search_similar_code(search_api.CodeRequest(code="print(1)"))
+        assert response["similar_files"] == []
+
+        # The empty base still takes new documents, which are found again
+        await search_api.add_document(search_api.DocumentRequest(doc_id="course/late.py", code="print(1)"))
+        response = await search_api.search_similar_code(search_api.CodeRequest(code="print(1)"))
+        assert [file["file_path"] for file in response["similar_files"]] == ["course/late.py"]
+
+    asyncio.run(run())
@@ -0,0 +1,97 @@
+"""Incremental document adds and deletes: tombstoned base rows, the ID-mapped delta index and the update log."""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from search_api_helpers import random_vectors, search_api, write_index
+
+N_FILES = 50
+
+@pytest.fixture
+def shard(index_dirs, embedder, monkeypatch):
+    """An unsharded flat index of N_FILES files; submitted code "v<i>" embeds to vector i."""
+    embeddings_dir, _ = index_dirs
+    monkeypatch.setattr(search_api, "reload_lock", asyncio.Lock())
+    vectors = random_vectors(N_FILES + 2)
+    write_index(embeddings_dir, [f"course/student{i}.py" for i in range(N_FILES)], vectors[:N_FILES])
+    embedder.update({f"v{i}": vector for i, vector in enumerate(vectors)})
+    search_api.shards = {search_api.UNSHARDED: search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)}
+    return embeddings_dir
+
+def snapshot():
+    return search_api.shards[search_api.UNSHARDED]
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def add(doc_id, code):
+    return run(search_api.add_document(search_api.DocumentRequest(doc_id=doc_id, code=code)))
+
+def delete(doc_id):
+    return run(search_api.delete_document(doc_id))
+
+def best_match(code):
+    similar_files = run(search_api.search_similar_code(search_api.CodeRequest(code=code)))["similar_files"]
+    return similar_files[0]["file_path"], similar_files[0]["similarity_score"]
+
+def test_deleted_base_documents_are_tombstoned(shard):
+    assert delete("course/student3.py")["status"] == "deleted"
+    assert snapshot().tombstones.tolist() == [3]
+    assert snapshot().ntotal == N_FILES - 1
+    assert best_match("v3")[0] != "course/student3.py"
+    with pytest.raises(HTTPException) as error:
+        delete("course/student3.py")
+    assert error.value.status_code == 404
+
+def test_a_deleted_document_can_be_added_back_with_new_code(shard, index_dirs):
+    _, processed_dir = index_dirs
+    delete("course/student3.py")
+    response = add("course/student3.py", "v50")
+    assert response["status"] == "added"
+    assert best_match("v50") == ("course/student3.py", pytest.approx(1.0))
+    # The base row stays tombstoned; the document now lives in the delta index
+    assert best_match("v3")[0] != "course/student3.py"
+    assert snapshot().delta_docs == {"course/student3.py": [N_FILES]}
+    assert (processed_dir / "course/student3.py").read_text() == "v50"
+
+def test_replacing_an_added_document_removes_its_old_vectors(shard):
+    add("course/late.py", "v50")
+    assert add("course/late.py", "v51")["status"] == "replaced"
+    assert snapshot().delta_index.ntotal == 1
+    assert best_match("v51") == ("course/late.py", pytest.approx(1.0))
+    assert best_match("v50")[0] != "course/late.py"
+    delete("course/late.py")
+    assert snapshot().delta_index.ntotal == 0
+    assert snapshot().ntotal == N_FILES
+
+def test_updates_are_replayed_by_other_workers_and_after_restarts(shard):
+    delete("course/student1.py")
+    add("course/student2.py", "v50")
+    add("course/late.py", "v51")
+    delete("course/late.py")
+
+    restarted = search_api.load_index_snapshot(search_api.UNSHARDED, shard)
+    assert restarted.log_records == 4
+    assert restarted.content_version == snapshot().content_version
+    assert sorted(restarted.tombstones.tolist()) == [1, 2]
+    assert restarted.delta_docs == {"course/student2.py": [N_FILES]}
+    assert not restarted.has_document("course/student1.py")
+    assert not restarted.has_document("course/late.py")
+
+def test_a_partially_written_record_waits_for_its_end(shard):
+    log_path = shard / search_api.UPDATES_LOG
+    log_path.write_bytes(b'{"op": "delete", "doc_id": "course/student1.py"}\n{"op": "delete", "doc_')
+    search_api.replay_update_log(snapshot())
+    assert snapshot().log_records == 1
+    with open(log_path, "ab") as f:
+        f.write(b'id": "course/student2.py"}\n')
+    search_api.replay_update_log(snapshot())
+    assert snapshot().log_records == 2
+    assert sorted(snapshot().deleted_docs) == ["course/student1.py", "course/student2.py"]
+
+def test_document_ids_stay_inside_processed_codefiles(shard):
+    with pytest.raises(HTTPException) as error:
+        add("../outside.py", "v50")
+    assert error.value.status_code == 400
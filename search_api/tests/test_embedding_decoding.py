@@ -0,0 +1,62 @@
+"""Decoding binary embedding responses from the embedding API, with the JSON fallback."""
+
+import asyncio
+import json
+
+import httpx
+import numpy as np
+import pytest
+
+from search_api_helpers import random_vectors, search_api
+
+def payload(matrix: np.ndarray, dtype: str = "float32", metadata=None) -> bytes:
+    """Encode matrix the way embedding_api does."""
+    code = {"float32": 0, "float16": 1}[dtype]
+    body = search_api.EMBEDDING_HEADER.pack(b"EMB1", code, *matrix.shape)
+    body += matrix.astype(search_api.EMBEDDING_DTYPE_CODES[code]).tobytes()
+    return body + (json.dumps(metadata).encode("utf-8") if metadata is not None else b"")
+
+@pytest.fixture
+def embedding_service(monkeypatch):
+    """Serve /embed and /embed_batch from a handler set by the test, recording the Accept headers."""
+    state = {"handler": None, "accept": []}
+
+    def handle(request):
+        state["accept"].append(request.headers.get("accept"))
+        return state["handler"](json.loads(request.content))
+
+    monkeypatch.setattr(search_api, "embedding_client", httpx.AsyncClient(transport=httpx.MockTransport(handle)))
+    return state
+
+def binary(content: bytes, dtype: str = "float32") -> httpx.Response:
+    return httpx.Response(200, content=content, headers={"content-type": f"application/x-embeddings; dtype={dtype}"})
+
+@pytest.mark.parametrize("dtype, tolerance", [("float32", 0), ("float16", 1e-3)])
+def test_batch_embeddings_are_decoded_in_key_order(embedding_service, dtype, tolerance):
+    vectors = random_vectors(3)
+    embedding_service["handler"] = lambda body: binary(payload(vectors, dtype), dtype)
+    code_snippets = {"c.py": "c", "a.py": "a", "b.py": "b"}
+    matrix = asyncio.run(search_api.generate_embeddings_batch(code_snippets))
+    assert matrix.dtype == np.float32 and matrix.shape == (3, search_api.EMBEDDING_DIM)
+    np.testing.assert_allclose(matrix, vectors, atol=tolerance)
+    assert embedding_service["accept"][0].startswith("application/x-embeddings")
+
+def test_json_responses_are_still_understood(embedding_service):
+    vector = random_vectors(1)[0]
+    embedding_service["handler"] = lambda body: httpx.Response(200, json={"embedding": vector.tolist()})
+    np.testing.assert_allclose(asyncio.run(search_api.generate_embedding("code")), vector, rtol=1e-6)
+
+def test_chunk_spans_and_owners_come_from_the_trailer(embedding_service):
+    vectors = random_vectors(3)
+    spans = [[0, 1, 40, 512], [0, 30, 52, 300], [1, 1, 9, 80]]
+    embedding_service["handler"] = lambda body: binary(payload(vectors, metadata={"spans": spans}))
+    embeddings, line_ranges, owners = asyncio.run(
+        search_api.generate_chunk_embeddings_batch({"long.py": "long", "short.py": "short"})
+    )
+    np.testing.assert_array_equal(embeddings, vectors)
+    assert line_ranges.tolist() == [[1, 40], [30, 52], [1, 9]]
+    assert owners.tolist() == [0, 0, 1]
+
+def test_unknown_payloads_are_rejected():
+    with pytest.raises(Exception, match="Unexpected binary embedding payload"):
+        search_api.decode_embeddings(b"JSON" + payload(random_vectors(1))[4:])
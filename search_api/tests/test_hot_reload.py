@@ -0,0 +1,81 @@
+"""Hot reload of index versions written by the indexer while the service keeps serving."""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from search_api_helpers import random_vectors, search_api, write_index
+
+@pytest.fixture
+def served(index_dirs, embedder, monkeypatch):
+    """A served index of 20 files; returns its directory and the vectors of a newer build of 21 files."""
+    embeddings_dir, _ = index_dirs
+    monkeypatch.setattr(search_api, "failed_signatures", {})
+    monkeypatch.setattr(search_api, "last_reload_error", None)
+    monkeypatch.setattr(search_api, "reload_lock", asyncio.Lock())
+    vectors = random_vectors(21)
+    write_index(embeddings_dir, [f"course/student{i}.py" for i in range(20)], vectors[:20])
+    search_api.shards = {search_api.UNSHARDED: search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)}
+    embedder["late"] = vectors[20]
+    return embeddings_dir, vectors
+
+def write_new_version(embeddings_dir, vectors):
+    write_index(embeddings_dir, [f"course/student{i}.py" for i in range(len(vectors))], vectors)
+
+def search(code):
+    return asyncio.run(search_api.search_similar_code(search_api.CodeRequest(code=code)))
+
+def test_unchanged_files_are_not_reloaded(served):
+    snapshot = search_api.shards[search_api.UNSHARDED]
+    assert asyncio.run(search_api.reload_index()) is False
+    assert search_api.shards[search_api.UNSHARDED] is snapshot
+
+def test_a_new_version_is_swapped_in(served):
+    embeddings_dir, vectors = served
+    version = search("late")["index_version"]
+    write_new_version(embeddings_dir, vectors)
+    assert asyncio.run(search_api.reload_index()) is True
+    response = search("late")
+    assert response["index_version"] != version
+    assert response["similar_files"][0]["file_path"] == "course/student20.py"
+
+def test_a_broken_version_keeps_the_current_one_serving(served):
+    embeddings_dir, vectors = served
+    snapshot = search_api.shards[search_api.UNSHARDED]
+    write_new_version(embeddings_dir, vectors)
+    np.save(embeddings_dir / search_api.EMBEDDINGS_NPY, vectors[:5])  # The indexer died half way
+    with pytest.raises(RuntimeError, match="Embeddings have shape"):
+        asyncio.run(search_api.reload_index())
+    assert search_api.shards[search_api.UNSHARDED] is snapshot
+    assert "Embeddings have shape" in search_api.last_reload_error
+    # The same broken files are not retried on every poll, but fixed ones are picked up
+    assert asyncio.run(search_api.reload_index()) is False
+    write_new_version(embeddings_dir, vectors)
+    assert asyncio.run(search_api.reload_index()) is True
+    assert search_api.last_reload_error is None
+
+def test_a_search_in_flight_finishes_on_the_version_it_started_with(served, monkeypatch):
+    embeddings_dir, vectors = served
+    generate_embedding = search_api.generate_embedding
+    embedding_started = asyncio.Event()
+    reloaded = asyncio.Event()
+
+    async def slow_generate_embedding(code, normalize=False):
+        embedding_started.set()
+        await reloaded.wait()
+        return await generate_embedding(code, normalize)
+
+    async def run():
+        monkeypatch.setattr(search_api, "generate_embedding", slow_generate_embedding)
+        old_version = search_api.index_version(search_api.shards)
+        in_flight = asyncio.create_task(search_api.search_similar_code(search_api.CodeRequest(code="late")))
+        await embedding_started.wait()
+        write_new_version(embeddings_dir, vectors)
+        assert await search_api.reload_index() is True
+        reloaded.set()
+        response = await in_flight
+        assert response["index_version"] == old_version
+        assert "course/student20.py" not in [file["file_path"] for file in response["similar_files"]]
+
+    asyncio.run(run())
@@ -0,0 +1,128 @@
+"""Language detection and query routing over language shards."""
+
+import asyncio
+
+import pytest
+
+from search_api_helpers import generate_embeddings, load_layout, random_vectors, search_api
+
+HTML_PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><link rel="stylesheet" href="style.css"></head>
+<body><div class="card"><a href="/login">Log in</a></div></body>
+</html>
+"""
+
+HTML_FRAGMENT = """<div class="row">
+  <form method="post" action="/account"><input type="text" name="user"/></form>
+</div>
+"""
+
+XML_CONFIG = """<?xml version="1.0" encoding="UTF-8"?>
+<faceted-project>
+  <installed facet="java" version="1.8"/>
+</faceted-project>
+"""
+
+XML_NAMESPACED = """<beans:beans xmlns:beans="http://www.springframework.org/schema/beans">
+  <beans:bean id="service" class="app.Service"/>
+</beans:beans>
+"""
+
+DJANGO_URLS = """urlpatterns = [
+    path('<int:pk>/', views.detail, name='detail'),
+    path('<int:pk>/results/', views.results, name='results'),
+]
+"""
+
+JAVA_CODE = """public class Account {
+    public void deposit(int amount) {
+        System.out.println(amount);
+    }
+}
+"""
+
+PYTHON_CODE = """def deposit(amount):
+    print(amount)
+"""
+
+@pytest.fixture
+def sharded(index_dirs):
+    """Language shards written by the indexer, with its detection rules in the manifest."""
+    embeddings_dir, _ = index_dirs
+    code_files = {"web/index.html": HTML_PAGE, "web/config.xml": XML_CONFIG, "bank/Account.java": JAVA_CODE,
+                  "bank/account.py": PYTHON_CODE, "bank/notes": PYTHON_CODE}
+    file_paths = list(code_files)
+    shards = generate_embeddings.split_by_language(code_files, file_paths, random_vectors(len(file_paths)))
+    generate_embeddings.save_shards(embeddings_dir, shards)
+    return search_api.discover_shards()
+
+@pytest.mark.parametrize("code, language", [
+    (HTML_PAGE, "html"),
+    (HTML_FRAGMENT, "html"),
+    (XML_CONFIG, "xml"),
+    (XML_NAMESPACED, "xml"),
+    (DJANGO_URLS, "other"),  # URL converters are not namespaced tags
+    (JAVA_CODE, "java"),
+])
+def test_indexer_detects_language_from_content(code, language):
+    assert generate_embeddings.detect_language("submission", code) == language
+
+def test_manifest_carries_the_indexer_rules(sharded):
+    assert sorted(sharded) == ["html", "java", "python", "xml"]
+    assert search_api.language_rules["extensions"][".cpp"] == "cpp"
+    for code in (HTML_PAGE, HTML_FRAGMENT, XML_CONFIG, XML_NAMESPACED, DJANGO_URLS, JAVA_CODE):
+        assert (search_api.detect_language(code) or "other") == generate_embeddings.detect_language("submission", code)
+
+def test_extension_takes_precedence_over_content(sharded):
+    assert search_api.detect_language(HTML_PAGE, "templates/page.xml") == "xml"
+    assert search_api.detect_language(XML_CONFIG, None) == "xml"
+
+def test_without_rules_only_named_languages_route(index_dirs):
+    assert search_api.detect_language(HTML_PAGE) is None
+    assert search_api.detect_language(HTML_PAGE, "index.html") is None
+
+@pytest.fixture
+def guessed_wrong(index_dirs, embedder):
+    """A python query whose only real match is a Java file; the python shard holds unrelated files."""
+    embeddings_dir, _ = index_dirs
+    code_files = {f"bank/Account{i}.java": JAVA_CODE for i in range(5)}
+    code_files.update({f"bank/account{i}.py": PYTHON_CODE for i in range(3)})
+    file_paths = list(code_files)
+    vectors = random_vectors(len(file_paths))
+    generate_embeddings.save_shards(
+        embeddings_dir, generate_embeddings.split_by_language(code_files, file_paths, vectors)
+    )
+    load_layout()
+    embedder[PYTHON_CODE] = vectors[0]  # bank/Account0.java
+    embedder[JAVA_CODE] = vectors[1]  # bank/Account1.java
+    return file_paths
+
+def search(code, **kwargs):
+    request = search_api.CodeRequest(code=code, **kwargs)
+    return asyncio.run(search_api.search_similar_code(request))["similar_files"]
+
+def test_weak_matches_in_the_guessed_shard_fall_back_to_all_shards(guessed_wrong):
+    fallbacks = search_api.routing_stats["fallbacks"]
+    similar_files = search(PYTHON_CODE)
+    assert similar_files[0]["file_path"] == "bank/Account0.java"
+    assert similar_files[0]["similarity_score"] == pytest.approx(1.0)
+    assert search_api.routing_stats["fallbacks"] == fallbacks + 1
+
+def test_short_shard_results_fall_back_to_all_shards(guessed_wrong, monkeypatch):
+    monkeypatch.setattr(search_api, "CROSS_LANGUAGE_MIN_SIMILARITY", -1.0)
+    # The python shard holds 3 files, fewer than top_k
+    assert search(PYTHON_CODE, top_k=5)[0]["file_path"] == "bank/Account0.java"
+    # A full page of weak-but-accepted matches stays in the guessed shard
+    assert all(file["file_path"].endswith(".py") for file in search(PYTHON_CODE, top_k=3))
+
+def test_strong_matches_stay_in_their_shard(guessed_wrong):
+    fallbacks = search_api.routing_stats["fallbacks"]
+    similar_files = search(JAVA_CODE)
+    assert similar_files[0]["file_path"] == "bank/Account1.java"
+    assert all(file["file_path"].endswith(".java") for file in similar_files)
+    assert search_api.routing_stats["fallbacks"] == fallbacks
+
+def test_fallback_can_be_disabled(guessed_wrong, monkeypatch):
+    monkeypatch.setattr(search_api, "CROSS_LANGUAGE_FALLBACK", False)
+    assert all(file["file_path"].endswith(".py") for file in search(PYTHON_CODE))
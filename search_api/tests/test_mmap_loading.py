@@ -0,0 +1,39 @@
+"""Memory-mapped loading of the FAISS index and embeddings."""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from search_api_helpers import random_vectors, search_api, write_index
+
+N_FILES = 400
+
+def search(code):
+    response = asyncio.run(search_api.search_similar_code(search_api.CodeRequest(code=code)))
+    return [(file["file_path"], round(file["similarity_score"], 5)) for file in response["similar_files"]]
+
+@pytest.mark.parametrize("index_type", ["flat", "hnsw", "ivf-flat"])
+def test_mapped_index_answers_like_a_loaded_one(index_dirs, embedder, monkeypatch, index_type):
+    embeddings_dir, _ = index_dirs
+    vectors = random_vectors(N_FILES)
+    write_index(embeddings_dir, [f"course/student{i}.py" for i in range(N_FILES)], vectors, index_type)
+    queries = {f"query{i}": vectors[i * 40] for i in range(5)}
+    embedder.update(queries)
+
+    results = {}
+    for mmap in (True, False):
+        monkeypatch.setattr(search_api, "INDEX_MMAP", mmap)
+        snapshot = search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)
+        assert isinstance(snapshot.embeddings, np.memmap) == mmap
+        search_api.shards = {search_api.UNSHARDED: snapshot}
+        results[mmap] = [search(code) for code in queries]
+    assert results[True] == results[False]
+    assert [matches[0][0] for matches in results[True]] == [f"course/student{i * 40}.py" for i in range(5)]
+
+def test_embeddings_from_another_build_are_refused(index_dirs):
+    embeddings_dir, _ = index_dirs
+    write_index(embeddings_dir, [f"course/student{i}.py" for i in range(10)], random_vectors(10))
+    np.save(embeddings_dir / search_api.EMBEDDINGS_NPY, random_vectors(9))
+    with pytest.raises(RuntimeError, match="Embeddings have shape"):
+        search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)
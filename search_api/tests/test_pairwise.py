@@ -0,0 +1,93 @@
+"""/pairwise: suspicious pairs among submissions and their clusters."""
+
+import asyncio
+from itertools import combinations
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from search_api_helpers import DIM, random_vectors, search_api, unit
+
+def near(vector: np.ndarray, seed: int, distance: float = 0.2) -> np.ndarray:
+    """A unit vector about distance away from vector (cosine similarity around 0.98 for 0.2)."""
+    noise = random_vectors(1, seed)[0]
+    return unit((vector + distance * noise).reshape(1, DIM))[0]
+
+@pytest.fixture
+def assignment(embedder):
+    """Ten submissions: a chain of three copies, an identical pair and five originals."""
+    base = random_vectors(3, seed=10)
+    vectors = {
+        "copy_a": base[0], "copy_b": near(base[0], 11), "copy_c": near(near(base[0], 11), 12),
+        "pair_x": base[1],
+        **{f"original{i}": vector for i, vector in enumerate(random_vectors(5, seed=20))},
+    }
+    code_snippets = {key: f"def {key}():\n    return {i}\n" for i, key in enumerate(vectors)}
+    code_snippets["pair_y"] = code_snippets["pair_x"]
+    for key, code in code_snippets.items():
+        embedder[code] = vectors.get(key, base[1])
+    return code_snippets
+
+def pairwise(code_snippets, **options):
+    request = search_api.PairwiseRequest(code_snippets=code_snippets, **options)
+    return asyncio.run(search_api.pairwise_similarity(request))
+
+def brute_force_pairs(code_snippets, embedder, min_similarity):
+    keys = list(code_snippets)
+    pairs = {}
+    for a, b in combinations(keys, 2):
+        score = float(embedder[code_snippets[a]] @ embedder[code_snippets[b]])
+        if score >= min_similarity:
+            pairs[(a, b)] = score
+    return pairs
+
+def test_pairs_and_clusters(assignment, embedder):
+    response = pairwise(assignment, min_similarity=0.9)
+    expected = brute_force_pairs(assignment, embedder, 0.9)
+    assert {(pair["a"], pair["b"]) for pair in response["pairs"]} == set(expected)
+    assert response["suspicious_pairs"] == len(expected) == 4
+    for pair in response["pairs"]:
+        assert pair["similarity"] == pytest.approx(expected[(pair["a"], pair["b"])], abs=1e-5)
+    scores = [pair["similarity"] for pair in response["pairs"]]
+    assert scores == sorted(scores, reverse=True)
+    assert response["pairs"][0]["a"] == "pair_x" and response["pairs"][0]["lexical_overlap"] == 1.0
+
+    assert [cluster["members"] for cluster in response["clusters"]] == [["copy_a", "copy_b", "copy_c"], ["pair_x", "pair_y"]]
+    assert response["clusters"][0]["pairs"] == 3
+    assert response["clusters"][1]["max_similarity"] == pytest.approx(1.0)
+
+def test_a_chain_stays_one_cluster_with_one_neighbour(assignment):
+    response = pairwise(assignment, min_similarity=0.9, neighbors=1)
+    assert response["clusters"][0]["members"] == ["copy_a", "copy_b", "copy_c"]
+    assert response["clusters"][0]["pairs"] == 2
+
+def test_max_pairs_limits_the_listed_pairs_only(assignment):
+    response = pairwise(assignment, min_similarity=0.9, max_pairs=1)
+    assert len(response["pairs"]) == 1
+    assert response["suspicious_pairs"] == 4
+    assert len(response["clusters"]) == 2
+
+def test_submissions_are_embedded_in_batches(assignment, monkeypatch):
+    expected = pairwise(assignment, min_similarity=0.9)
+    monkeypatch.setattr(search_api, "SEARCH_BATCH_MAX_SIZE", 3)
+    assert pairwise(assignment, min_similarity=0.9) == expected
+
+def test_empty_submissions_are_reported_and_skipped(assignment):
+    response = pairwise({"blank": "  ", "pair_x": assignment["pair_x"], "pair_y": assignment["pair_y"]})
+    assert response["errors"] == {"blank": "After processing, the code is empty. Please provide valid code."}
+    assert response["submissions"] == 2
+    assert response["clusters"][0]["members"] == ["pair_x", "pair_y"]
+    assert pairwise({"alone": assignment["pair_x"]})["pairs"] == []
+
+@pytest.mark.parametrize("options", [{"neighbors": 0}, {"max_pairs": -1}])
+def test_invalid_options_are_refused(assignment, options):
+    with pytest.raises(HTTPException) as error:
+        pairwise(assignment, **options)
+    assert error.value.status_code == 400
+
+def test_oversized_requests_are_refused(assignment, monkeypatch):
+    monkeypatch.setattr(search_api, "PAIRWISE_MAX_SIZE", 5)
+    with pytest.raises(HTTPException) as error:
+        pairwise(assignment)
+    assert error.value.status_code == 400
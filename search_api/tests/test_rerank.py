@@ -0,0 +1,58 @@
+"""Exact re-ranking of candidates from a compressed (IVF-PQ) index."""
+
+import asyncio
+
+import numpy as np
+import pytest
+
+from search_api_helpers import DIM, generate_embeddings, random_vectors, search_api, unit, write_index
+
+N_CLUSTERS = 40
+CLUSTER_SIZE = 50
+
+@pytest.fixture
+def compressed(index_dirs, embedder, monkeypatch):
+    """An IVF-PQ index over clusters of files at graded distances from their centre.
+
+    Query "q<c>" lies next to the first file of cluster c. Returns every file's vector.
+    """
+    embeddings_dir, _ = index_dirs
+    monkeypatch.setattr(generate_embeddings, "PQ_M", 16)
+    monkeypatch.setattr(generate_embeddings, "PQ_NBITS", 4)
+    monkeypatch.setattr(search_api, "rerank_stats", {name: 0 for name in search_api.rerank_stats})
+    rng = np.random.default_rng(3)
+    centres = random_vectors(N_CLUSTERS, seed=4)
+    spread = np.linspace(0.1, 1.0, CLUSTER_SIZE)[:, None] / np.sqrt(DIM)
+    vectors = unit(np.vstack([centre + spread * rng.normal(size=(CLUSTER_SIZE, DIM)) for centre in centres]))
+    file_paths = [f"course/student{i}.py" for i in range(len(vectors))]
+    write_index(embeddings_dir, file_paths, vectors, "ivf-pq")
+    search_api.shards = {search_api.UNSHARDED: search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)}
+    assert search_api.shards[search_api.UNSHARDED].is_approximate()
+    for c in range(N_CLUSTERS):
+        embedder[f"q{c}"] = unit(vectors[c * CLUSTER_SIZE] + rng.normal(size=(1, DIM)) * 0.01 / np.sqrt(DIM))[0]
+    return vectors
+
+def search(code, **options):
+    request = search_api.CodeRequest(code=code, top_k=5, nprobe=N_CLUSTERS, **options)
+    return asyncio.run(search_api.search_similar_code(request))["similar_files"]
+
+def exact_top(vectors, query, k):
+    scores = vectors @ query
+    return [(f"course/student{i}.py", scores[i]) for i in np.argsort(-scores)[:k]]
+
+def test_reranked_results_are_exact(compressed, embedder):
+    for c in range(0, N_CLUSTERS, 8):
+        expected = exact_top(compressed, embedder[f"q{c}"], 5)
+        similar_files = search(f"q{c}", rerank_factor=8)
+        assert [file["file_path"] for file in similar_files] == [path for path, _ in expected]
+        for file, (_, score) in zip(similar_files, expected):
+            assert file["similarity_score"] == pytest.approx(score, abs=1e-5)
+    assert search_api.rerank_stats["queries"] == len(range(0, N_CLUSTERS, 8))
+
+def test_without_reranking_scores_are_approximate(compressed, embedder):
+    errors = []
+    for c in range(0, N_CLUSTERS, 8):
+        exact = dict(exact_top(compressed, embedder[f"q{c}"], len(compressed)))
+        errors += [abs(file["similarity_score"] - exact[file["file_path"]]) for file in search(f"q{c}", rerank_factor=1)]
+    assert max(errors) > 1e-3
+    assert search_api.rerank_stats["queries"] == 0
@@ -0,0 +1,74 @@
+"""Per-request top_k, min_similarity and range search on /search."""
+
+import asyncio
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+from search_api_helpers import generate_embeddings, random_vectors, search_api, unit, write_index
+
+N_FILES = 300
+
+def expected_similarity(metric, query, vectors):
+    """Similarity scores the way /search reports them."""
+    if metric == "cosine":
+        return vectors @ query
+    return 1.0 / (1.0 + np.sum((vectors - query) ** 2, axis=1))
+
+@pytest.fixture(params=["cosine", "l2"])
+def shard(request, index_dirs, embedder, monkeypatch):
+    """A flat index whose files are increasingly similar to the query "q"; returns the metric and every file's score."""
+    embeddings_dir, _ = index_dirs
+    metric = request.param
+    monkeypatch.setattr(generate_embeddings, "METRIC", metric)
+    query = random_vectors(1, seed=1)[0]
+    closeness = np.linspace(0.0, 0.99, N_FILES)[:, None]
+    vectors = unit(closeness * query + (1 - closeness) * random_vectors(N_FILES, seed=2))
+    file_paths = [f"course/student{i}.py" for i in range(N_FILES)]
+    write_index(embeddings_dir, file_paths, vectors)
+    search_api.shards = {search_api.UNSHARDED: search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)}
+    embedder["q"] = query
+    return metric, dict(zip(file_paths, expected_similarity(metric, query, vectors)))
+
+def search(**options):
+    request = search_api.CodeRequest(code="q", **options)
+    return asyncio.run(search_api.search_similar_code(request))["similar_files"]
+
+def ranked(scores, min_similarity=-1.0):
+    return [path for path, score in sorted(scores.items(), key=lambda item: -item[1]) if score >= min_similarity]
+
+def test_top_k(shard):
+    _, scores = shard
+    assert [file["file_path"] for file in search()] == ranked(scores)[:search_api.TOP_K]
+    similar_files = search(top_k=20)
+    assert [file["file_path"] for file in similar_files] == ranked(scores)[:20]
+    for file in similar_files:
+        assert file["similarity_score"] == pytest.approx(scores[file["file_path"]], abs=1e-5)
+
+def test_min_similarity_drops_weaker_matches(shard):
+    _, scores = shard
+    threshold = sorted(scores.values())[-5] - 1e-4
+    assert [file["file_path"] for file in search(top_k=20, min_similarity=threshold)] == ranked(scores, threshold)
+
+@pytest.mark.parametrize("rank", [1, 40, 150])
+def test_range_search_returns_every_file_above_the_threshold(shard, rank):
+    _, scores = shard
+    # Halfway between two neighbouring scores, so float rounding cannot move a file across it
+    ordered = sorted(scores.values(), reverse=True)
+    threshold = float((ordered[rank - 1] + ordered[rank]) / 2)
+    similar_files = search(range_search=True, min_similarity=threshold)
+    assert [file["file_path"] for file in similar_files] == ranked(scores, threshold)[:search_api.MAX_TOP_K]
+    assert len(similar_files) == min(rank, search_api.MAX_TOP_K)
+    assert len(search(range_search=True, min_similarity=threshold, top_k=5)) == min(rank, 5)
+
+@pytest.mark.parametrize("options", [
+    {"top_k": 0},
+    {"top_k": 10_000},
+    {"range_search": True},
+    {"rerank_factor": 1000},
+])
+def test_invalid_options_are_refused(options):
+    with pytest.raises(HTTPException) as error:
+        search_api.resolve_result_options(search_api.CodeRequest(code="q", **options))
+    assert error.value.status_code == 400
@@ -0,0 +1,64 @@
+"""/search_batch: many queries per request with one embedding call."""
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from search_api_helpers import random_vectors, search_api, write_index
+
+N_FILES = 100
+
+@pytest.fixture
+def shard(index_dirs, embedder, monkeypatch):
+    """A flat index of N_FILES files; code "q<i>" embeds to the vector of course/student<i>.py.
+
+    Returns the list of /embed_batch calls made.
+    """
+    embeddings_dir, _ = index_dirs
+    vectors = random_vectors(N_FILES)
+    write_index(embeddings_dir, [f"course/student{i}.py" for i in range(N_FILES)], vectors)
+    search_api.shards = {search_api.UNSHARDED: search_api.load_index_snapshot(search_api.UNSHARDED, embeddings_dir)}
+    embedder.update({f"q{i}": vector for i, vector in enumerate(vectors)})
+
+    calls = []
+    generate_embeddings_batch = search_api.generate_embeddings_batch
+
+    async def recording_generate_embeddings_batch(code_snippets, normalize=False):
+        calls.append(list(code_snippets))
+        return await generate_embeddings_batch(code_snippets, normalize)
+
+    monkeypatch.setattr(search_api, "generate_embeddings_batch", recording_generate_embeddings_batch)
+    return calls
+
+def search_batch(code_snippets, **options):
+    request = search_api.BatchCodeRequest(code_snippets=code_snippets, **options)
+    return asyncio.run(search_api.search_similar_code_batch(request))
+
+def search(code, **options):
+    return asyncio.run(search_api.search_similar_code(search_api.CodeRequest(code=code, **options)))
+
+def test_batch_results_match_single_searches(shard):
+    code_snippets = {f"submission{i}": f"q{i * 7}" for i in range(10)}
+    response = search_batch(code_snippets, top_k=5)
+    assert list(response["results"]) == list(code_snippets)
+    assert len(shard) == 1
+    for key, code in code_snippets.items():
+        assert response["results"][key]["similar_files"] == search(code, top_k=5)["similar_files"]
+    assert response["index_version"] == search("q0")["index_version"]
+
+def test_an_empty_snippet_fails_alone(shard):
+    response = search_batch({"blank": "   ", "ok": "q3", "other": "q4"})
+    assert response["results"]["blank"]["error"].startswith("After processing, the code is empty")
+    assert response["results"]["blank"]["similar_files"] == []
+    assert "error" not in response["results"]["ok"]
+    assert response["results"]["ok"]["similar_files"][0]["file_path"] == "course/student3.py"
+    assert shard == [["ok", "other"]]
+
+def test_empty_and_oversized_batches(shard, monkeypatch):
+    assert search_batch({})["results"] == {}
+    assert shard == []
+    monkeypatch.setattr(search_api, "SEARCH_BATCH_MAX_SIZE", 2)
+    with pytest.raises(HTTPException) as error:
+        search_batch({"a": "q1", "b": "q2", "c": "q3"})
+    assert error.value.status_code == 400